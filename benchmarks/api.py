@@ -0,0 +1,230 @@
+"""Replays a weighted mix of API requests and reports throughput, latency percentiles and queries per request.
+
+    python manage.py generate_catalogue --books 10000 --users 200
+    python -m benchmarks.api --duration 30 --threads 4 --output results/$(git rev-parse --short HEAD).json
+    python -m benchmarks.api --compare results/base.json results/head.json
+
+Requests go through the whole Django stack (middleware, routing, views,
+serializers and the database named by DJANGO_SETTINGS_MODULE) with the
+test client, so the queries of every request can be counted; there is no
+HTTP server in between. benchmarks.serving measures serving over HTTP.
+The users are the ones generate_catalogue creates.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from benchmarks.http import percentile
+
+PASSWORD = 'bench-password'
+SAMPLE_SIZE = 10000
+SEARCH_TERMS = ['метро', 'онегин', 'программирование', 'война мир', 'станция туннель', 'сад']
+
+
+def book_create(data, rng):
+    return {'title': 'Benchmark %d' % rng.getrandbits(32), 'isbn': '978-5-0000-0000-0', 'status': 'a',
+            'authors': [], 'genre': []}
+
+
+# name, weight, user ('reader', 'admin' for the staff-only views, or None), method, path or path factory, body factory, extra headers
+SCENARIOS = [
+    ('book list', 15, 'reader', 'GET', '/api/books', None, {}),
+    ('book list small page', 10, 'reader', 'GET', '/api/books?page_size=10', None, {}),
+    ('book detail', 20, 'admin', 'GET', lambda data, rng: '/api/books/%d' % rng.choice(data['books']), None, {}),
+    ('book search', 8, 'reader', 'GET', lambda data, rng: '/api/books/search?q=%s' % rng.choice(SEARCH_TERMS), None, {}),
+    ('author list', 4, 'reader', 'GET', '/api/authors', None, {}),
+    ('author detail', 5, 'reader', 'GET', lambda data, rng: '/api/authors/%d' % rng.choice(data['authors']), None, {}),
+    ('genre list', 4, 'admin', 'GET', '/api/genre', None, {}),
+    ('genre detail', 3, 'admin', 'GET', lambda data, rng: '/api/genre/%d' % rng.choice(data['genres']), None, {}),
+    ('book instance list', 1, 'admin', 'GET', '/api/bookinstances', None, {}),
+    ('book instance detail', 3, 'reader', 'GET',
+     lambda data, rng: '/api/bookinstances/%s' % rng.choice(data['instances']), None, {}),
+    ('book text page', 5, 'reader', 'GET',
+     lambda data, rng: '/api/bookinstances/%s/content?page=1' % rng.choice(data['instances']), None, {}),
+    ('book text range', 3, 'reader', 'GET',
+     lambda data, rng: '/api/bookinstances/%s/content' % rng.choice(data['instances']), None,
+     {'HTTP_RANGE': 'bytes=0-65535'}),
+    ('profile', 5, 'reader', 'GET', '/api/profile', None, {}),
+    ('profile update', 2, 'reader', 'PUT', '/api/profile',
+     lambda data, rng: {'location': rng.choice(SEARCH_TERMS)}, {}),
+    ('login', 2, None, 'POST', '/auth/login',
+     lambda data, rng: {'username': rng.choice(data['readers']), 'password': PASSWORD}, {}),
+    ('register', 1, None, 'POST', '/auth/register',
+     lambda data, rng: {'username': 'bench-new-%d' % rng.getrandbits(48), 'password': PASSWORD,
+                        'email': 'new-%d@example.com' % rng.getrandbits(48)}, {}),
+    ('book create', 1, 'admin', 'POST', '/api/books', book_create, {}),
+]
+
+
+def sample_data(prefix):
+    from django.contrib.auth.models import User
+    from libraryapp.models import Author, Book, BookInstance, Genre
+
+    data = {
+        'books': list(Book.objects.order_by('?').values_list('pk', flat=True)[:SAMPLE_SIZE]),
+        'authors': list(Author.objects.order_by('?').values_list('pk', flat=True)[:SAMPLE_SIZE]),
+        'genres': list(Genre.objects.values_list('pk', flat=True)[:SAMPLE_SIZE]),
+        'instances': [str(value) for value in
+                      BookInstance.objects.order_by('?').values_list('id_security', flat=True)[:SAMPLE_SIZE]],
+        'readers': list(User.objects.filter(username__startswith='%s-user-' % prefix)
+                        .values_list('username', flat=True)[:SAMPLE_SIZE]),
+        'admin': '%s-admin' % prefix,
+    }
+    missing = [name for name, values in data.items() if not values]
+    if missing:
+        raise SystemExit('No %s in the database, run manage.py generate_catalogue first' % ', '.join(missing))
+    return data
+
+
+def dataset_size():
+    from django.contrib.auth.models import User
+    from libraryapp.models import Author, Book, BookInstance, Genre
+
+    return {model._meta.model_name: model.objects.count() for model in (Book, BookInstance, Author, Genre, User)}
+
+
+def login(client, username):
+    response = client.post('/auth/login', {'username': username, 'password': PASSWORD})
+    if response.status_code != 200:
+        raise SystemExit('Cannot log in as %s: %s' % (username, response.status_code))
+    return 'Bearer %s' % response.json()['access']
+
+
+def worker(index, data, deadline, max_requests, seed, samples):
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    rng = random.Random(seed + index)
+    client = Client()
+    tokens = {'reader': login(client, data['readers'][index % len(data['readers'])]),
+              'admin': login(client, data['admin']), None: None}
+    weights = [scenario[1] for scenario in SCENARIOS]
+    done = 0
+    try:
+        while time.monotonic() < deadline and (max_requests is None or done < max_requests):
+            name, _, user, method, path, body, headers = rng.choices(SCENARIOS, weights)[0]
+            path = path(data, rng) if callable(path) else path
+            extra = dict(headers)
+            if tokens[user]:
+                extra['HTTP_AUTHORIZATION'] = tokens[user]
+            kwargs = {'data': json.dumps(body(data, rng)), 'content_type': 'application/json'} if body else {}
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = getattr(client, method.lower())(path, **kwargs, **extra)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                elapsed = time.perf_counter() - started
+            samples.append((name, elapsed, len(queries), response.status_code))
+            done += 1
+    finally:
+        connection.close()
+
+
+def summarize(samples, elapsed):
+    def stats(rows):
+        latencies = [row[1] for row in rows]
+        queries = [row[2] for row in rows]
+        return {
+            'requests': len(rows),
+            'errors': sum(1 for row in rows if row[3] >= 400),
+            'throughput': len(rows) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'queries_mean': sum(queries) / len(queries) if queries else 0.0,
+            'queries_max': max(queries, default=0),
+        }
+
+    by_name = defaultdict(list)
+    for row in samples:
+        by_name[row[0]].append(row)
+    return stats(samples), {name: stats(rows) for name, rows in sorted(by_name.items())}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(overall, endpoints):
+    print('%-22s %8s %7s %9s %9s %9s %9s %8s' % ('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+                                                  'p99 ms', 'queries'))
+    for name, row in list(endpoints.items()) + [('all', overall)]:
+        print('%-22s %8d %7d %9.1f %9.1f %9.1f %9.1f %8.1f' % (
+            name, row['requests'], row['errors'], row['throughput'], row['p50_ms'], row['p95_ms'], row['p99_ms'],
+            row['queries_mean']))
+
+
+def compare(base_path, head_path, threshold):
+    """Prints the change of every endpoint; returns True if any got slower than threshold or runs more queries."""
+    with open(base_path) as base_file, open(head_path) as head_file:
+        base, head = json.load(base_file), json.load(head_file)
+    regressed = False
+    print('%-22s %10s %10s %8s %9s %9s' % ('endpoint', 'base p95', 'head p95', 'change', 'base q', 'head q'))
+    for name, row in sorted(head['endpoints'].items()):
+        old = base['endpoints'].get(name)
+        if old is None:
+            print('%-22s %10s %10.1f' % (name, '-', row['p95_ms']))
+            continue
+        change = row['p95_ms'] / old['p95_ms'] - 1 if old['p95_ms'] else 0.0
+        worse = change > threshold or row['queries_mean'] > old['queries_mean'] + 0.01
+        regressed |= worse
+        print('%-22s %10.1f %10.1f %+7.0f%% %9.1f %9.1f%s' % (
+            name, old['p95_ms'], row['p95_ms'], change * 100, old['queries_mean'], row['queries_mean'],
+            '  REGRESSION' if worse else ''))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--requests', type=int, default=None, help='stop each thread after this many requests')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--prefix', default='bench', help='username prefix given to generate_catalogue')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'HEAD'), help='compare two JSON result files')
+    parser.add_argument('--threshold', type=float, default=0.10, help='p95 slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'library.settings')
+    import django
+    django.setup()
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+
+    data = sample_data(args.prefix)
+    samples = []
+    deadline = time.monotonic() + args.duration
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(index, data, deadline, args.requests, args.seed, samples))
+               for index in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    overall, endpoints = summarize(samples, time.perf_counter() - started)
+    print_table(overall, endpoints)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as output:
+            json.dump({'commit': git_commit(), 'vendor': connection.vendor, 'threads': args.threads,
+                       'dataset': dataset_size(),
+                       'overall': overall, 'endpoints': endpoints}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
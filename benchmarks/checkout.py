@@ -0,0 +1,137 @@
+"""Races hundreds of readers for a few books and checks that no copy is lent twice.
+
+    python manage.py generate_catalogue --books 1000 --users 300
+    python -m benchmarks.checkout --readers 300 --books 3
+
+Every reader thread waits at a barrier, then checks out one of the --books
+books at once; the losers join its waitlist. The holders then return the
+books until every waitlist is empty. The run fails if a book ever had two
+open loans, if the number of successful checkouts differs from the number
+of books, or if a waitlist was not served in order. The chosen books are
+reset to available and their loans and reservations deleted first, so
+point DJANGO_SETTINGS_MODULE at a benchmark database.
+"""
+import argparse
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+from benchmarks.http import percentile
+
+
+def access_token(user):
+    from libraryapp.serializers import ClaimsTokenObtainPairSerializer
+
+    return 'Bearer %s' % ClaimsTokenObtainPairSerializer.get_token(user).access_token
+
+
+def reader(index, user, books, barrier, results):
+    from django.db import connection
+    from django.test import Client
+
+    client = Client(raise_request_exception=False)
+    token = access_token(user)
+    book_id = books[index % len(books)]
+    try:
+        barrier.wait()
+        started = time.perf_counter()
+        response = client.post('/api/books/%d/checkout' % book_id, HTTP_AUTHORIZATION=token)
+        results['checkout'].append((book_id, user.pk, response.status_code, time.perf_counter() - started))
+        if response.status_code == 409:
+            started = time.perf_counter()
+            response = client.post('/api/books/%d/reservation' % book_id, HTTP_AUTHORIZATION=token)
+            results['reserve'].append((book_id, user.pk, response.status_code, time.perf_counter() - started))
+    finally:
+        connection.close()
+
+
+def drain(books, tokens):
+    """Returns every book until its waitlist is empty; returns the users who got each book, in order."""
+    from django.test import Client
+    from libraryapp.models import Loan
+
+    client = Client(raise_request_exception=False)
+    holders = defaultdict(list)
+    for book_id in books:
+        while True:
+            loan = Loan.objects.filter(book_id=book_id, returned_at__isnull=True).first()
+            if loan is None:
+                break
+            holders[book_id].append(loan.user_id)
+            response = client.post('/api/books/%d/return' % book_id, HTTP_AUTHORIZATION=tokens[loan.user_id])
+            if response.status_code != 204:
+                raise SystemExit('Return of book %d failed: %s' % (book_id, response.status_code))
+    return holders
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readers', type=int, default=200)
+    parser.add_argument('--books', type=int, default=1)
+    parser.add_argument('--prefix', default='bench', help='username prefix given to generate_catalogue')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'library.settings')
+    import django
+    django.setup()
+    from django.contrib.auth.models import User
+    from django.test.utils import setup_test_environment
+    from libraryapp.cache import get_response_cache
+    from libraryapp.models import Book, Loan, Reservation
+    setup_test_environment()
+
+    users = list(User.objects.filter(username__startswith='%s-user-' % args.prefix, profile__is_reader=True)
+                 .order_by('pk')[:args.readers])
+    if len(users) < args.readers:
+        raise SystemExit('Only %d readers, run manage.py generate_catalogue --users %d' % (len(users), args.readers))
+    rng = random.Random(args.seed)
+    books = rng.sample(list(Book.objects.values_list('pk', flat=True)), args.books)
+    Loan.objects.filter(book_id__in=books).delete()
+    Reservation.objects.filter(book_id__in=books).delete()
+    Book.objects.filter(pk__in=books).update(status='a')
+    get_response_cache().clear()
+
+    results = {'checkout': [], 'reserve': []}
+    barrier = threading.Barrier(len(users))
+    threads = [threading.Thread(target=reader, args=(index, user, books, barrier, results))
+               for index, user in enumerate(users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    for name, rows in results.items():
+        latencies = [row[3] for row in rows]
+        print('%-8s %5d requests  %s  p50 %7.1f ms  p99 %7.1f ms' % (
+            name, len(rows), ' '.join('%s: %d' % item for item in sorted(Counter(row[2] for row in rows).items())),
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+    print('%.2f s for %d readers' % (elapsed, len(users)))
+
+    failures = []
+    granted = Counter(row[0] for row in results['checkout'] if row[2] == 201)
+    for book_id in books:
+        if granted[book_id] != 1:
+            failures.append('book %d was checked out %d times' % (book_id, granted[book_id]))
+    open_loans = Counter(Loan.objects.filter(book_id__in=books, returned_at__isnull=True).values_list('book_id', flat=True))
+    failures += ['book %d has %d open loans' % item for item in open_loans.items() if item[1] != 1]
+    queues = {book_id: list(Reservation.objects.filter(book_id=book_id).order_by('pk').values_list('user_id', flat=True))
+              for book_id in books}
+    tokens = {user.pk: access_token(user) for user in users}
+    holders = drain(books, tokens)
+    for book_id in books:
+        if holders[book_id][1:] != queues[book_id]:
+            failures.append('the waitlist of book %d was not served in order' % book_id)
+    if Book.objects.filter(pk__in=books).exclude(status='a').exists():
+        failures.append('books are not available after the waitlists were served')
+    served = sum(len(queue) for queue in queues.values())
+    print('%d waitlist places served in order' % served if not failures else '\n'.join(failures))
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Measures what opening a database connection per request costs, against persistent connections.
+
+    python -m benchmarks.connections --token $ADMIN_ACCESS_TOKEN --paths /api/genre --duration 10
+
+The server is started twice from gunicorn.conf.py: with DB_CONN_MAX_AGE=0,
+which closes the connection after every request as before, and with the
+given --max-age. Small endpoints show the difference best, their own
+queries take less time than the connection setup. Point DB_HOST at
+pgbouncer to measure that setup instead.
+"""
+import argparse
+import asyncio
+import json
+
+from benchmarks.serving import run_load, start_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', default='wsgi', choices=['wsgi', 'asgi'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--connections', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--max-age', type=int, default=300, help='DB_CONN_MAX_AGE of the persistent run')
+    parser.add_argument('--paths', nargs='+', default=['/api/genre', '/api/authors'])
+    parser.add_argument('--token', help='JWT access token sent as a Bearer Authorization header')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    headers = {'Authorization': 'Bearer %s' % args.token} if args.token else {}
+    results = []
+    for max_age in (0, args.max_age):
+        server = start_server(args.mode, args.host, args.port, args.workers, env={'DB_CONN_MAX_AGE': str(max_age)})
+        try:
+            result = asyncio.run(run_load(args.host, args.port, args.paths, args.connections, args.duration, 0.0,
+                                          headers))
+        finally:
+            server.terminate()
+            server.wait()
+        result['max_age'] = max_age
+        results.append(result)
+        print('max age {max_age:5d}  {throughput:9.1f} req/s  p50 {p50_ms:8.1f} ms  p95 {p95_ms:8.1f} ms  '
+              'p99 {p99_ms:8.1f} ms  errors {errors}'.format(**result))
+    closing, persistent = results
+    if closing['p50_ms']:
+        print('persistent connections: p50 %+.0f%%, throughput %+.0f%%' % (
+            (persistent['p50_ms'] / closing['p50_ms'] - 1) * 100,
+            (persistent['throughput'] / closing['throughput'] - 1) * 100 if closing['throughput'] else 0))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'mode': args.mode, 'workers': args.workers, 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+
+class Connection:
+    """Minimal keep-alive HTTP/1.1 client over asyncio streams, so the load generator has no dependencies."""
+
+    def __init__(self, host, port, headers=None):
+        self.host = host
+        self.port = port
+        self.headers = headers or {}
+        self.reader = self.writer = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.reader = self.writer = None
+
+    async def request(self, method, path, body=b'', headers=None, send_delay=0.0):
+        """Returns (status, headers, body, seconds); send_delay simulates a slow client sending its request."""
+        if self.writer is None:
+            await self.open()
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s:%d' % (self.host, self.port),
+                 'Content-Length: %d' % len(body)]
+        lines += ['%s: %s' % item for item in dict(self.headers, **(headers or {})).items()]
+        started = time.perf_counter()
+        data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+        if send_delay:
+            self.writer.write(data[:len(lines[0])])
+            await self.writer.drain()
+            await asyncio.sleep(send_delay)
+            data = data[len(lines[0]):]
+        self.writer.write(data)
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            await self.close()
+            raise ConnectionError('connection closed by server')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        if response_headers.get('transfer-encoding') == 'chunked':
+            data = b''
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                data += chunk[:-2]
+        elif 'content-length' in response_headers:
+            data = await self.reader.readexactly(int(response_headers['content-length']))
+        else:
+            data = await self.reader.read()
+            await self.close()
+        if response_headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, response_headers, data, time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
@@ -0,0 +1,62 @@
+"""Measures what the request instrumentation costs, to check it stays below 1% of the request time.
+
+    python manage.py generate_catalogue --books 10000
+    python -m benchmarks.instrumentation --requests 500
+
+The same GET requests go through the whole stack with the test client,
+alternately with InstrumentationMiddleware in MIDDLEWARE and without it;
+without it no metrics are collected, so the query wrapper and the view
+phases return right away. Each path is the median of --repeat rounds of
+--requests requests.
+"""
+import argparse
+import os
+import statistics
+import time
+
+PATHS = ['/api/books', '/api/books?page_size=10', '/api/books?ordering=title', '/api/books?status=a']
+
+
+def round_seconds(client, requests):
+    started = time.perf_counter()
+    for _ in range(requests):
+        for path in PATHS:
+            client.get(path)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'library.settings')
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.test import Client
+    from django.test.utils import override_settings, setup_test_environment
+    from rest_framework.settings import api_settings
+    setup_test_environment()
+    # thousands of requests from one client would be throttled
+    api_settings.DEFAULT_THROTTLE_RATES.clear()
+
+    middleware = [name for name in settings.MIDDLEWARE if name != 'libraryapp.instrumentation.InstrumentationMiddleware']
+    client = Client()
+    round_seconds(client, 10)
+    with_metrics, without = [], []
+    # alternated, so a change of load on the machine affects both the same way
+    for _ in range(args.repeat):
+        with_metrics.append(round_seconds(client, args.requests))
+        with override_settings(MIDDLEWARE=middleware):
+            without.append(round_seconds(client, args.requests))
+    count = args.requests * len(PATHS)
+    on, off = statistics.median(with_metrics), statistics.median(without)
+    print('with instrumentation     %8.3f ms per request' % (on / count * 1000))
+    print('without instrumentation  %8.3f ms per request' % (off / count * 1000))
+    print('overhead                 %8.2f %%' % ((on - off) / off * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Times serializing and rendering a large book payload, before and after the rendering changes.
+
+    python manage.py generate_catalogue --books 10000
+    python -m benchmarks.rendering --books 10000
+
+"before" is BookSerializer with stock ModelSerializer nested serializers
+rendered by DRF's JSONRenderer; "after" is the current BookSerializer with
+the orjson and MessagePack renderers. The sparse rows select ?fields=id,title
+and load only what those fields need. Every step is the median of --repeat
+runs over the same books; the stream rows time GET /api/books?stream=1
+through the whole stack.
+"""
+import argparse
+import os
+import statistics
+import time
+
+
+def timed(repeat, func):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times), result
+
+
+def reference_serializer():
+    from rest_framework import serializers
+    from libraryapp.models import Author, Book, BookInstance
+    from libraryapp.serializers import GenreSerializer
+
+    class AuthorToBook(serializers.ModelSerializer):
+        class Meta:
+            model = Author
+            fields = ('id', 'first_name', 'last_name')
+
+    class BookInstanceToBook(serializers.ModelSerializer):
+        class Meta:
+            model = BookInstance
+            fields = ('id_security',)
+
+    class ReferenceBookSerializer(serializers.ModelSerializer):
+        authors = AuthorToBook(many=True, read_only=True)
+        genre = GenreSerializer(many=True, read_only=True)
+        id_inst = BookInstanceToBook(many=False, read_only=True)
+
+        class Meta:
+            model = Book
+            fields = ('id', 'title', 'authors', 'isbn', 'genre', 'status', 'id_inst')
+
+    return ReferenceBookSerializer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'library.settings')
+    import django
+    django.setup()
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    from rest_framework.renderers import JSONRenderer
+    from libraryapp.models import Book
+    from libraryapp.renderers import MessagePackRenderer, ORJSONRenderer, msgpack, orjson
+    from libraryapp.serializers import BookSerializer, eager_loading, restrict_fields
+    setup_test_environment()
+
+    if orjson is None:
+        raise SystemExit('orjson is not installed')
+    queryset = Book.objects.order_by('pk')[:args.books]
+    books = list(eager_loading(queryset, BookSerializer))
+    if len(books) < args.books:
+        raise SystemExit('Only %d books, run manage.py generate_catalogue --books %d' % (len(books), args.books))
+    reference = reference_serializer()
+    rows = []
+
+    def row(name, seconds, size=None):
+        rows.append((name, seconds))
+        print('%-38s %8.1f ms%s' % (name, seconds * 1000, '  %8.1f KiB' % (size / 1024) if size else ''))
+
+    before, data = timed(args.repeat, lambda: reference(books, many=True).data)
+    row('serialize, ModelSerializer nested', before)
+    after, data = timed(args.repeat, lambda: BookSerializer(books, many=True).data)
+    row('serialize, plain nested', after)
+    seconds, body = timed(args.repeat, lambda: JSONRenderer().render(data))
+    row('render, DRF JSONRenderer', seconds, len(body))
+    seconds, body = timed(args.repeat, lambda: ORJSONRenderer().render(data))
+    row('render, orjson', seconds, len(body))
+    if msgpack is not None:
+        seconds, body = timed(args.repeat, lambda: MessagePackRenderer().render(data))
+        row('render, msgpack', seconds, len(body))
+
+    before, _ = timed(args.repeat, lambda: JSONRenderer().render(reference(list(eager_loading(queryset, reference)),
+                                                                           many=True).data))
+    row('load + serialize + render, before', before)
+    after, _ = timed(args.repeat, lambda: ORJSONRenderer().render(BookSerializer(list(eager_loading(queryset, BookSerializer)),
+                                                                                 many=True).data))
+    row('load + serialize + render, after', after)
+    fields = ['id', 'title']
+    sparse, body = timed(args.repeat, lambda: ORJSONRenderer().render(restrict_fields(
+        BookSerializer(list(eager_loading(queryset.defer(None), BookSerializer, fields)), many=True), fields).data))
+    row('load + serialize + render, id,title', sparse, len(body))
+
+    client = Client()
+    for name, params in (('stream, all fields', {'stream': 1}), ('stream, id,title', {'stream': 1, 'fields': 'id,title'})):
+        seconds, body = timed(args.repeat, lambda: b''.join(client.get('/api/books', params).streaming_content))
+        row('%s (%d books)' % (name, len(orjson.loads(body))), seconds, len(body))
+
+
+if __name__ == '__main__':
+    main()
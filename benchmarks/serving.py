@@ -0,0 +1,113 @@
+"""Compares WSGI (gunicorn gthread) and ASGI (gunicorn + uvicorn) serving of the read endpoints.
+
+    python -m benchmarks.serving --connections 10 50 200 --duration 10 --send-delay 0.05
+
+Each mode is started from gunicorn.conf.py with SERVER_MODE set, then every
+connection count is run for --duration seconds. --send-delay makes each
+client pause after the request line, the way a slow mobile connection does.
+The database named by DJANGO_SETTINGS_MODULE must already be migrated and
+contain data.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from benchmarks.http import Connection, percentile
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start on %s:%d' % (host, port))
+
+
+def start_server(mode, host, port, workers, env=None):
+    env = dict(os.environ, **(env or {}), SERVER_MODE=mode, WEB_BIND='%s:%d' % (host, port), WEB_WORKERS=str(workers))
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(host, port)
+    return process
+
+
+async def client(host, port, paths, deadline, send_delay, headers, latencies, errors):
+    connection = Connection(host, port, headers)
+    index = 0
+    while time.monotonic() < deadline:
+        path = paths[index % len(paths)]
+        index += 1
+        try:
+            status, _, _, seconds = await connection.request('GET', path, send_delay=send_delay)
+        except (ConnectionError, asyncio.IncompleteReadError, OSError):
+            errors.append(path)
+            await connection.close()
+            continue
+        if status >= 400:
+            errors.append(path)
+        latencies.append(seconds)
+    await connection.close()
+
+
+async def run_load(host, port, paths, connections, duration, send_delay, headers):
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(client(host, port, paths, deadline, send_delay, headers, latencies, errors)
+                           for _ in range(connections)))
+    elapsed = time.perf_counter() - started
+    return {
+        'connections': connections,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['wsgi', 'asgi'], choices=['wsgi', 'asgi'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--connections', nargs='+', type=int, default=[10, 50, 200])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--send-delay', type=float, default=0.0)
+    parser.add_argument('--paths', nargs='+', default=['/api/books', '/api/books?page_size=10'])
+    parser.add_argument('--token', help='JWT access token sent as a Bearer Authorization header')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    headers = {'Authorization': 'Bearer %s' % args.token} if args.token else {}
+    results = []
+    for mode in args.modes:
+        server = start_server(mode, args.host, args.port, args.workers)
+        try:
+            for connections in args.connections:
+                result = asyncio.run(run_load(args.host, args.port, args.paths, connections, args.duration,
+                                              args.send_delay, headers))
+                result['mode'] = mode
+                results.append(result)
+                print('{mode:5} {connections:5d} conns  {throughput:9.1f} req/s  p50 {p50_ms:8.1f} ms  '
+                      'p95 {p95_ms:8.1f} ms  p99 {p99_ms:8.1f} ms  errors {errors}'.format(**result))
+        finally:
+            server.terminate()
+            server.wait()
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'workers': args.workers, 'send_delay': args.send_delay, 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
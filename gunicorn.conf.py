@@ -0,0 +1,40 @@
+# Gunicorn settings for the library API.
+#
+# WSGI (sync workers, one request per worker thread at a time):
+#     gunicorn -c gunicorn.conf.py
+# ASGI (uvicorn workers, slow clients are handled by the event loop):
+#     SERVER_MODE=asgi gunicorn -c gunicorn.conf.py
+#
+# Each uvicorn worker runs the ORM work of the async read views in a thread
+# pool, so size the database pool for WEB_WORKERS * (WEB_THREADS + 1)
+# connections.
+import multiprocessing
+import os
+
+mode = os.environ.get('SERVER_MODE', 'wsgi')
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = timeout
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+if mode == 'asgi':
+    wsgi_app = 'library.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    raw_env = ['LIBRARY_ASYNC_VIEWS=1']
+    # sync_to_async(thread_sensitive=False) uses the loop's default executor
+    os.environ.setdefault('ASGI_THREADS', str(threads))
+else:
+    wsgi_app = 'library.wsgi:application'
+    worker_class = 'gthread'
+
+
+def child_exit(server, worker):
+    # with PROMETHEUS_MULTIPROC_DIR set, drop the live gauges of the exited worker from /metrics
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -5,12 +5,19 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+
+Run it with gunicorn and uvicorn workers, see gunicorn.conf.py:
+    SERVER_MODE=asgi gunicorn -c gunicorn.conf.py
+
+The handler of libraryapp.asgi streams ?stream=1 lists and book texts,
+whose bodies run queries, from a thread rather than the event loop.
 """
 
 import os
 
-from django.core.asgi import get_asgi_application
+from libraryapp.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'library.settings')
+os.environ.setdefault('LIBRARY_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
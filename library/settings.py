@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 import os
 from datetime import timedelta
+from importlib.util import find_spec
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,6 +49,8 @@ GRAPH_MODELS = {
 }
 
 MIDDLEWARE = [
+    'libraryapp.instrumentation.InstrumentationMiddleware',
+    'libraryapp.overload.LoadSheddingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -78,27 +81,144 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'library.wsgi.application'
 
+# Serve the book, author and genre endpoints through async views; library/asgi.py turns this on
+ASYNC_READ_VIEWS = os.environ.get('LIBRARY_ASYNC_VIEWS') == '1'
+
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# Connections are kept open for DB_CONN_MAX_AGE seconds and checked with a
+# round trip before reuse when idle for DB_HEALTH_CHECK_SECONDS (libraryapp.db).
+# Behind pgbouncer in transaction pooling mode set DB_PGBOUNCER=1: server-side
+# cursors do not survive between transactions there.
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
-        'NAME': 'library',
-        'USER': 'library',
-        'PASSWORD': 'Kursach20',
-        'HOST': '127.0.0.1',
-        'PORT': '5432',
+        'ENGINE': os.environ.get('DB_ENGINE', 'django.db.backends.postgresql'),
+        'NAME': os.environ.get('DB_NAME', 'library'),
+        'USER': os.environ.get('DB_USER', 'library'),
+        'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+        'HOST': os.environ.get('DB_HOST', '127.0.0.1'),
+        'PORT': os.environ.get('DB_PORT', '5432'),
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 300)),
+        'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('DB_PGBOUNCER') == '1',
     }
 }
+if 'postgresql' in DATABASES['default']['ENGINE']:
+    DATABASES['default']['OPTIONS'] = {'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5))}
+
+DB_HEALTH_CHECK_SECONDS = int(os.environ.get('DB_HEALTH_CHECK_SECONDS', 30))
+
+# Read replicas for the catalogue views, see libraryapp/routers.py.
+# DB_REPLICAS is a comma-separated list of replica hosts, or of database
+# files with SQLite (copy the primary file to try it locally). A replica
+# further behind than MAX_LAG_SECONDS, or failing, is left out until the next
+# check; with none left the reads go to the primary. After a write the user
+# reads from the primary for STICKY_SECONDS; the window is kept in
+# CACHE_ALIAS, which every worker must see.
+
+READ_REPLICAS = {
+    'ALIASES': [],
+    'MAX_LAG_SECONDS': int(os.environ.get('DB_REPLICA_MAX_LAG', 5)),
+    'CHECK_INTERVAL': 5,
+    'STICKY_SECONDS': int(os.environ.get('DB_REPLICA_STICKY_SECONDS', 10)),
+    'CACHE_ALIAS': 'shared',
+}
+for number, location in enumerate(filter(None, os.environ.get('DB_REPLICAS', '').split(',')), 1):
+    replica = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    replica['NAME' if 'sqlite' in replica['ENGINE'] else 'HOST'] = location
+    DATABASES['replica_%d' % number] = replica
+    READ_REPLICAS['ALIASES'].append('replica_%d' % number)
+
+DATABASE_ROUTERS = ['libraryapp.routers.ReplicaRouter']
 
 
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
         'LOCATION': os.path.join(BASE_DIR, 'rest_cache'),
-    }
+    },
+    # seen by every web and task worker; a single process can use
+    # SHARED_CACHE_BACKEND=django.core.cache.backends.locmem.LocMemCache instead
+    'shared': {
+        'BACKEND': os.environ.get('SHARED_CACHE_BACKEND', 'django.core.cache.backends.memcached.PyMemcacheCache'),
+        'LOCATION': os.environ.get('SHARED_CACHE_LOCATION', '127.0.0.1:11211'),
+    },
+}
+if 'memcached' in CACHES['shared']['BACKEND']:
+    # an unreachable memcached turns into cache misses rather than failed requests
+    CACHES['shared']['OPTIONS'] = {'ignore_exc': True, 'connect_timeout': 1, 'timeout': 1}
+
+
+# Cache of serialized books, authors and genres, see libraryapp/cache.py.
+# It is the 'shared' cache, so a change invalidates the entries of every
+# worker; libraryapp.cache.LRUCache keeps a copy per process and is only
+# right for a single one.
+
+RESPONSE_CACHE = {
+    'BACKEND': 'libraryapp.cache.DjangoCache',
+    'TIMEOUT': 300,
+    'OPTIONS': {'alias': 'shared'},
+}
+
+
+# Loan period of checkouts, see libraryapp/loans.py
+
+LOANS = {
+    'DAYS': 14,
+}
+
+
+# Background tasks, see libraryapp/tasks.py: queued in the database and run
+# by manage.py runworker. With TASKS_BACKEND=immediate they run in the request
+# instead, which needs no worker.
+
+TASKS = {
+    'BACKEND': os.environ.get('TASKS_BACKEND', 'database'),
+    'PROCESSES': int(os.environ.get('TASKS_PROCESSES', 2)),
+    'LEASE_SECONDS': 300,
+    'MAX_ATTEMPTS': 5,
+    'BACKOFF_SECONDS': 10,
+    'KEEP_FINISHED_SECONDS': 7 * 24 * 3600,
+}
+
+
+# Precompressed copies of BookInstance.text served by /content ('gzip', 'br');
+# 'br' needs the brotli package
+
+BOOK_CONTENT_ENCODINGS = ('gzip',)
+
+
+# PostgreSQL text search configuration used by /api/books/search
+
+SEARCH_CONFIG = 'russian'
+
+
+# Password hashing: argon2 when argon2-cffi is installed; the other hashers
+# only verify older hashes, which are upgraded on the next login
+
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+try:
+    import argon2  # noqa: F401
+    PASSWORD_HASHERS.insert(0, PASSWORD_HASHERS.pop(2))
+except ImportError:
+    pass
+
+AUTHENTICATION_BACKENDS = ['libraryapp.passwords.PooledModelBackend']
+
+# Hashing runs in a pool of WORKERS threads with at most QUEUE waiting;
+# past that, login and registration answer 503 after QUEUE_TIMEOUT seconds
+
+PASSWORD_HASHING = {
+    'WORKERS': int(os.environ.get('PASSWORD_HASHING_WORKERS', 2)),
+    'QUEUE': 32,
+    'QUEUE_TIMEOUT': 2,
 }
 
 
@@ -122,15 +242,73 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'libraryapp.authentication.ClaimsJWTAuthentication',
     ),
+    'DEFAULT_PAGINATION_CLASS': 'libraryapp.pagination.IdCursorPagination',
+    # orjson when installed; MessagePack for Accept: application/msgpack, see libraryapp/renderers.py
+    'DEFAULT_RENDERER_CLASSES': [
+        'libraryapp.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ] + (['libraryapp.renderers.MessagePackRenderer'] if find_spec('msgpack') else []),
+    # sliding-window limits per user or address, per address and per view scope, see libraryapp/throttling.py;
+    # the rates hold for the whole deployment only while the counters are shared (THROTTLING below), with
+    # counters in process memory, or a LocMemCache as 'shared', each worker allows the full rate
+    'DEFAULT_THROTTLE_CLASSES': [
+        'libraryapp.throttling.ClientThrottle',
+        'libraryapp.throttling.AddressThrottle',
+        'libraryapp.throttling.ScopedThrottle',
+    ],
+    'DEFAULT_THROTTLE_RATES': {
+        'anon': '300/min',
+        'user': '1200/min',
+        'address': '3000/min',
+        'login': '10/min',
+        'register': '20/hour',
+        'search': '120/min',
+        'stream': '10/min',
+    },
+    # proxies in front of the app; client addresses are read from X-Forwarded-For behind them
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
+}
+
+# Counters of the throttles: the 'shared' cache, so with memcached all workers
+# count together; THROTTLE_CACHE_ALIAS='' keeps them in process memory, which
+# multiplies every rate by the number of workers.
+
+THROTTLING = {
+    'CACHE_ALIAS': os.environ.get('THROTTLE_CACHE_ALIAS', 'shared') or None,
+}
+
+# Load shedding, see libraryapp/overload.py: while a process serves more than
+# MAX_IN_FLIGHT requests, its responses average more than MAX_LATENCY_SECONDS,
+# or requests waited in the proxy queue (X-Request-Start) longer than
+# MAX_QUEUE_SECONDS, the LOW_PRIORITY requests and anonymous reads get a 503.
+# UNTIMED requests are long by design and stay out of the latency average.
+
+OVERLOAD = {
+    'MAX_IN_FLIGHT': int(os.environ.get('OVERLOAD_MAX_IN_FLIGHT', 64)),
+    'MAX_LATENCY_SECONDS': float(os.environ.get('OVERLOAD_MAX_LATENCY', 2.0)),
+    'MAX_QUEUE_SECONDS': float(os.environ.get('OVERLOAD_MAX_QUEUE', 1.0)),
+    'LATENCY_DECAY_SECONDS': 10,
+    'RETRY_AFTER': 5,
+    'LOW_PRIORITY': [
+        r'^/api/books/(search|bulk)',
+        r'[?&](stream|facets)=',
+        r'^/auth/register',
+    ],
+    'UNTIMED': [
+        r'^/api/books/bulk',
+        r'^/api/bookinstances/[^/?]+/content',
+        r'[?&]stream=',
+    ],
+    'SHED_ANONYMOUS_READS': True,
 }
 
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=30),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=2),
-    'ROTATE_REFRESH_TOKENS': False,
-    'BlACKLIST_AFTER_ROTATION': True,
+    'ROTATE_REFRESH_TOKENS': True,
+    'BLACKLIST_AFTER_ROTATION': True,
 
     'ALGORITHM': 'HS256',
     'SIGNING_KEY': SECRET_KEY,
@@ -152,6 +330,40 @@ SIMPLE_JWT = {
 }
 
 
+# Request instrumentation: Server-Timing headers, slow-request logs and the
+# Prometheus metrics served at /metrics to the listed addresses
+
+INSTRUMENTATION = {
+    'SLOW_REQUEST_SECONDS': float(os.environ.get('SLOW_REQUEST_SECONDS', 0.5)),
+    'SERVER_TIMING': True,
+    'METRICS_ALLOWED_IPS': tuple(os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1').split(',')),
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'libraryapp.requests': {'handlers': ['console'], 'level': 'WARNING', 'propagate': False},
+        'libraryapp.tasks': {'handlers': ['console'], 'level': 'WARNING', 'propagate': False},
+    },
+}
+
+
+# Caches used by libraryapp.authentication: full users for the profile views
+# and, for REVOCATION_TIMEOUT seconds, the per-user token revocation
+# timestamps kept in the database; ALIAS holds the refresh token blacklist
+
+AUTH_CACHE = {
+    'ALIAS': 'shared',
+    'USER_TIMEOUT': 30,
+    'REVOCATION_TIMEOUT': 5,
+    'MAX_USERS': 10000,
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.1/topics/i18n/
 
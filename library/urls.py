@@ -16,8 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from libraryapp.instrumentation import metrics_view
+
 urlpatterns = [
     #path('admin/', admin.site.urls),
-    #path('auth/', include('libraryapp.auth_urls')),
-    #path('api/', include('libraryapp.urls'))
+    path('metrics', metrics_view),
+    path('auth/', include('libraryapp.auth_urls')),
+    path('api/', include('libraryapp.urls'))
 ]
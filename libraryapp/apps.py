@@ -3,3 +3,17 @@ from django.apps import AppConfig
 
 class LibraryappConfig(AppConfig):
     name = 'libraryapp'
+
+    def ready(self):
+        from django.core.signals import request_finished, request_started
+        from django.db.backends.signals import connection_created
+
+        from . import signals
+        from .db import check_connections, count_connection, mark_connections_used
+        from .instrumentation import install_query_wrapper
+        from .routers import install_failover_wrapper
+        connection_created.connect(install_query_wrapper)
+        connection_created.connect(install_failover_wrapper)
+        connection_created.connect(count_connection)
+        request_started.connect(check_connections)
+        request_finished.connect(mark_connections_used)
@@ -0,0 +1,51 @@
+"""ASGI handler that reads streaming response bodies outside the event loop.
+
+Django 3.2's ASGIHandler iterates streaming_content on the event loop, but
+the streamed lists and book texts run their queries inside those
+iterators, which the ORM refuses to do there. Here every chunk is produced
+in the thread that runs sync views, in one context for the whole body, so
+the replica chosen for the request stays in place.
+"""
+import contextvars
+
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+
+# marks the end of the body, next() cannot raise StopIteration across sync_to_async
+_END = object()
+
+
+def next_chunk(context, iterator):
+    return context.run(next, iterator, _END)
+
+
+class StreamingASGIHandler(ASGIHandler):
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        context = contextvars.copy_context()
+        iterator = iter(response)
+        read = sync_to_async(next_chunk, thread_sensitive=True)
+        while True:
+            part = await read(context, iterator)
+            if part is _END:
+                break
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
+
+
+def get_asgi_application():
+    django.setup(set_prefix=False)
+    return StreamingASGIHandler()
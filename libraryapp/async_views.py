@@ -0,0 +1,37 @@
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from rest_framework.permissions import SAFE_METHODS
+
+
+def async_read_view(view_class, **initkwargs):
+    """Async entry point for a DRF view when served over ASGI.
+
+    Django 3.2 has no async ORM, so the DRF view still runs synchronously,
+    but safe requests run in the shared thread pool rather than in the
+    per-request thread Django gives sync views. The event loop keeps
+    serving other connections while a slow client is being read from or
+    written to. Writes stay thread-sensitive so transactions keep their
+    connection.
+    """
+    view = view_class.as_view(**initkwargs)
+
+    def pooled_view(request, *args, **kwargs):
+        # pool threads never see request_finished, so release their connections here
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            close_old_connections()
+
+    read = sync_to_async(pooled_view, thread_sensitive=False)
+    write = sync_to_async(view, thread_sensitive=True)
+
+    async def async_view(request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            return await read(request, *args, **kwargs)
+        return await write(request, *args, **kwargs)
+
+    # DRF does its own CSRF checks; csrf_exempt() would wrap the coroutine in a sync function on Django 3.2
+    async_view.csrf_exempt = True
+    async_view.view_class = view_class
+    async_view.view_initkwargs = initkwargs
+    return async_view
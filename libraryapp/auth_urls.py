@@ -1,11 +1,17 @@
 from django.urls import path
+from rest_framework.settings import api_settings
 from rest_framework_simplejwt import views
 
-from libraryapp.views import UserRegisterView
+from libraryapp.serializers import BlacklistTokenVerifySerializer, ClaimsTokenObtainPairSerializer, \
+    RotatingTokenRefreshSerializer
+from libraryapp.throttling import LoginThrottle
+from libraryapp.views import LogoutView, UserRegisterView
 
 urlpatterns = [
     path('register', UserRegisterView.as_view(), name="register"),
-    path('login', views.TokenObtainPairView.as_view(), name="jwt-create"),
-    path('refresh', views.TokenRefreshView.as_view(), name="jwt-refresh"),
-    path('verify', views.TokenVerifyView.as_view(), name="jwt-verify"),
+    path('login', views.TokenObtainPairView.as_view(
+        serializer_class=ClaimsTokenObtainPairSerializer, throttle_classes=api_settings.DEFAULT_THROTTLE_CLASSES + [LoginThrottle]), name="jwt-create"),
+    path('refresh', views.TokenRefreshView.as_view(serializer_class=RotatingTokenRefreshSerializer), name="jwt-refresh"),
+    path('verify', views.TokenVerifyView.as_view(serializer_class=BlacklistTokenVerifySerializer), name="jwt-verify"),
+    path('logout', LogoutView.as_view(), name="jwt-logout"),
 ]
\ No newline at end of file
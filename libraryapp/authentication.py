@@ -0,0 +1,119 @@
+import copy
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from .cache import LRUCache
+from .models import TokenRevocation
+
+AUTH_CACHE = getattr(settings, 'AUTH_CACHE', {})
+# full User rows for the views that need them, per process
+_users = LRUCache(timeout=AUTH_CACHE.get('USER_TIMEOUT', 30), max_entries=AUTH_CACHE.get('MAX_USERS', 10000))
+# per-process memo of the revocation timestamps in the database, so most requests do not query them
+_revocations = LRUCache(timeout=AUTH_CACHE.get('REVOCATION_TIMEOUT', 5), max_entries=AUTH_CACHE.get('MAX_USERS', 10000))
+NOT_REVOKED = 0
+
+
+def issued_at(current_time):
+    """The iat claim of a token, with sub-second precision so it can be told apart from a revocation in the same second."""
+    return current_time.timestamp()
+
+
+def revoke_user_tokens(user_id):
+    """Rejects every token of the user issued before now; every worker sees it within REVOCATION_TIMEOUT seconds."""
+    now = time.time()
+    if not TokenRevocation.objects.filter(pk=user_id).update(revoked_before=now):
+        try:
+            with transaction.atomic():
+                TokenRevocation.objects.create(user_id=user_id, revoked_before=now)
+        except IntegrityError:
+            TokenRevocation.objects.filter(pk=user_id).update(revoked_before=now)
+    _revocations.set(user_id, now)
+    _users.delete_many([user_id])
+
+
+def purge_revocations():
+    """Deletes revocations older than the refresh token lifetime; every token they rejected has expired."""
+    oldest = int(time.time() - api_settings.REFRESH_TOKEN_LIFETIME.total_seconds())
+    return TokenRevocation.objects.filter(revoked_before__lt=oldest).delete()[0]
+
+
+def forget_user(user_id):
+    _users.delete_many([user_id])
+
+
+def check_revocation(validated_token):
+    user_id = validated_token[api_settings.USER_ID_CLAIM]
+    revoked_before = _revocations.get(user_id)
+    if revoked_before is None:
+        revoked_before = TokenRevocation.objects.filter(pk=user_id).values_list('revoked_before', flat=True).first()
+        revoked_before = revoked_before or NOT_REVOKED
+        _revocations.set(user_id, revoked_before)
+    # tokens issued before iat had a fraction were cut to the second, and are rejected for the whole second
+    if revoked_before and validated_token.get('iat', 0) < revoked_before:
+        raise InvalidToken(_('Token has been revoked'))
+
+
+class ClaimsUser(TokenUser):
+    """User built from the signed token claims, without a database row."""
+
+    @cached_property
+    def is_reader(self):
+        return self.token.get('is_reader', False)
+
+    @cached_property
+    def profile_id(self):
+        return self.token.get('profile_id')
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """Authenticates from token claims alone; tokens issued before the claims existed fall back to the database."""
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        check_revocation(validated_token)
+        if 'is_staff' not in validated_token:
+            return CachedUserJWTAuthentication().get_user(validated_token)
+        return ClaimsUser(validated_token)
+
+
+class UserJWTAuthentication(JWTAuthentication):
+    """Loads the full User with its profile from the database on every request."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        check_revocation(validated_token)
+        user = self.load_user(user_id)
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
+
+    def load_user(self, user_id):
+        try:
+            return User.objects.select_related('profile').get(**{api_settings.USER_ID_FIELD: user_id})
+        except User.DoesNotExist:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+
+
+class CachedUserJWTAuthentication(UserJWTAuthentication):
+    """Keeps the full User for a short time in process memory, so other workers may see it stale until USER_TIMEOUT."""
+
+    def load_user(self, user_id):
+        user = _users.get(user_id)
+        if user is None:
+            user = super().load_user(user_id)
+            _users.set(user_id, user)
+        # callers may change the user, so they must not share the cached instance
+        return copy.deepcopy(user)
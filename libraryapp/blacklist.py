@@ -0,0 +1,73 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from .models import RevokedToken
+
+PURGE_BATCH_SIZE = 1000
+
+
+def blacklist_cache():
+    return caches[getattr(settings, 'AUTH_CACHE', {}).get('ALIAS', 'shared')]
+
+
+def jti_hash(jti):
+    return hashlib.blake2b(jti.encode(), digest_size=16).hexdigest()
+
+
+def cache_key(digest):
+    return 'auth:blacklist:%s' % digest
+
+
+def remaining_seconds(token):
+    return max(int(token['exp'] - timezone.now().timestamp()), 1)
+
+
+def is_blacklisted(token):
+    """Looks the token up in the shared cache; the table is only read for tokens the cache does not know.
+
+    Both answers are kept until the token expires. A miss is stored with
+    add(), so it never replaces the entry blacklist() wrote meanwhile.
+    """
+    digest = jti_hash(token[api_settings.JTI_CLAIM])
+    cached = blacklist_cache().get(cache_key(digest))
+    if cached is not None:
+        return cached
+    if RevokedToken.objects.filter(pk=digest).exists():
+        blacklist_cache().set(cache_key(digest), True, remaining_seconds(token))
+        return True
+    blacklist_cache().add(cache_key(digest), False, remaining_seconds(token))
+    return False
+
+
+def blacklist(token):
+    """Records the token as used up; returns False if it already was, so only one concurrent rotation wins."""
+    digest = jti_hash(token[api_settings.JTI_CLAIM])
+    try:
+        with transaction.atomic():
+            RevokedToken.objects.create(jti_hash=digest, expires_at=datetime_from_epoch(token['exp']))
+    except IntegrityError:
+        created = False
+    else:
+        created = True
+    # replaces a cached miss
+    blacklist_cache().set(cache_key(digest), True, remaining_seconds(token))
+    return created
+
+
+def purge_expired(batch_size=PURGE_BATCH_SIZE, max_batches=None):
+    """Deletes expired entries a batch at a time, so no single statement locks much of the table."""
+    now = timezone.now()
+    purged = batches = 0
+    while max_batches is None or batches < max_batches:
+        digests = list(RevokedToken.objects.filter(expires_at__lt=now).values_list('pk', flat=True)[:batch_size])
+        if not digests:
+            break
+        purged += RevokedToken.objects.filter(pk__in=digests).delete()[0]
+        batches += 1
+    return purged
@@ -0,0 +1,243 @@
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Author, Book, BookInstance, Genre
+from .cache import invalidate
+from .filters import LISTED_FIELDS
+from .listing import schedule_refresh
+from .loans import LEND_BY_CHECKOUT, LENT_OUT, shelve
+from .search import schedule_reindex
+from .serializers import BookWriteSerializer
+from .tasks import task
+
+# below SQLite's default limit of 999 parameters per query
+BATCH_SIZE = 900
+
+
+def batched(queryset, lookup, values):
+    values = list(values)
+    for start in range(0, len(values), BATCH_SIZE):
+        yield from queryset.filter(**{lookup: values[start:start + BATCH_SIZE]})
+
+
+def batched_pairs(queryset, fields, pairs):
+    """Rows matching one of the value pairs on the two fields, with as many parameters per query as batched()."""
+    pairs = list(pairs)
+    size = BATCH_SIZE // 2
+    for start in range(0, len(pairs), size):
+        condition = reduce(or_, (Q(**dict(zip(fields, pair))) for pair in pairs[start:start + size]))
+        yield from queryset.filter(condition)
+
+
+def sync_relations(through, column, desired, existing_books=()):
+    """Brings the through rows of the given books to the desired related ids.
+
+    Only the missing rows are inserted and only the stale rows are deleted;
+    rows that are already in place are left untouched. Returns the ids of
+    the books whose relations changed.
+    """
+    current, stale, changed = set(), [], set()
+    rows = through.objects.values_list('id', 'book_id', column)
+    for pk, book_id, related_id in batched(rows, 'book_id__in', [pk for pk in existing_books if pk in desired]):
+        if related_id in desired[book_id]:
+            current.add((book_id, related_id))
+        else:
+            stale.append(pk)
+            changed.add(book_id)
+    for start in range(0, len(stale), BATCH_SIZE):
+        through.objects.filter(id__in=stale[start:start + BATCH_SIZE]).delete()
+    missing = [through(book_id=book_id, **{column: related_id})
+               for book_id, related_ids in desired.items() for related_id in related_ids
+               if (book_id, related_id) not in current]
+    through.objects.bulk_create(missing, batch_size=BATCH_SIZE)
+    changed.update(row.book_id for row in missing)
+    return changed
+
+
+def is_changed(book, field, value):
+    if field == 'id_inst':
+        return book.id_inst_id != value.pk
+    return getattr(book, field) != value
+
+
+class BookBulkLoader:
+    """Creates or updates many books with a fixed number of set-based queries.
+
+    Items have the BooksView.create payload shape; an item with an "id" updates
+    that book, and with partial=True only the fields it contains are changed.
+    Invalid items are reported in errors and skipped, the rest are written in
+    one transaction.
+    """
+
+    def __init__(self, items, partial=False):
+        self.items = items
+        self.partial = partial
+        self.errors = []
+        self.created = []
+        self.updated = []
+
+    def load(self):
+        valid = self.validate()
+        instances, authors, genres, books = self.resolve(valid)
+        rows = []
+        for index, data in valid:
+            errors = {}
+            values = {field: data[field] for field in ('title', 'isbn', 'status') if field in data}
+            if data.get('id_inst'):
+                instance = instances.get(data['id_inst']['id_security'])
+                if instance is None:
+                    errors['id_inst'] = ['Book instance %s does not exist.' % data['id_inst']['id_security']]
+                else:
+                    values['id_inst'] = instance
+            book = Book()
+            if 'id' in data:
+                book = books.get(data['id'])
+                if book is None:
+                    errors['id'] = ['Book %s does not exist.' % data['id']]
+            if book is not None and values.get('status', book.status) != book.status:
+                if book.status == 'e':
+                    errors['status'] = [LENT_OUT]
+                elif values['status'] == 'e':
+                    errors['status'] = [LEND_BY_CHECKOUT]
+            author_ids = genre_ids = None
+            if 'authors' in data or book is not None and book.pk is None:
+                author_ids = self.match(data.get('authors', []), authors,
+                                        lambda a: (a['first_name'], a['last_name']), errors, 'authors')
+            if 'genre' in data or book is not None and book.pk is None:
+                genre_ids = self.match(data.get('genre', []), genres, lambda g: g['name'], errors, 'genre')
+            if errors:
+                self.errors.append({'index': index, 'errors': errors})
+                continue
+            changed = [field for field, value in values.items() if book.pk is None or is_changed(book, field, value)]
+            for field in changed:
+                setattr(book, field, values[field])
+            rows.append((index, book, changed, author_ids, genre_ids))
+        self.check_instances(rows)
+        self.write(rows)
+        return self
+
+    def validate(self):
+        valid = []
+        for index, item in enumerate(self.items):
+            serializer = BookWriteSerializer(data=item, partial=self.partial and isinstance(item, dict) and 'id' in item)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                self.errors.append({'index': index, 'errors': serializer.errors})
+        return valid
+
+    def resolve(self, valid):
+        securities = {data['id_inst']['id_security'] for _, data in valid if data.get('id_inst')}
+        full_names, names, ids = set(), set(), set()
+        for _, data in valid:
+            full_names.update((author['first_name'], author['last_name']) for author in data.get('authors', []))
+            names.update(genre['name'] for genre in data.get('genre', []))
+            if 'id' in data:
+                ids.add(data['id'])
+        instances = {}
+        for instance in batched(BookInstance.objects.only('id', 'id_security'), 'id_security__in', securities):
+            instances[instance.id_security] = instance
+        # with duplicate names the lowest id wins, as it is the last one seen
+        authors = {}
+        queryset = Author.objects.order_by('-id').only('id', 'first_name', 'last_name')
+        for author in batched_pairs(queryset, ('first_name', 'last_name'), full_names):
+            authors[author.first_name, author.last_name] = author.id
+        genres = {}
+        for genre in batched(Genre.objects.order_by('-id').only('id', 'name'), 'name__in', names):
+            genres[genre.name] = genre.id
+        books = {book.id: book for book in batched(Book.objects.all(), 'id__in', ids)}
+        return instances, authors, genres, books
+
+    def match(self, refs, known, key, errors, field):
+        ids = []
+        for ref in refs:
+            pk = known.get(key(ref))
+            if pk is None:
+                errors.setdefault(field, []).append('%s does not exist.' % ' '.join(ref.values()))
+            elif pk not in ids:
+                ids.append(pk)
+        return ids
+
+    def check_instances(self, rows):
+        """Drops rows whose book instance is already attached to another book."""
+        claimed = {}
+        instance_ids = [book.id_inst_id for _, book, changed, _, _ in rows if 'id_inst' in changed and book.id_inst_id]
+        for pk, instance_id in batched(Book.objects.values_list('id', 'id_inst_id'), 'id_inst__in', instance_ids):
+            claimed[instance_id] = pk
+        kept = []
+        for row in rows:
+            index, book, changed, _, _ = row
+            if 'id_inst' in changed and book.id_inst_id:
+                owner = claimed.get(book.id_inst_id)
+                if owner is not None and owner != book.pk:
+                    self.errors.append({'index': index, 'errors': {'id_inst': ['Book instance is already used by book %s.' % owner]}})
+                    continue
+                claimed[book.id_inst_id] = book.pk or ('new', index)
+            kept.append(row)
+        rows[:] = kept
+
+    def shelve(self, rows):
+        """Writes the status changes first, conditionally, and drops the rows of books a checkout has lent out since."""
+        shelved = defaultdict(set)
+        for _, book, fields, _, _ in rows:
+            if book.pk is not None and 'status' in fields:
+                shelved[book.status].add(book.pk)
+        lent = set()
+        for status, book_ids in shelved.items():
+            book_ids = sorted(book_ids)
+            for start in range(0, len(book_ids), BATCH_SIZE):
+                lent |= shelve(book_ids[start:start + BATCH_SIZE], status)
+        kept = []
+        for row in rows:
+            if row[1].pk in lent:
+                self.errors.append({'index': row[0], 'errors': {'status': [LENT_OUT]}})
+            else:
+                kept.append(row)
+        rows[:] = kept
+
+    @transaction.atomic
+    def write(self, rows):
+        self.shelve(rows)
+        new = [book for _, book, _, _, _ in rows if book.pk is None]
+        existing = [book.pk for _, book, _, _, _ in rows if book.pk is not None]
+        now = timezone.now()
+        changed = defaultdict(list)
+        for _, book, fields, _, _ in rows:
+            if book.pk is not None and fields:
+                book.updated_at = now
+                changed[tuple(fields) + ('updated_at',)].append(book)
+        if connection.features.can_return_rows_from_bulk_insert:
+            Book.objects.bulk_create(new, batch_size=BATCH_SIZE)
+        else:
+            for book in new:
+                book.save()
+        for fields, books in changed.items():
+            # the status was written by shelve()
+            Book.objects.bulk_update(books, [field for field in fields if field != 'status'], batch_size=BATCH_SIZE)
+        relinked = sync_relations(Book.authors.through, 'author_id',
+                                  {book.pk: set(ids) for _, book, _, ids, _ in rows if ids is not None}, existing)
+        relinked |= sync_relations(Book.genre.through, 'genre_id',
+                                   {book.pk: set(ids) for _, book, _, _, ids in rows if ids is not None}, existing)
+        # new books, new authors or genres and new filtered or ordered values, updated_at among them, move books
+        moved = bool(new or relinked or any(LISTED_FIELDS.intersection(fields) for fields in changed))
+        touched = {book.pk for books in changed.values() for book in books}
+        relinked = sorted(relinked.intersection(existing) - touched)
+        for start in range(0, len(relinked), BATCH_SIZE):
+            Book.objects.filter(pk__in=relinked[start:start + BATCH_SIZE]).update(updated_at=now)
+        self.created = [book.pk for book in new]
+        self.updated = existing
+        schedule_reindex(self.created + self.updated)
+        schedule_refresh(self.created + self.updated)
+        invalidate(Book, self.updated, membership=moved)
+
+
+@task(max_attempts=3)
+def load_books(items, partial=False):
+    """BookBulkLoader in the background; a failed attempt rolled back, so it is safe to run again."""
+    loader = BookBulkLoader(items, partial).load()
+    return {'created': loader.created, 'updated': loader.updated, 'errors': loader.errors}
@@ -0,0 +1,183 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import ListVersion
+from .routers import CHECK_INTERVAL, MAX_LAG_SECONDS, REPLICAS
+
+DEFAULT_TIMEOUT = 300
+
+
+class LRUCache:
+    """In-process cache with least-recently-used eviction; each worker process has its own copy."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_entries=10000):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+            if item[1] < time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return item[0]
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.timeout)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_entries:
+                self.data.popitem(last=False)
+
+    def set_many(self, mapping):
+        for key, value in mapping.items():
+            self.set(key, value)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class DjangoCache:
+    """Adapter for a CACHES alias, e.g. memcached shared by all workers."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, alias='shared'):
+        self.timeout = timeout
+        self.cache = caches[alias]
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def set_many(self, mapping):
+        self.cache.set_many(mapping, self.timeout)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+    def clear(self):
+        self.cache.clear()
+
+
+_cache = None
+
+
+def get_response_cache():
+    global _cache
+    if _cache is None:
+        config = getattr(settings, 'RESPONSE_CACHE', {})
+        backend = import_string(config.get('BACKEND', 'libraryapp.cache.DjangoCache'))
+        _cache = backend(timeout=config.get('TIMEOUT', DEFAULT_TIMEOUT), **config.get('OPTIONS', {}))
+    return _cache
+
+
+def is_shared():
+    """Whether the other worker processes see what this one caches."""
+    return isinstance(get_response_cache(), DjangoCache)
+
+
+def object_key(model, pk):
+    return 'repr:%s:%s' % (model._meta.label_lower, pk)
+
+
+def list_state(model, request=None):
+    """Version of the model's lists and the time it last moved, from the database; read once per request.
+
+    Every worker sees the same values, and they survive cache evictions and restarts.
+    """
+    states = request.__dict__.setdefault('list_states', {}) if request is not None else {}
+    label = model._meta.label_lower
+    if label not in states:
+        row = ListVersion.objects.filter(pk=label).values_list('version', 'changed_at').first()
+        states[label] = (row[0], row[1].timestamp()) if row is not None else (0, 0.0)
+    return states[label]
+
+
+_pending = threading.local()
+
+
+def expire_lists(model):
+    """Moves the version of the model's lists once the current transaction commits, which expires every cached page."""
+    if getattr(_pending, 'labels', None) is None:
+        _pending.labels = set()
+    _pending.labels.add(model._meta.label_lower)
+    transaction.on_commit(flush_list_versions)
+
+
+def flush_list_versions():
+    labels, _pending.labels = _pending.labels, set()
+    now = timezone.now()
+    for label in sorted(labels):
+        if ListVersion.objects.filter(pk=label).update(version=F('version') + 1, changed_at=now):
+            continue
+        try:
+            with transaction.atomic():
+                ListVersion.objects.create(table=label, version=1, changed_at=now)
+        except IntegrityError:
+            ListVersion.objects.filter(pk=label).update(version=F('version') + 1, changed_at=now)
+
+
+def url_digest(request):
+    # memcached keys are limited to 250 characters
+    return hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+
+
+def list_key(model, request):
+    return 'list:%s:%s:%s' % (model._meta.label_lower, list_state(model, request)[0], url_digest(request))
+
+
+def invalidate(model, pks=(), membership=False):
+    """Drops the cached representations of the given objects.
+
+    Keys are dropped right away and again after the transaction commits, in
+    case another request cached the old rows in between. With read replicas
+    they are dropped a third time once a replica that is still in use can no
+    longer return the old rows. membership=True also expires every cached
+    list page of the model.
+    """
+    keys = [object_key(model, pk) for pk in pks]
+    if membership:
+        expire_lists(model)
+    if keys:
+        get_response_cache().delete_many(keys)
+        transaction.on_commit(lambda: get_response_cache().delete_many(keys))
+        if REPLICAS:
+            transaction.on_commit(lambda: delete_later(keys, MAX_LAG_SECONDS + CHECK_INTERVAL))
+
+
+def delete_later(keys, delay):
+    timer = threading.Timer(delay, get_response_cache().delete_many, [keys])
+    timer.daemon = True
+    timer.start()
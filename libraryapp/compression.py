@@ -0,0 +1,25 @@
+"""Precompressed copies of BookInstance.text, made in the background after the text is saved.
+
+BookInstance.save() drops the old copies; until the task has run, /content
+serves the text uncompressed.
+"""
+from django.db import transaction
+
+from .content import compress_text, content_encodings
+from .models import BookInstance
+from .tasks import task
+
+
+@task(max_attempts=3)
+def compress_instance_text(instance_id):
+    row = BookInstance.objects.filter(pk=instance_id).values_list('text', 'updated_at').first()
+    if row is None:
+        return
+    text, updated_at = row
+    # a text saved meanwhile has a task of its own, which writes its copies
+    BookInstance.objects.filter(pk=instance_id, updated_at=updated_at).update(**compress_text(text))
+
+
+def schedule_compression(instance_id):
+    if content_encodings():
+        transaction.on_commit(lambda: compress_instance_text.delay(instance_id))
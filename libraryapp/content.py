@@ -0,0 +1,122 @@
+import gzip
+import re
+
+from django.conf import settings
+from django.db.models import Func, IntegerField
+from django.db.models.functions import Substr
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CHUNK_CHARS = 64 * 1024
+# the widest UTF-8 character, used to turn byte offsets into a lower bound in characters
+MAX_CHAR_BYTES = 4
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class OctetLength(Func):
+    function = 'OCTET_LENGTH'
+    output_field = IntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='LENGTH(CAST(%(expressions)s AS BLOB))', **extra_context)
+
+
+def content_encodings():
+    """Encodings to store precompressed copies in, from BOOK_CONTENT_ENCODINGS."""
+    encodings = getattr(settings, 'BOOK_CONTENT_ENCODINGS', ())
+    return [encoding for encoding in encodings if encoding != 'br' or brotli is not None]
+
+
+def accepted_encodings(header, encodings):
+    """The given encodings that an Accept-Encoding header accepts, best quality first, keeping the given order on ties."""
+    qualities = {}
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    ranked = [(qualities.get(encoding, qualities.get('*', 0.0)), encoding) for encoding in encodings]
+    return [encoding for quality, encoding in sorted(ranked, key=lambda item: -item[0]) if quality > 0]
+
+
+def compress_text(text):
+    data = text.encode('utf-8')
+    compressed = {'text_gzip': None, 'text_br': None}
+    encodings = content_encodings()
+    if 'gzip' in encodings:
+        compressed['text_gzip'] = gzip.compress(data, compresslevel=9, mtime=0)
+    if 'br' in encodings:
+        compressed['text_br'] = brotli.compress(data, quality=11, mode=brotli.MODE_TEXT)
+    return compressed
+
+
+def parse_range(header, size):
+    """Returns (start, end) of a single byte range, end exclusive; None if unsatisfiable."""
+    match = RANGE_RE.match(header.strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        start, end = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    if start >= end:
+        return None
+    return start, end
+
+
+class TextReader:
+    """Reads BookInstance.text in slices computed by the database, so the whole text is never loaded."""
+
+    def __init__(self, queryset, length):
+        self.queryset = queryset
+        self.length = length
+
+    def slice(self, start, count):
+        if count <= 0 or start >= self.length:
+            return ''
+        return self.queryset.annotate(piece=Substr('text', start + 1, count)).values_list('piece', flat=True).get()
+
+    def byte_offset(self, chars):
+        if chars <= 0:
+            return 0
+        return self.queryset.annotate(size=OctetLength(Substr('text', 1, chars))).values_list('size', flat=True).get()
+
+    def char_offset(self, target):
+        """Finds a character offset whose byte offset is at most target and close to it."""
+        chars = bytes_before = 0
+        while target - bytes_before >= MAX_CHAR_BYTES * CHUNK_CHARS:
+            chars += (target - bytes_before) // MAX_CHAR_BYTES
+            bytes_before = self.byte_offset(chars)
+        return chars, bytes_before
+
+    def chars(self, start=0, end=None):
+        end = self.length if end is None else min(end, self.length)
+        while start < end:
+            count = min(CHUNK_CHARS, end - start)
+            yield self.slice(start, count)
+            start += count
+
+    def bytes(self, start, end):
+        """Yields the UTF-8 encoded bytes [start, end) of the text."""
+        chars, position = self.char_offset(start)
+        for piece in self.chars(chars):
+            data = piece.encode('utf-8')
+            if position + len(data) > start:
+                yield data[max(start - position, 0):end - position]
+            position += len(data)
+            if position >= end:
+                break
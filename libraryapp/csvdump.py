@@ -0,0 +1,256 @@
+"""Reading and writing the semicolon-separated table dumps in "to Postgres/".
+
+Each file is named after its table and starts with a header of column
+names. Strings are double-quoted, numbers and 0/1 booleans are not,
+datetimes are naive UTC and UUIDs have no dashes. Line breaks inside texts
+are written as backslash escapes (\\r\\n), so every row is one line.
+"""
+import csv
+import datetime
+import os
+import re
+import sys
+import uuid
+
+from django.apps import apps
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.utils import timezone
+
+from .models import BookInstance
+
+DELIMITER = ';'
+BATCH_SIZE = 2000
+# file names that differ from the table name
+TABLE_ALIASES = {
+    'libraryapp_bookinstances': 'libraryapp_bookinstance',
+}
+# columns computed from other columns on import, so they are not exported
+DERIVED_FIELDS = {
+    BookInstance: ('text_length', 'text_size', 'text_gzip', 'text_br'),
+}
+ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+ESCAPE_RE = re.compile(r'\\(.)', re.S)
+UNESCAPED_RE = re.compile(r'[\\\r\n\t\0\x1a\b]')
+REVERSE_ESCAPES = {value: '\\' + key for key, value in ESCAPES.items()}
+REVERSE_ESCAPES['\\'] = '\\\\'
+COPY_ESCAPES = {'\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t'}
+COPY_UNESCAPED_RE = re.compile(r'[\\\n\r\t]')
+
+csv.field_size_limit(sys.maxsize)
+
+
+def unescape(value):
+    return ESCAPE_RE.sub(lambda match: ESCAPES.get(match.group(1), match.group(1)), value)
+
+
+def escape(value):
+    return UNESCAPED_RE.sub(lambda match: REVERSE_ESCAPES[match.group(0)], value)
+
+
+def table_models():
+    """Every model, including the many-to-many through tables, by table name."""
+    return {model._meta.db_table: model for model in apps.get_models(include_auto_created=True)}
+
+
+def model_for_file(path):
+    table = os.path.splitext(os.path.basename(path))[0]
+    return table_models().get(TABLE_ALIASES.get(table, table))
+
+
+def dependencies(model):
+    return {field.related_model for field in model._meta.concrete_fields if field.is_relation}
+
+
+def load_order(models_to_load):
+    """Sorts the models so every table comes after the tables its foreign keys point to."""
+    pending, ordered = list(models_to_load), []
+    while pending:
+        ready = [model for model in pending if not (dependencies(model) - {model}) & set(pending)]
+        if not ready:
+            raise ValueError('Circular foreign keys between %s' % ', '.join(model._meta.db_table for model in pending))
+        ordered += ready
+        pending = [model for model in pending if model not in ready]
+    return ordered
+
+
+def export_fields(model):
+    derived = DERIVED_FIELDS.get(model, ())
+    return [field for field in model._meta.concrete_fields
+            if field.name not in derived and not isinstance(field, models.BinaryField)]
+
+
+def open_dump(path, mode='r'):
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+class TableLoader:
+    """Streams one dump file into its table.
+
+    Columns missing from the file get their defaults, auto_now fields the
+    start time of the load and the derived BookInstance columns are
+    computed as save() computes them. PostgreSQL receives the rows through COPY; other databases get
+    batched multi-row INSERTs. Memory use does not depend on the file size.
+    """
+
+    def __init__(self, model, path, unescape_text=True, compress=True, using=DEFAULT_DB_ALIAS):
+        self.model = model
+        self.connection = connections[using]
+        self.path = path
+        self.unescape_text = unescape_text
+        self.compress = compress
+        self.fields = model._meta.concrete_fields
+
+    def rows(self, reader):
+        header = next(reader)
+        by_column = {field.column: field for field in self.fields}
+        unknown = [column for column in header if column not in by_column]
+        if unknown:
+            raise ValueError('%s: unknown columns %s' % (self.path, ', '.join(unknown)))
+        present = [by_column[column] for column in header]
+        missing = [field for field in self.fields if field not in present]
+        now = timezone.now()
+        for line in reader:
+            values = {field.attname: self.to_python(field, raw) for field, raw in zip(present, line)}
+            if self.model is BookInstance:
+                obj = BookInstance(**values)
+                obj.fill_content(compress=self.compress)
+                values.update((name, getattr(obj, name)) for name in DERIVED_FIELDS[BookInstance])
+            for field in missing:
+                if field.attname in values:
+                    continue
+                if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+                    values[field.attname] = now
+                else:
+                    values[field.attname] = field.get_default()
+            yield [values[field.attname] for field in self.fields]
+
+    def to_python(self, field, raw):
+        if isinstance(field, (models.CharField, models.TextField)):
+            return unescape(raw) if self.unescape_text else raw
+        if raw == '' and field.null:
+            return None
+        value = field.to_python(raw)
+        if isinstance(value, datetime.datetime) and timezone.is_naive(value):
+            value = timezone.make_aware(value, datetime.timezone.utc)
+        return value
+
+    def load(self):
+        with open_dump(self.path) as dump, transaction.atomic(using=self.connection.alias):
+            rows = self.rows(csv.reader(dump, delimiter=DELIMITER))
+            if self.connection.vendor == 'postgresql':
+                count = self.copy(rows)
+            else:
+                count = self.insert(rows)
+        return count
+
+    def copy(self, rows):
+        stream = CopyStream(rows)
+        quote_name = self.connection.ops.quote_name
+        sql = 'COPY %s (%s) FROM STDIN' % (quote_name(self.model._meta.db_table),
+                                           ', '.join(quote_name(field.column) for field in self.fields))
+        with self.connection.cursor() as cursor:
+            cursor.copy_expert(sql, stream)
+        return stream.count
+
+    def insert(self, rows):
+        connection = self.connection
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in self.fields)
+        placeholders = '(%s)' % ', '.join(['%s'] * len(self.fields))
+        # stay below the bound parameter limit of the database
+        max_params = connection.features.max_query_params or 999
+        per_statement = max(min(BATCH_SIZE, max_params // len(self.fields)), 1)
+        count = 0
+        batch = []
+        with connection.cursor() as cursor:
+            for row in rows:
+                batch.append([field.get_db_prep_save(value, connection) for field, value in zip(self.fields, row)])
+                if len(batch) == per_statement:
+                    count += self.insert_batch(cursor, table, columns, placeholders, batch)
+                    batch = []
+            if batch:
+                count += self.insert_batch(cursor, table, columns, placeholders, batch)
+        return count
+
+    def insert_batch(self, cursor, table, columns, placeholders, batch):
+        cursor.execute('INSERT INTO %s (%s) VALUES %s' % (table, columns, ', '.join([placeholders] * len(batch))),
+                       [value for row in batch for value in row])
+        return len(batch)
+
+
+def copy_value(value):
+    """A database value in the COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return COPY_UNESCAPED_RE.sub(lambda match: COPY_ESCAPES[match.group(0)], str(value))
+
+
+class CopyStream:
+    """File-like object that psycopg2's copy_expert reads the rows from, a chunk at a time."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        size = size if size and size > 0 else 65536
+        while len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.buffer += '\t'.join(copy_value(value) for value in row) + '\n'
+            self.count += 1
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    readline = read
+
+
+def reset_sequences(models_loaded, using=DEFAULT_DB_ALIAS):
+    """Moves the id sequences past the imported ids; SQLite does it by itself."""
+    connection = connections[using]
+    statements = connection.ops.sequence_reset_sql(no_style(), models_loaded)
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+
+def export_value(field, value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime.datetime):
+        if timezone.is_aware(value):
+            value = timezone.make_naive(value, datetime.timezone.utc)
+        return value.isoformat(' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return value.hex
+    if isinstance(value, str):
+        return escape(value)
+    return value
+
+
+def export_table(model, path, chunk_size=BATCH_SIZE):
+    """Writes the table in the dump format, reading it through a server-side cursor where available."""
+    fields = export_fields(model)
+    queryset = model._default_manager.order_by('pk').values_list(*[field.attname for field in fields])
+    count = 0
+    with open_dump(path, 'w') as dump:
+        writer = csv.writer(dump, delimiter=DELIMITER, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+        writer.writerow([field.column for field in fields])
+        for row in queryset.iterator(chunk_size=chunk_size):
+            writer.writerow([export_value(field, value) for field, value in zip(fields, row)])
+            count += 1
+    return count
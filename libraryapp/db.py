@@ -0,0 +1,41 @@
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import instrumentation
+
+HEALTH_CHECK_SECONDS = getattr(settings, 'DB_HEALTH_CHECK_SECONDS', 30)
+
+
+def count_connection(sender, connection, **kwargs):
+    connection.last_used_at = time.monotonic()
+    if instrumentation.prometheus_client is not None:
+        instrumentation.DB_CONNECTIONS.labels(connection.alias).inc()
+
+
+def check_connections(**kwargs):
+    """Closes persistent connections that stopped working while idle, before the request runs a query on them.
+
+    Django 3.2 only notices a dead connection when a query fails, which
+    turns a database restart or an idle timeout into a failed request.
+    The check costs a round trip, so it is only done for connections that
+    sat unused for HEALTH_CHECK_SECONDS.
+    """
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or now - getattr(connection, 'last_used_at', now) < HEALTH_CHECK_SECONDS:
+            continue
+        usable = connection.is_usable()
+        if not usable:
+            connection.close()
+        connection.last_used_at = now
+        if instrumentation.prometheus_client is not None:
+            instrumentation.DB_HEALTH_CHECKS.labels(connection.alias, 'ok' if usable else 'closed').inc()
+
+
+def mark_connections_used(**kwargs):
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection.last_used_at = now
@@ -0,0 +1,196 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+INSTRUMENTATION = getattr(settings, 'INSTRUMENTATION', {})
+SLOW_REQUEST_SECONDS = INSTRUMENTATION.get('SLOW_REQUEST_SECONDS', 0.5)
+SERVER_TIMING = INSTRUMENTATION.get('SERVER_TIMING', True)
+METRICS_ALLOWED_IPS = INSTRUMENTATION.get('METRICS_ALLOWED_IPS', ('127.0.0.1',))
+
+logger = logging.getLogger('libraryapp.requests')
+# the metrics of the request being served; a context variable so async views and their worker threads see it
+current = contextvars.ContextVar('request_metrics', default=None)
+
+if prometheus_client is not None:
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'library_request_duration_seconds', 'Time spent serving a request.', ['view', 'method'],
+        buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+    DB_SECONDS = prometheus_client.Histogram(
+        'library_request_db_seconds', 'Time spent in database queries per request.', ['view', 'method'],
+        buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+    QUERIES = prometheus_client.Histogram(
+        'library_request_queries', 'Database queries per request.', ['view', 'method'],
+        buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100))
+    RESPONSE_BYTES = prometheus_client.Histogram(
+        'library_response_bytes', 'Size of non-streaming response bodies.', ['view', 'method'],
+        buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+    RESPONSES = prometheus_client.Counter(
+        'library_responses', 'Responses by status code.', ['view', 'method', 'status'])
+    REPEATED_QUERIES = prometheus_client.Counter(
+        'library_repeated_queries', 'Queries whose SQL already ran earlier in the same request.', ['view', 'method'])
+    DB_CONNECTIONS = prometheus_client.Counter(
+        'library_db_connections_opened', 'Database connections opened; compare with the request count for reuse.',
+        ['alias'])
+    DB_HEALTH_CHECKS = prometheus_client.Counter(
+        'library_db_health_checks', 'Checks of idle persistent connections, by outcome.', ['alias', 'result'])
+
+
+class RequestMetrics:
+    __slots__ = ('started', 'db_time', 'queries', 'statements', 'phases')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.queries = 0
+        self.statements = defaultdict(int)
+        self.phases = defaultdict(float)
+
+    @property
+    def repeated(self):
+        """Executions of a statement that already ran in this request, the signature of an N+1 loop."""
+        return sum(count - 1 for count in self.statements.values())
+
+
+def instrument_query(execute, sql, params, many, context):
+    """Database execute wrapper, installed on every connection when it is opened."""
+    metrics = current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_time += time.perf_counter() - started
+        metrics.queries += 1
+        metrics.statements[sql] += 1
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    if instrument_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(instrument_query)
+
+
+@contextmanager
+def phase(name):
+    """Times a part of the request; database time spent inside it is reported under db instead."""
+    metrics = current.get()
+    if metrics is None:
+        yield
+        return
+    started, db_before = time.perf_counter(), metrics.db_time
+    try:
+        yield
+    finally:
+        metrics.phases[name] += time.perf_counter() - started - (metrics.db_time - db_before)
+
+
+def view_label(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match is not None else 'unmatched'
+
+
+def response_size(response):
+    if response.streaming:
+        length = response.get('Content-Length')
+        return int(length) if length else None
+    return len(response.content)
+
+
+def server_timing(metrics, total):
+    parts = ['%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in metrics.phases.items()]
+    parts.append('db;dur=%.2f;desc="%d queries, %d repeated"' % (metrics.db_time * 1000, metrics.queries, metrics.repeated))
+    app = total - metrics.db_time - sum(metrics.phases.values())
+    parts.append('app;dur=%.2f' % (app * 1000))
+    parts.append('total;dur=%.2f' % (total * 1000))
+    return ', '.join(parts)
+
+
+class InstrumentationMiddleware:
+    """Measures every request: phases, database time and queries, response size.
+
+    The numbers go to the Server-Timing header, to the libraryapp.requests
+    log for requests slower than SLOW_REQUEST_SECONDS, and to the
+    Prometheus histograms served by metrics_view.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # under ASGI the chain below is async; marked as Django's MiddlewareMixin does, so no thread is taken
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        self.record(request, response, metrics)
+        return response
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        self.record(request, response, metrics)
+        return response
+
+    def record(self, request, response, metrics):
+        total = time.perf_counter() - metrics.started
+        view, method = view_label(request), request.method
+        size = response_size(response)
+        if SERVER_TIMING:
+            response['Server-Timing'] = server_timing(metrics, total)
+        if prometheus_client is not None:
+            REQUEST_SECONDS.labels(view, method).observe(total)
+            DB_SECONDS.labels(view, method).observe(metrics.db_time)
+            QUERIES.labels(view, method).observe(metrics.queries)
+            RESPONSES.labels(view, method, response.status_code).inc()
+            if size is not None:
+                RESPONSE_BYTES.labels(view, method).observe(size)
+            if metrics.repeated:
+                REPEATED_QUERIES.labels(view, method).inc(metrics.repeated)
+        if total >= SLOW_REQUEST_SECONDS:
+            logger.warning(json.dumps({
+                'event': 'slow_request', 'view': view, 'method': method, 'path': request.get_full_path(),
+                'status': response.status_code, 'total_ms': round(total * 1000, 2),
+                'db_ms': round(metrics.db_time * 1000, 2), 'queries': metrics.queries, 'repeated_queries': metrics.repeated,
+                'phases_ms': {name: round(seconds * 1000, 2) for name, seconds in metrics.phases.items()},
+                'response_bytes': size,
+            }, ensure_ascii=False))
+
+
+def metrics_view(request):
+    """Prometheus text exposition; with several workers, set PROMETHEUS_MULTIPROC_DIR so they are summed."""
+    if METRICS_ALLOWED_IPS and request.META.get('REMOTE_ADDR') not in METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    if prometheus_client is None:
+        return HttpResponse('prometheus_client is not installed', status=501, content_type='text/plain')
+    registry = prometheus_client.REGISTRY
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return HttpResponse(prometheus_client.generate_latest(registry), content_type=prometheus_client.CONTENT_TYPE_LATEST)
@@ -0,0 +1,75 @@
+"""The book read model: each book's BookSerializer representation, rendered ahead of time.
+
+Rows are refreshed by a background task queued when the transactions that
+change a book or its authors, genres or instance commit, so a list page is
+read from one table instead of being joined from five. BooksView serves its
+list from it; the rows of changed books are deleted at commit, and books
+without a row are serialized as before until the task ran. When the response cache is shared by the
+workers, the task then puts the new rows into it, so the next read of a
+changed book is a hit.
+"""
+import threading
+
+from django.db import transaction
+
+from .cache import get_response_cache, is_shared, object_key
+from .models import Book, BookListing
+from .renderers import dumps, loads
+from .routers import CHECK_INTERVAL, MAX_LAG_SECONDS, REPLICAS
+from .serializers import BookSerializer, eager_loading
+from .tasks import task
+
+REFRESH_BATCH_SIZE = 500
+
+
+@task
+def refresh_listings(book_ids, warm=False):
+    """Renders the given books again; rows of books that no longer exist are removed.
+
+    With warm, the new rows are put into the response cache afterwards.
+    """
+    book_ids = sorted(set(book_ids))
+    for start in range(0, len(book_ids), REFRESH_BATCH_SIZE):
+        batch = book_ids[start:start + REFRESH_BATCH_SIZE]
+        books = eager_loading(Book.objects.filter(pk__in=batch), BookSerializer)
+        rows = [BookListing(book_id=book.pk, document=dumps(data).decode('utf-8'))
+                for book, data in zip(books, BookSerializer(books, many=True).data)]
+        with transaction.atomic():
+            BookListing.objects.filter(book_id__in=batch).delete()
+            BookListing.objects.bulk_create(rows)
+    if warm:
+        # with replicas, after invalidate() dropped the keys for the last time
+        warm_books.delay(book_ids, countdown=MAX_LAG_SECONDS + CHECK_INTERVAL + 1 if REPLICAS else 0)
+
+
+def read_listings(book_ids):
+    """Representations of the books that have a row, by book id."""
+    return {book_id: loads(document) for book_id, document in
+            BookListing.objects.filter(book_id__in=book_ids).values_list('book_id', 'document')}
+
+
+@task
+def warm_books(book_ids):
+    get_response_cache().set_many({object_key(Book, pk): data for pk, data in read_listings(book_ids).items()})
+
+
+_pending = threading.local()
+
+
+def schedule_refresh(book_ids):
+    """Refreshes the books once the current transaction commits; repeated requests for a book are merged."""
+    if getattr(_pending, 'book_ids', None) is None:
+        _pending.book_ids = set()
+    _pending.book_ids.update(book_ids)
+    transaction.on_commit(flush_refresh)
+
+
+def flush_refresh():
+    book_ids, _pending.book_ids = _pending.book_ids, set()
+    if book_ids:
+        # an author or genre can have thousands of books, so they are rendered by a task, not in the request;
+        # until it runs they are served without their outdated rows
+        book_ids = sorted(book_ids)
+        for start in range(0, len(book_ids), REFRESH_BATCH_SIZE):
+            BookListing.objects.filter(book_id__in=book_ids[start:start + REFRESH_BATCH_SIZE]).delete()
+        refresh_listings.delay(book_ids, is_shared())
@@ -0,0 +1,128 @@
+"""Checkout, return and the waitlist of books.
+
+Book.status is the availability of the book's single copy: 'a' on the
+shelf, 'e' lent out, 'n_a' not lendable. Every transition starts with a
+conditional UPDATE of the book row, which checks the status and holds the
+row lock until the transaction commits: of two concurrent checkouts of an
+available book exactly one updates a row, and a return and a reservation
+of the same book run one after the other. The book row is always locked
+first, so the transitions cannot deadlock each other. The partial unique
+index on open loans backs this up.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound
+
+from .cache import invalidate
+from .listing import schedule_refresh
+from .models import Book, Loan, Reservation
+
+LOANS = getattr(settings, 'LOANS', {})
+LOAN_DAYS = LOANS.get('DAYS', 14)
+
+CHECKOUT_CONFLICTS = {'e': 'The book is lent out, reserve it to join the waitlist.', 'n_a': 'The book cannot be lent.'}
+RESERVE_CONFLICTS = {'a': 'The book is available, check it out instead.', 'n_a': 'The book cannot be lent.'}
+RETURN_CONFLICTS = {'a': 'The book is not lent out.', 'n_a': 'The book is not lent out.'}
+LENT_OUT = 'The book is lent out, it goes back on the shelf when it is returned.'
+LEND_BY_CHECKOUT = 'A book is lent out by checking it out.'
+
+
+class LoanConflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The book cannot be lent right now.'
+    default_code = 'loan_conflict'
+
+
+def lock_book(book_id, expected, conflicts, **changes):
+    """Locks the book row if its status is the expected one, applying changes; raises otherwise."""
+    if 'status' in changes:
+        changes['updated_at'] = timezone.now()
+    else:
+        # a no-op assignment still takes the row lock
+        changes['status'] = expected
+    if Book.objects.filter(pk=book_id, status=expected).update(**changes):
+        return
+    current = Book.objects.filter(pk=book_id).values_list('status', flat=True).first()
+    if current is None:
+        raise NotFound()
+    raise LoanConflict(conflicts.get(current))
+
+
+def status_changed(book_id):
+    # update() sends no signals, so the cached and precomputed representations are refreshed here;
+    # the lists filter on status, so they expire as well
+    invalidate(Book, [book_id], membership=True)
+    schedule_refresh([book_id])
+
+
+def new_loan(book_id, user_id):
+    # the book row is locked, so only a status written outside this module can leave an open loan behind
+    try:
+        with transaction.atomic():
+            return Loan.objects.create(book_id=book_id, user_id=user_id,
+                                       due_at=timezone.now() + timedelta(days=LOAN_DAYS))
+    except IntegrityError:
+        raise LoanConflict('The book is already lent out.')
+
+
+def shelve(book_ids, status):
+    """Puts books on the shelf ('a') or takes them off ('n_a'); a lent out book is left to return_book().
+
+    Returns the ids of the books that were not changed because they are lent out, or gone.
+    """
+    book_ids = set(book_ids)
+    shelved = Book.objects.filter(pk__in=book_ids, status__in=('a', 'n_a')).update(status=status, updated_at=timezone.now())
+    if shelved == len(book_ids):
+        return set()
+    # the rows just updated stay locked until the transaction ends, so they still have the new status
+    return book_ids - set(Book.objects.filter(pk__in=book_ids, status=status).values_list('pk', flat=True))
+
+
+@transaction.atomic
+def checkout(book_id, user_id):
+    lock_book(book_id, 'a', CHECKOUT_CONFLICTS, status='e')
+    loan = new_loan(book_id, user_id)
+    status_changed(book_id)
+    return loan
+
+
+@transaction.atomic
+def return_book(book_id, user_id):
+    """Closes the user's loan and lends the book to the first reader in the waitlist, if there is one."""
+    lock_book(book_id, 'e', RETURN_CONFLICTS)
+    now = timezone.now()
+    if not Loan.objects.filter(book_id=book_id, user_id=user_id, returned_at__isnull=True).update(returned_at=now):
+        raise LoanConflict('You have not borrowed this book.')
+    reservation = Reservation.objects.filter(book_id=book_id, closed_at__isnull=True).order_by('id').first()
+    if reservation is None:
+        Book.objects.filter(pk=book_id).update(status='a', updated_at=now)
+        status_changed(book_id)
+        return None
+    loan = new_loan(book_id, reservation.user_id)
+    Reservation.objects.filter(pk=reservation.pk).update(closed_at=now, loan=loan)
+    return loan
+
+
+@transaction.atomic
+def reserve(book_id, user_id):
+    """Puts the user at the end of the waitlist; returns the reservation and its place in the queue."""
+    lock_book(book_id, 'e', RESERVE_CONFLICTS)
+    if Loan.objects.filter(book_id=book_id, user_id=user_id, returned_at__isnull=True).exists():
+        raise LoanConflict('You have borrowed this book.')
+    try:
+        with transaction.atomic():
+            reservation = Reservation.objects.create(book_id=book_id, user_id=user_id)
+    except IntegrityError:
+        raise LoanConflict('You are already in the waitlist.')
+    position = Reservation.objects.filter(book_id=book_id, closed_at__isnull=True, id__lte=reservation.pk).count()
+    return reservation, position
+
+
+def cancel_reservation(book_id, user_id):
+    if not Reservation.objects.filter(book_id=book_id, user_id=user_id, closed_at__isnull=True).update(
+            closed_at=timezone.now()):
+        raise NotFound()
@@ -0,0 +1,60 @@
+import re
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from libraryapp.models import Author, Book, BookInstance, Genre
+from libraryapp.views import BookDetailView, BooksView
+
+SCAN_PATTERNS = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'\bSCAN (?:TABLE )?(\w+)(?!.*\bUSING\b)'),
+}
+
+
+def app_querysets():
+    """The querysets the API runs, keyed by a short description."""
+    return {
+        'book list page': BooksView().get_queryset().filter(id__gt=0).order_by('id')[:50],
+        'book detail': BookDetailView().get_queryset().filter(pk=1),
+        'book authors prefetch': Book.authors.through.objects.filter(book_id__in=[1, 2]),
+        'book genre prefetch': Book.genre.through.objects.filter(book_id__in=[1, 2]),
+        'book instance by id_security': BookInstance.objects.filter(id_security=uuid.uuid4()).only('id', 'id_security'),
+        'author by name': Author.objects.filter(first_name='Александр', last_name='Пушкин'),
+        'genre by name': Genre.objects.filter(name='Роман'),
+        'book by isbn': Book.objects.filter(isbn='978-5-7932-0842-3'),
+        'book by status': Book.objects.filter(status='a'),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Runs EXPLAIN for the querysets used by the API and reports full table scans.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-seqscan', action='store_true',
+                            help='PostgreSQL only: disable sequential scans so small tables still show their indexes.')
+        parser.add_argument('--fail-on-scan', action='store_true', help='Exit with an error if any scan is found.')
+
+    def handle(self, *args, **options):
+        pattern = SCAN_PATTERNS.get(connection.vendor)
+        if pattern is None:
+            self.stdout.write(self.style.WARNING('Scan detection is not supported on %s, printing plans only.' % connection.vendor))
+        if options['no_seqscan'] and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+        scans = 0
+        for name, queryset in app_querysets().items():
+            plan = queryset.explain()
+            tables = pattern.findall(plan) if pattern else []
+            if pattern is None:
+                self.stdout.write(name)
+            elif tables:
+                scans += 1
+                self.stdout.write(self.style.WARNING('%s: full scan of %s' % (name, ', '.join(sorted(set(tables))))))
+            else:
+                self.stdout.write(self.style.SUCCESS('%s: ok' % name))
+            if options['verbosity'] > 1 or tables or pattern is None:
+                self.stdout.write('    ' + plan.replace('\n', '\n    '))
+        if scans and options['fail_on_scan']:
+            raise CommandError('%d queries scan a whole table' % scans)
@@ -0,0 +1,29 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from libraryapp.csvdump import TABLE_ALIASES, export_table, table_models
+
+DEFAULT_TABLES = ('auth_user', 'libraryapp_author', 'libraryapp_genre', 'libraryapp_bookinstance', 'libraryapp_book',
+                  'libraryapp_book_authors', 'libraryapp_book_genre', 'libraryapp_userprofile')
+
+
+class Command(BaseCommand):
+    help = 'Writes tables as semicolon-separated dumps in the format import_csv reads, streaming them row by row.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tables', nargs='*', default=DEFAULT_TABLES)
+        parser.add_argument('--output-dir', default='.')
+
+    def handle(self, *args, **options):
+        models = table_models()
+        file_names = {table: name for name, table in TABLE_ALIASES.items()}
+        os.makedirs(options['output_dir'], exist_ok=True)
+        for table in options['tables']:
+            model = models.get(TABLE_ALIASES.get(table, table))
+            if model is None:
+                raise CommandError('No such table: %s' % table)
+            table = model._meta.db_table
+            path = os.path.join(options['output_dir'], '%s.csv' % file_names.get(table, table))
+            count = export_table(model, path)
+            self.stdout.write('%s: %d rows' % (path, count))
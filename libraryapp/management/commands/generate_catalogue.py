@@ -0,0 +1,135 @@
+import random
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max
+
+from libraryapp.cache import invalidate
+from libraryapp.models import Author, Book, BookInstance, Genre, UserProfile
+from libraryapp.search import BACKENDS
+
+# word pools in the style of the exported catalogue in "to Postgres/"
+FIRST_NAMES = ['Александр', 'Юрий', 'Дмитрий', 'Лев', 'Фёдор', 'Антон', 'Михаил', 'Иван', 'Николай', 'Борис',
+               'Анна', 'Марина', 'Ольга', 'Татьяна', 'Людмила', 'Виктор', 'Сергей', 'Владимир', 'Евгений', 'Андрей']
+LAST_NAMES = ['Пушкин', 'Шпак', 'Глуховский', 'Толстой', 'Достоевский', 'Чехов', 'Булгаков', 'Тургенев', 'Гоголь',
+              'Пастернак', 'Ахматова', 'Цветаева', 'Пелевин', 'Улицкая', 'Стругацкий', 'Лермонтов', 'Бунин', 'Набоков']
+GENRES = ['Роман', 'Стихотворение', 'Программирование', 'Фантастика', 'Постапокалипсис', 'Детектив', 'Повесть',
+          'Рассказ', 'Драма', 'Комедия', 'Биография', 'История', 'Философия', 'Поэма', 'Сказка', 'Приключения',
+          'Учебник', 'Справочник', 'Математика', 'Физика', 'Антиутопия', 'Мемуары', 'Публицистика', 'Мистика']
+TITLE_WORDS = ['Метро', 'Евгений', 'Онегин', 'Программирование', 'на', 'языке', 'тихий', 'Дон', 'мастер', 'война',
+               'мир', 'белая', 'гвардия', 'идиот', 'бесы', 'вишнёвый', 'сад', 'мёртвые', 'души', 'отцы', 'дети',
+               'пикник', 'обочине', 'понедельник', 'начинается', 'субботу', 'микроконтроллеров', 'AVR', 'основы']
+TEXT_WORDS = ['в', 'книге', 'рассмотрено', 'программирование', 'на', 'языке', 'С', 'микроконтроллеров', 'с',
+              'использованием', 'компиляторов', 'и', 'а', 'также', 'он', 'она', 'было', 'утро', 'город', 'метро',
+              'станция', 'туннель', 'свет', 'тьма', 'люди', 'жизнь', 'дорога', 'время', 'сказал', 'глаза', 'дом',
+              'письмо', 'сердце', 'ночь', 'снег', 'поезд', 'память', 'земля', 'небо', 'вдруг', 'никто', 'всегда']
+PASSWORD = 'bench-password'
+
+
+def insert(model, objects, batch_size):
+    """bulk_create() that returns the new primary keys on databases that cannot return them from the insert."""
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objects, batch_size=batch_size)
+        return [obj.pk for obj in objects]
+    last = model.objects.aggregate(last=Max('pk'))['last'] or 0
+    model.objects.bulk_create(objects, batch_size=batch_size)
+    return list(model.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True))
+
+
+class Command(BaseCommand):
+    help = ('Fills the database with a synthetic catalogue for benchmarks: authors, genres, books with their '
+            'instances and texts, and users with profiles. The same --seed always gives the same data.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=1000)
+        parser.add_argument('--authors', type=int, default=None, help='Defaults to a fifth of --books.')
+        parser.add_argument('--genres', type=int, default=len(GENRES))
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--text-chars', type=int, default=20000, help='Average length of an instance text.')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--prefix', default='bench', help='Prefix of the generated usernames.')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        genre_ids = self.create_genres(options['genres'])
+        author_ids = self.create_authors(options['authors'] or max(options['books'] // 5, 1))
+        self.create_books(options['books'], author_ids, genre_ids)
+        self.create_users(options['users'])
+        for model in (Author, Genre, Book):
+            invalidate(model, membership=True)
+        if connection.vendor in BACKENDS:
+            call_command('rebuild_search_index', verbosity=0)
+        call_command('rebuild_book_listing', verbosity=0)
+        self.stdout.write(self.style.SUCCESS(
+            '%d genres, %d authors, %d books and %d users created' % (
+                len(genre_ids), len(author_ids), options['books'], options['users'])))
+
+    def create_genres(self, count):
+        existing = set(Genre.objects.values_list('name', flat=True))
+        names = [GENRES[i % len(GENRES)] + ('' if i < len(GENRES) else ' %d' % (i // len(GENRES))) for i in range(count)]
+        insert(Genre, [Genre(name=name) for name in names if name not in existing], self.options['batch_size'])
+        return list(Genre.objects.filter(name__in=names).values_list('pk', flat=True))
+
+    def create_authors(self, count):
+        authors = [Author(first_name=self.rng.choice(FIRST_NAMES), last_name=self.rng.choice(LAST_NAMES),
+                          birthday='%04d-%02d-%02d' % (self.rng.randint(1750, 2000), self.rng.randint(1, 12),
+                                                       self.rng.randint(1, 28)))
+                   for _ in range(count)]
+        return insert(Author, authors, self.options['batch_size'])
+
+    def text(self):
+        # lengths vary around the average the way real books do, a few are several times longer
+        target = int(self.rng.expovariate(1 / self.options['text_chars'])) + 1
+        words, length = [], 0
+        while length < target:
+            word = self.rng.choice(TEXT_WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return ' '.join(words)
+
+    def create_books(self, count, author_ids, genre_ids):
+        batch_size = self.options['batch_size']
+        for start in range(0, count, batch_size):
+            size = min(batch_size, count - start)
+            with transaction.atomic():
+                instances = [BookInstance(id_security=uuid.UUID(int=self.rng.getrandbits(128), version=4),
+                                          text=self.text()) for _ in range(size)]
+                for instance in instances:
+                    instance.fill_content()
+                instance_ids = insert(BookInstance, instances, batch_size)
+                books = [Book(title=' '.join(self.rng.sample(TITLE_WORDS, self.rng.randint(1, 4))).capitalize(),
+                              isbn='978-5-%04d-%04d-%d' % (self.rng.randint(0, 9999), self.rng.randint(0, 9999),
+                                                           self.rng.randint(0, 9)),
+                              status=self.rng.choice(Book.BOOK_STATUS)[0], id_inst_id=instance_id)
+                         for instance_id in instance_ids]
+                book_ids = insert(Book, books, batch_size)
+                Book.authors.through.objects.bulk_create(
+                    [Book.authors.through(book_id=book_id, author_id=author_id) for book_id in book_ids
+                     for author_id in self.rng.sample(author_ids, min(self.rng.choice([1, 1, 1, 2, 3]), len(author_ids)))],
+                    batch_size=batch_size)
+                Book.genre.through.objects.bulk_create(
+                    [Book.genre.through(book_id=book_id, genre_id=genre_id) for book_id in book_ids
+                     for genre_id in self.rng.sample(genre_ids, min(self.rng.choice([1, 2, 2, 3]), len(genre_ids)))],
+                    batch_size=batch_size)
+            if self.options['verbosity'] > 1:
+                self.stdout.write('%d books created' % (start + size))
+
+    def create_users(self, count):
+        """Creates <prefix>-admin (staff) and <prefix>-user-N readers, all with the password bench-password."""
+        prefix = self.options['prefix']
+        # hashing once keeps generation fast; the hash is the same format login checks
+        password = make_password(PASSWORD)
+        usernames = ['%s-admin' % prefix] + ['%s-user-%d' % (prefix, i) for i in range(count)]
+        existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        users = [User(username=username, email='%s@example.com' % username, password=password,
+                      is_staff=username.endswith('-admin'))
+                 for username in usernames if username not in existing]
+        user_ids = insert(User, users, self.options['batch_size'])
+        UserProfile.objects.bulk_create([UserProfile(user_id=user_id, location=self.rng.choice(LAST_NAMES))
+                                         for user_id in user_ids], batch_size=self.options['batch_size'])
@@ -0,0 +1,67 @@
+import glob
+import os
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from libraryapp.cache import expire_lists, get_response_cache
+from libraryapp.csvdump import TableLoader, load_order, model_for_file, reset_sequences
+from libraryapp.models import Book
+from libraryapp.search import BACKENDS
+
+# created by migrate or only meaningful to the database they were exported from
+SKIPPED_TABLES = ('django_content_type', 'auth_permission', 'django_session', 'django_admin_log',
+                  'libraryapp_booklisting')
+
+
+class Command(BaseCommand):
+    help = ('Loads semicolon-separated table dumps like the ones in "to Postgres/". Uses COPY on PostgreSQL and '
+            'batched INSERTs elsewhere; files are loaded in foreign key order.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='CSV files or directories; defaults to "to Postgres/".')
+        parser.add_argument('--truncate', action='store_true',
+                            help='Empty the tables first. On PostgreSQL this cascades to tables that reference them.')
+        parser.add_argument('--no-unescape', dest='unescape', action='store_false',
+                            help='Keep backslash sequences such as \\r\\n in texts as they are.')
+        parser.add_argument('--skip-compression', dest='compress', action='store_false',
+                            help='Do not precompress book texts; the content endpoint then streams them uncompressed.')
+
+    def handle(self, *args, **options):
+        files = {}
+        for path in options['paths'] or [os.path.join(settings.BASE_DIR, 'to Postgres')]:
+            for name in sorted(glob.glob(os.path.join(path, '*.csv'))) if os.path.isdir(path) else [path]:
+                model = model_for_file(name)
+                if model is None:
+                    self.stdout.write(self.style.WARNING('%s: no such table, skipped' % name))
+                elif model._meta.db_table in SKIPPED_TABLES:
+                    self.stdout.write('%s: skipped' % name)
+                else:
+                    files[model] = name
+        if not files:
+            raise CommandError('Nothing to load')
+        ordered = load_order(files)
+        with transaction.atomic():
+            if options['truncate']:
+                tables = [model._meta.db_table for model in ordered]
+                connection.ops.execute_sql_flush(
+                    connection.ops.sql_flush(no_style(), tables, reset_sequences=True, allow_cascade=True))
+            for model in ordered:
+                loader = TableLoader(model, files[model], options['unescape'], options['compress'])
+                try:
+                    count = loader.load()
+                except ValueError as e:
+                    raise CommandError(e)
+                self.stdout.write('%s: %d rows' % (model._meta.db_table, count))
+            reset_sequences(ordered)
+        get_response_cache().clear()
+        for model in ordered:
+            expire_lists(model)
+        if Book in files and connection.vendor in BACKENDS:
+            call_command('rebuild_search_index', verbosity=0)
+        if Book in files:
+            call_command('rebuild_book_listing', verbosity=0)
+        self.stdout.write(self.style.SUCCESS('%d tables loaded' % len(ordered)))
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from libraryapp.authentication import purge_revocations
+from libraryapp.blacklist import PURGE_BATCH_SIZE, purge_expired
+
+
+class Command(BaseCommand):
+    help = 'Deletes blacklisted refresh tokens that have expired, in bounded batches, and outdated user revocations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE)
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches; the rest is left for the next run.')
+        parser.add_argument('--every', type=int, default=None, metavar='SECONDS',
+                            help='Keep running and purge again every SECONDS seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            purged = purge_expired(options['batch_size'], options['max_batches'])
+            self.stdout.write(self.style.SUCCESS('%d expired tokens purged' % purged))
+            self.stdout.write(self.style.SUCCESS('%d outdated revocations purged' % purge_revocations()))
+            if options['every'] is None:
+                break
+            close_old_connections()
+            time.sleep(options['every'])
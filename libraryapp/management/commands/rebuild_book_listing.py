@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from libraryapp.listing import REFRESH_BATCH_SIZE, refresh_listings
+from libraryapp.models import Book, BookListing
+
+
+class Command(BaseCommand):
+    help = 'Renders the listing representation of all books again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=REFRESH_BATCH_SIZE * 10)
+
+    def handle(self, *args, **options):
+        # rows of deleted books go with them, so only the books need a pass
+        BookListing.objects.exclude(book_id__in=Book.objects.values('pk')).delete()
+        last_id = 0
+        rendered = 0
+        while True:
+            book_ids = list(Book.objects.filter(pk__gt=last_id).order_by('pk')
+                            .values_list('pk', flat=True)[:options['batch_size']])
+            if not book_ids:
+                break
+            refresh_listings(book_ids)
+            rendered += len(book_ids)
+            last_id = book_ids[-1]
+            if options['verbosity'] > 1:
+                self.stdout.write('%d books rendered' % rendered)
+        self.stdout.write(self.style.SUCCESS('%d books rendered' % rendered))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from libraryapp.models import Book
+from libraryapp.search import INDEX_BATCH_SIZE, index_books
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search documents of all books.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=INDEX_BATCH_SIZE * 10)
+
+    def handle(self, *args, **options):
+        last_id = 0
+        indexed = 0
+        while True:
+            book_ids = list(Book.objects.filter(pk__gt=last_id).order_by('pk')
+                            .values_list('pk', flat=True)[:options['batch_size']])
+            if not book_ids:
+                break
+            index_books(book_ids)
+            indexed += len(book_ids)
+            last_id = book_ids[-1]
+            if options['verbosity'] > 1:
+                self.stdout.write('%d books indexed' % indexed)
+        self.stdout.write(self.style.SUCCESS('%d books indexed' % indexed))
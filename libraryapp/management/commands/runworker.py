@@ -0,0 +1,76 @@
+import multiprocessing
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+# libraryapp.tasks is imported inside the functions: a spawned worker process
+# imports this module before django.setup() has run
+
+
+def work(stop, idle_sleep):
+    import django
+    django.setup()
+    from libraryapp.tasks import run_pending
+
+    # Ctrl+C reaches the whole process group; the supervisor decides when the workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while not stop.is_set():
+        ran = run_pending(limit=100)
+        close_old_connections()
+        if not ran:
+            stop.wait(idle_sleep)
+
+
+class Command(BaseCommand):
+    help = 'Runs the background tasks queued in the database with a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        from libraryapp.tasks import TASKS
+
+        parser.add_argument('--processes', type=int, default=TASKS.get('PROCESSES', 2))
+        parser.add_argument('--idle-sleep', type=float, default=1.0, metavar='SECONDS',
+                            help='How long a worker waits before looking again when no task is due.')
+        parser.add_argument('--keep-finished', type=int, default=TASKS.get('KEEP_FINISHED_SECONDS', 7 * 24 * 3600),
+                            metavar='SECONDS', help='Delete done and failed tasks this long after they finished.')
+        parser.add_argument('--once', action='store_true',
+                            help='Run the due tasks in this process and exit, e.g. from cron.')
+
+    def handle(self, *args, **options):
+        from libraryapp.tasks import purge_finished, run_pending
+
+        if options['once']:
+            self.stdout.write(self.style.SUCCESS('%d tasks run' % run_pending()))
+            return
+        # forked workers must not share the supervisor's connections
+        connections.close_all()
+        stop = multiprocessing.Event()
+        stopping = []
+        # the handler only records the signal: Event.set() could wait for a lock the interrupted wait() holds
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stopping.append(True))
+        workers = [None] * options['processes']
+        purged_at = 0
+        while not stopping:
+            for slot, process in enumerate(workers):
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    self.stderr.write('worker %d exited with %s, starting another' % (process.pid, process.exitcode))
+                workers[slot] = multiprocessing.Process(target=work, args=(stop, options['idle_sleep']), daemon=True)
+                workers[slot].start()
+            if time.monotonic() - purged_at >= 3600:
+                purged = purge_finished(options['keep_finished'])
+                connections.close_all()
+                purged_at = time.monotonic()
+                if purged:
+                    self.stdout.write('%d finished tasks purged' % purged)
+            time.sleep(1)
+        stop.set()
+        # a worker finishes its current task first; one that outlives the lease would lose it anyway
+        for process in workers:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        self.stdout.write(self.style.SUCCESS('workers stopped'))
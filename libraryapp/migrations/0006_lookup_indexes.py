@@ -0,0 +1,52 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:02
+
+from django.db import migrations, models
+import uuid
+
+
+def merge_duplicate_genres(apps, schema_editor):
+    Genre = apps.get_model('libraryapp', 'Genre')
+    Through = apps.get_model('libraryapp', 'Book').genre.through
+    keep = {}
+    for genre in Genre.objects.order_by('id'):
+        if genre.name not in keep:
+            keep[genre.name] = genre.id
+            continue
+        linked = Through.objects.filter(genre_id=keep[genre.name]).values_list('book_id', flat=True)
+        Through.objects.filter(genre_id=genre.id).exclude(book_id__in=linked).update(genre_id=keep[genre.name])
+        genre.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libraryapp', '0005_auto_20210411_2259'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_genres, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='book',
+            name='isbn',
+            field=models.CharField(db_index=True, max_length=17, verbose_name='ISBN'),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='status',
+            field=models.CharField(blank=True, choices=[('a', 'Available'), ('e', 'Expectation'), ('n_a', 'Not available')], db_index=True, default='n_a', max_length=3),
+        ),
+        migrations.AlterField(
+            model_name='bookinstance',
+            name='id_security',
+            field=models.UUIDField(default=uuid.uuid4, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='genre',
+            name='name',
+            field=models.CharField(max_length=256, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='author',
+            index=models.Index(fields=['first_name', 'last_name'], name='author_name_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations
+
+CREATE_SQL = {
+    'postgresql': [
+        'CREATE TABLE libraryapp_booksearch (book_id integer PRIMARY KEY REFERENCES libraryapp_book (id) '
+        'ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, document tsvector NOT NULL)',
+        'CREATE INDEX libraryapp_booksearch_document_idx ON libraryapp_booksearch USING gin (document)',
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE libraryapp_booksearch USING fts5(title, authors, genre, text, tokenize='unicode61')",
+    ],
+}
+
+
+def create_search_table(apps, schema_editor):
+    for sql in CREATE_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor in CREATE_SQL:
+        schema_editor.execute('DROP TABLE IF EXISTS libraryapp_booksearch')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libraryapp', '0006_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:09
+
+from django.db import migrations, models
+
+FILL_SQL = {
+    # EXTERNAL keeps new texts uncompressed in TOAST so substr() only reads the chunks it needs
+    'postgresql': [
+        'UPDATE libraryapp_bookinstance SET text_length = char_length(text), text_size = octet_length(text)',
+        'ALTER TABLE libraryapp_bookinstance ALTER COLUMN text SET STORAGE EXTERNAL',
+    ],
+    'sqlite': [
+        'UPDATE libraryapp_bookinstance SET text_length = length(text), text_size = length(CAST(text AS BLOB))',
+    ],
+}
+
+
+def fill_text_sizes(apps, schema_editor):
+    for sql in FILL_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libraryapp', '0008_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookinstance',
+            name='text_br',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='bookinstance',
+            name='text_gzip',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='bookinstance',
+            name='text_length',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='bookinstance',
+            name='text_size',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_text_sizes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libraryapp', '0010_revokedtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookListing',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='listing', serialize=False, to='libraryapp.book')),
+                ('document', models.TextField()),
+            ],
+        ),
+    ]
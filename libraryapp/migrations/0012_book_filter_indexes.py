@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libraryapp', '0011_booklisting'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['status', 'id'], name='book_status_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['title', 'id'], name='book_title_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['title'], name='book_title_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['isbn'], name='book_isbn_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        # the books of an author or genre in id order, without a sort; the through tables are not declared models
+        migrations.RunSQL(
+            'CREATE INDEX book_authors_author_book_idx ON libraryapp_book_authors (author_id, book_id)',
+            'DROP INDEX book_authors_author_book_idx',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX book_genre_genre_book_idx ON libraryapp_book_genre (genre_id, book_id)',
+            'DROP INDEX book_genre_genre_book_idx',
+        ),
+    ]
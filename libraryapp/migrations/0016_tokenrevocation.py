@@ -0,0 +1,20 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libraryapp', '0015_listversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenRevocation',
+            fields=[
+                ('user_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('revoked_before', models.BigIntegerField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libraryapp', '0016_tokenrevocation'),
+    ]
+
+    # isbn's db_index already creates the same varchar_pattern_ops index on PostgreSQL, and
+    # book_status_id_idx serves every status lookup the single-column status index did
+    operations = [
+        migrations.RemoveIndex(
+            model_name='book',
+            name='book_isbn_prefix_idx',
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='status',
+            field=models.CharField(blank=True, choices=[('a', 'Available'), ('e', 'Expectation'), ('n_a', 'Not available')], default='n_a', max_length=3),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('libraryapp', '0017_drop_duplicate_book_indexes'),
+    ]
+
+    # registration checks emails with a query, this makes two concurrent registrations unable to share one;
+    # users created without an email (createsuperuser, the admin) keep an empty one
+    operations = [
+        migrations.RunSQL(
+            "CREATE UNIQUE INDEX auth_user_email_uniq ON auth_user (email) WHERE email <> ''",
+            'DROP INDEX auth_user_email_uniq',
+        ),
+    ]
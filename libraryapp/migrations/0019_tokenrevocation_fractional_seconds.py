@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libraryapp', '0018_user_email_unique'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tokenrevocation',
+            name='revoked_before',
+            field=models.FloatField(),
+        ),
+    ]
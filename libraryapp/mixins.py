@@ -0,0 +1,307 @@
+import hashlib
+from collections import OrderedDict
+
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from .cache import get_response_cache, list_key, list_state, object_key
+from .instrumentation import phase
+from .renderers import dumps
+from .routers import REPLICAS, pin_to_primary, pinned_to_primary, read_from_replica, reads_from
+from .serializers import eager_loading, restrict_fields, selected_fields
+from .throttling import StreamThrottle
+
+
+class InstrumentedMixin:
+    """Reports authentication, permission checks, serialization and rendering as separate Server-Timing phases."""
+
+    def perform_authentication(self, request):
+        with phase('auth'):
+            super().perform_authentication(request)
+
+    def check_permissions(self, request):
+        with phase('perm'):
+            super().check_permissions(request)
+
+    def check_object_permissions(self, request, obj):
+        with phase('perm'):
+            super().check_object_permissions(request, obj)
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        # .data and the streamed chunks all go through to_representation(); the queries it makes count as db
+        to_representation = serializer.to_representation
+
+        def timed_representation(*args, **kwargs):
+            with phase('serialize'):
+                return to_representation(*args, **kwargs)
+        serializer.to_representation = timed_representation
+        return serializer
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if isinstance(response, Response):
+            render = response.render
+
+            def timed_render():
+                with phase('render'):
+                    return render()
+            response.render = timed_render
+        return response
+
+
+class ReplicaReadMixin:
+    """Reads safe requests from a read replica unless the user wrote within the sticky window."""
+    replica_token = None
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # here rather than in finalize_response, which an unhandled exception skips
+            if self.replica_token is not None:
+                reads_from.reset(self.replica_token)
+                self.replica_token = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if REPLICAS and request.method in SAFE_METHODS and not pinned_to_primary(request):
+            self.replica_token = read_from_replica()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if REPLICAS and request.method not in SAFE_METHODS and response.status_code < 400:
+            pin_to_primary(request, response)
+        if self.replica_token is not None and response.streaming:
+            # the rows are read while the server sends the body, after the view has returned
+            alias = reads_from.get()
+            content = response.streaming_content
+
+            def replica_content():
+                # set rather than reset: an ASGI server may advance the iterator from another context
+                reads_from.set(alias)
+                try:
+                    yield from content
+                finally:
+                    reads_from.set(None)
+            response.streaming_content = replica_content()
+        return response
+
+
+class EagerLoadingMixin:
+    """Builds the view queryset with the joins required by the serializer's nested fields."""
+
+    def get_queryset(self):
+        return eager_loading(super().get_queryset(), self.get_serializer_class())
+
+
+class SparseFieldsMixin:
+    """Returns only the fields named by ?fields=id,title of each object.
+
+    Cached and precomputed representations are complete and are trimmed
+    here; StreamingListMixin serializes, and loads the relations of, just
+    the selected fields.
+    """
+    fields_selected = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS:
+            self.fields_selected = selected_fields(request, self.get_serializer_class())
+
+    def list(self, request, *args, **kwargs):
+        return self.trimmed(super().list(request, *args, **kwargs), many=True)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.trimmed(super().retrieve(request, *args, **kwargs), many=False)
+
+    def trimmed(self, response, many):
+        fields = self.fields_selected
+        if fields is None or not isinstance(response, Response) or response.status_code != 200:
+            return response
+        data = response.data
+        if not many:
+            response.data = {name: data[name] for name in fields}
+        elif isinstance(data, dict):
+            response.data = OrderedDict(data, results=[{name: row[name] for name in fields} for row in data['results']])
+        else:
+            response.data = [{name: row[name] for name in fields} for row in data]
+        return response
+
+
+class StreamingListMixin:
+    """Streams the whole list as a JSON array when called with ?stream=1.
+
+    Rows are read in keyset chunks ordered by primary key, so each chunk keeps
+    its select/prefetch joins and memory stays bounded by stream_chunk_size.
+    """
+    stream_chunk_size = 500
+    fields_selected = None
+
+    def get_throttles(self):
+        throttles = super().get_throttles()
+        if self.request.query_params.get('stream') in ('1', 'true'):
+            throttles.append(StreamThrottle())
+        return throttles
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('stream') not in ('1', 'true'):
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset()).order_by('pk')
+        if self.fields_selected is not None:
+            # only the joins of the selected fields
+            queryset = eager_loading(queryset.select_related(None).prefetch_related(None).defer(None),
+                                     self.get_serializer_class(), self.fields_selected)
+        response = StreamingHttpResponse(self.stream_rows(queryset), content_type='application/json')
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def stream_rows(self, queryset):
+        yield b'['
+        last_pk = None
+        first = True
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            chunk = list(chunk[:self.stream_chunk_size])
+            if not chunk:
+                break
+            serializer = self.get_serializer(chunk, many=True)
+            if self.fields_selected is not None:
+                restrict_fields(serializer, self.fields_selected)
+            for row in serializer.data:
+                yield (b'' if first else b',') + dumps(row)
+                first = False
+            last_pk = chunk[-1].pk
+        yield b']'
+
+
+class CachedRetrieveMixin:
+    """Serves the serialized object from the response cache.
+
+    The cache is shared by all users, so it is only suitable for views whose
+    permissions are checked at the view level, not per object.
+    """
+
+    def retrieve(self, request, *args, **kwargs):
+        model = self.get_queryset().model
+        key = object_key(model, kwargs[self.lookup_url_kwarg or self.lookup_field])
+        cache = get_response_cache()
+        data = cache.get(key)
+        if data is None:
+            data = self.get_serializer(self.get_object()).data
+            cache.set(key, data)
+        return Response(data)
+
+
+class CachedListMixin:
+    """Caches list pages as the ids they contain and builds them from per-object cached representations."""
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        cache = get_response_cache()
+        key = list_key(queryset.model, request)
+        page = cache.get(key)
+        if page is None:
+            ids, rows = self.page_rows(queryset)
+            cache.set_many({object_key(queryset.model, pk): row for pk, row in zip(ids, rows)})
+            page = {'ids': ids}
+            if self.paginator is not None:
+                page['next'] = self.paginator.get_next_link()
+                page['previous'] = self.paginator.get_previous_link()
+            cache.set(key, page)
+        else:
+            rows = self.cached_rows(queryset, page['ids'])
+        if 'next' not in page:
+            return Response(rows)
+        return Response(OrderedDict([('next', page['next']), ('previous', page['previous']), ('results', rows)]))
+
+    def cached_rows(self, queryset, ids):
+        cache = get_response_cache()
+        keys = [object_key(queryset.model, pk) for pk in ids]
+        found = cache.get_many(keys)
+        missing = [pk for pk, key in zip(ids, keys) if key not in found]
+        if missing:
+            fresh = {object_key(queryset.model, pk): row for pk, row in self.rows_by_pk(queryset, missing).items()}
+            cache.set_many(fresh)
+            found.update(fresh)
+        return [found[key] for key in keys if key in found]
+
+    def page_rows(self, queryset):
+        """The primary keys and representations of the requested page."""
+        objects = self.paginate_queryset(self.filter_queryset(queryset))
+        if objects is None:
+            objects = list(self.filter_queryset(queryset))
+        return [obj.pk for obj in objects], self.get_serializer(objects, many=True).data
+
+    def rows_by_pk(self, queryset, ids):
+        objects = list(queryset.in_bulk(ids).values())
+        return dict(zip([obj.pk for obj in objects], self.get_serializer(objects, many=True).data))
+
+
+class ReadModelListMixin:
+    """Builds the rows of CachedListMixin from precomputed representations instead of the joined objects.
+
+    read_rows(ids) returns the representations it has by primary key; the
+    other objects are serialized as usual. The page itself is selected by
+    primary key alone, without the joins of the view queryset.
+    """
+    read_rows = None
+
+    def page_rows(self, queryset):
+        # the ordering columns are loaded too, the paginator reads them for the cursor
+        keys = self.filter_queryset(queryset.select_related(None).prefetch_related(None)
+                                    .only('pk', *getattr(self, 'ordering_fields', ())))
+        objects = self.paginate_queryset(keys)
+        ids = [obj.pk for obj in (keys if objects is None else objects)]
+        rows = self.rows_by_pk(queryset, ids)
+        return [pk for pk in ids if pk in rows], [rows[pk] for pk in ids if pk in rows]
+
+    def rows_by_pk(self, queryset, ids):
+        rows = self.read_rows(ids)
+        missing = [pk for pk in ids if pk not in rows]
+        if missing:
+            rows.update(super().rows_by_pk(queryset, missing))
+        return rows
+
+
+class ConditionalGetMixin:
+    """ETag and Last-Modified validators, answering 304 before anything is serialized.
+
+    A detail validator reads only the object's updated_at. A list validator
+    is the list version of the table and the time it last moved, which every
+    change of a listed row moves; it is read once per request and shared
+    with the keys of the cached pages.
+    """
+    updated_field = 'updated_at'
+    # request headers that select a different body for the same URL
+    etag_headers = ()
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = {self.lookup_field: kwargs[self.lookup_url_kwarg or self.lookup_field]}
+        updated = self.get_queryset().filter(**lookup).values_list(self.updated_field, flat=True).first()
+        if updated is None:
+            return super().retrieve(request, *args, **kwargs)
+        return self.conditional_response(updated.timestamp(), super().retrieve, request, *args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        version, changed = list_state(self.get_queryset().model, request)
+        return self.conditional_response(changed, super().list, request, *args, version=version, **kwargs)
+
+    def conditional_response(self, last_modified, handler, request, *args, version='', **kwargs):
+        # the body differs per URL, renderer and, for /profile, user, so all of them are part of the strong ETag
+        etag = quote_etag(hashlib.md5(('%s|%s|%s|%.6f|%s|%s' % (
+            request.build_absolute_uri(), request.accepted_renderer.format, request.user.pk, last_modified, version,
+            '|'.join(request.META.get(header, '') for header in self.etag_headers),
+        )).encode()).hexdigest())
+        response = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(int(last_modified))
+        # the renderer is chosen from Accept, so shared caches must key on it as the ETag does
+        patch_vary_headers(response, ('Accept',) + tuple(
+            header[5:].replace('_', '-').title() for header in self.etag_headers if header.startswith('HTTP_')))
+        return response
@@ -1,39 +1,78 @@
 import uuid
 
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from .content import compress_text
+
 
 class Author(models.Model):
     first_name = models.CharField(max_length=128)
     last_name = models.CharField(max_length=128)
     birthday = models.DateField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['first_name', 'last_name'], name='author_name_idx'),
+        ]
 
     def __str__(self):
         return '%s, %s' % (self.last_name, self.first_name)
 
 
 class Genre(models.Model):
-    name = models.CharField(max_length=256)
+    name = models.CharField(max_length=256, unique=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.name
 
 
 class BookInstance(models.Model):
-    id_security = models.UUIDField(default=uuid.uuid4)
+    id_security = models.UUIDField(default=uuid.uuid4, unique=True)
     text = models.TextField()
+    text_length = models.PositiveIntegerField(default=0, editable=False)
+    text_size = models.PositiveIntegerField(default=0, editable=False)
+    text_gzip = models.BinaryField(null=True)
+    text_br = models.BinaryField(null=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    CONTENT_FIELDS = ('text', 'text_gzip', 'text_br')
 
     def __str__(self):
-        return self.text
+        return str(self.id_security)
+
+    def fill_content(self, compress=True):
+        """Computes the lengths and compressed copies of the text; save() does it, bulk_create() callers must.
+
+        With compress=False the copies are dropped rather than left stale.
+        """
+        self.text_length = len(self.text)
+        self.text_size = len(self.text.encode('utf-8'))
+        compressed = compress_text(self.text) if compress else {'text_gzip': None, 'text_br': None}
+        for field, value in compressed.items():
+            setattr(self, field, value)
+        self.compression_pending = not compress
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if 'text' not in self.get_deferred_fields() and (update_fields is None or 'text' in update_fields):
+            # compressing a long text at the highest levels takes seconds, the copies are made by a task
+            self.fill_content(compress=False)
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'text_length', 'text_size', 'text_gzip', 'text_br'}
+        super().save(*args, **kwargs)
 
 
 class Book(models.Model):
     title = models.CharField(max_length=256)
     authors = models.ManyToManyField(Author)
-    isbn = models.CharField('ISBN', max_length=17)
+    # on PostgreSQL db_index also adds the varchar_pattern_ops index that ?isbn= prefixes use
+    isbn = models.CharField('ISBN', max_length=17, db_index=True)
     genre = models.ManyToManyField(Genre)
     id_inst = models.OneToOneField(BookInstance, on_delete=models.CASCADE, blank=True, null=True)
 
@@ -43,12 +82,29 @@ class Book(models.Model):
         ('n_a', 'Not available')
     )
 
+    # looked up through book_status_id_idx, which starts with it
     status = models.CharField(max_length=3, choices=BOOK_STATUS, blank=True, default='n_a')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='book_status_id_idx'),
+            models.Index(fields=['title', 'id'], name='book_title_id_idx'),
+            # LIKE 'prefix%' can only use an index with the pattern operator class on PostgreSQL
+            models.Index(fields=['title'], name='book_title_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ]
 
     def __str__(self):
         return self.title
 
 
+class BookListing(models.Model):
+    """Rendered representation of a book for the catalogue listing, maintained by libraryapp.listing."""
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, primary_key=True, related_name='listing')
+    # JSON text rather than a JSONField: jsonb would reorder the keys of the representation
+    document = models.TextField()
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     location = models.TextField(blank=True, null=True)
@@ -62,9 +118,92 @@ class UserProfile(models.Model):
         if created:
             UserProfile.objects.create(user=instance)
 
-    @receiver(post_save, sender=User)
-    def save_user_profile(sender, instance, **kwargs):
-        instance.profile.save()
-
     def __str__(self):
         return self.user.username
+
+
+class Loan(models.Model):
+    """A reader holding a book; libraryapp.loans keeps Book.status in step with the open loans."""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='loans')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='loans')
+    created_at = models.DateTimeField(auto_now_add=True)
+    due_at = models.DateTimeField()
+    returned_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # the last line of defence against two checkouts of one copy
+            models.UniqueConstraint(fields=['book'], condition=models.Q(returned_at__isnull=True),
+                                    name='loan_one_open_per_book'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'returned_at'], name='loan_user_open_idx'),
+        ]
+
+
+class Reservation(models.Model):
+    """A place in the waitlist of a checked out book, served in id order."""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='reservations')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reservations')
+    created_at = models.DateTimeField(auto_now_add=True)
+    # set when the book is lent to the user or the user leaves the queue
+    closed_at = models.DateTimeField(null=True, blank=True)
+    loan = models.OneToOneField(Loan, on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'user'], condition=models.Q(closed_at__isnull=True),
+                                    name='reservation_one_open_per_user'),
+        ]
+        indexes = [
+            models.Index(fields=['book', 'closed_at', 'id'], name='reservation_queue_idx'),
+        ]
+
+
+class RevokedToken(models.Model):
+    """Refresh tokens that were rotated or logged out, by a hash of their jti, until they expire."""
+    jti_hash = models.CharField(max_length=32, primary_key=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+
+class TokenRevocation(models.Model):
+    """Tokens of the user issued before revoked_before (epoch seconds) are rejected; kept for deleted users too."""
+    user_id = models.IntegerField(primary_key=True)
+    revoked_before = models.FloatField()
+
+
+class Task(models.Model):
+    """A call of a background task, see libraryapp/tasks.py."""
+    TASK_STATUS = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list)
+    # callers that may submit the same work twice pass a key; the second delay() returns the first task
+    key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=8, choices=TASK_STATUS, default='queued')
+    run_at = models.DateTimeField(default=timezone.now)
+    # the lease of the worker running it; expired leases are claimed again
+    locked_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    result = models.JSONField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='task_due_idx'),
+            models.Index(fields=['status', 'finished_at'], name='task_finished_idx'),
+        ]
+
+
+class ListVersion(models.Model):
+    """Version of the lists of a table, moved by every change of which rows they hold, see libraryapp/cache.py."""
+    table = models.CharField(max_length=100, primary_key=True)
+    version = models.PositiveBigIntegerField(default=0)
+    changed_at = models.DateTimeField(default=timezone.now)
@@ -0,0 +1,147 @@
+"""Load shedding: refuses low-priority requests while this process is overloaded.
+
+The process counts as overloaded while more than MAX_IN_FLIGHT requests
+are being served at once, while the moving average of response times is
+above MAX_LATENCY_SECONDS (requests matching UNTIMED, which take long by
+design, are left out of it), or, behind a proxy that sets X-Request-Start,
+when a request waited in the queue longer than MAX_QUEUE_SECONDS. Requests
+matching LOW_PRIORITY, and anonymous catalogue reads with
+SHED_ANONYMOUS_READS, then get a 503 with Retry-After right away, so
+sign-ins, loans and the reads of signed-in readers keep their latency.
+The average decays while no request completes, so shedding cannot keep
+itself going.
+"""
+import asyncio
+import json
+import math
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from .instrumentation import prometheus_client
+
+OVERLOAD = getattr(settings, 'OVERLOAD', {})
+MAX_IN_FLIGHT = OVERLOAD.get('MAX_IN_FLIGHT', 64)
+MAX_LATENCY_SECONDS = OVERLOAD.get('MAX_LATENCY_SECONDS', 2.0)
+MAX_QUEUE_SECONDS = OVERLOAD.get('MAX_QUEUE_SECONDS', 1.0)
+LATENCY_DECAY_SECONDS = OVERLOAD.get('LATENCY_DECAY_SECONDS', 10)
+RETRY_AFTER = OVERLOAD.get('RETRY_AFTER', 5)
+LOW_PRIORITY = [re.compile(pattern) for pattern in OVERLOAD.get('LOW_PRIORITY', ())]
+UNTIMED = [re.compile(pattern) for pattern in OVERLOAD.get('UNTIMED', ())]
+SHED_ANONYMOUS_READS = OVERLOAD.get('SHED_ANONYMOUS_READS', True)
+# weight of the latest response time in the moving average
+SMOOTHING = 0.1
+
+if prometheus_client is not None:
+    SHED = prometheus_client.Counter('library_requests_shed', 'Requests refused with 503 under overload, by cause.',
+                                     ['cause'])
+
+
+class LoadState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.latency = 0.0
+        self.updated = time.monotonic()
+
+    def started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finished(self, seconds=None):
+        """Ends a request; seconds is None for one that stays out of the average."""
+        with self.lock:
+            self.in_flight -= 1
+            if seconds is not None:
+                self.latency = self.current_latency() * (1 - SMOOTHING) + seconds * SMOOTHING
+                self.updated = time.monotonic()
+
+    def current_latency(self):
+        return self.latency * math.exp(-(time.monotonic() - self.updated) / LATENCY_DECAY_SECONDS)
+
+
+state = LoadState()
+
+
+def queue_seconds(request):
+    """Time since the proxy received the request, from X-Request-Start: t=<seconds, milli- or microseconds>."""
+    value = request.META.get('HTTP_X_REQUEST_START', '')
+    try:
+        started = float(value[2:] if value.startswith('t=') else value)
+    except ValueError:
+        return 0.0
+    while started > 1e11:
+        started /= 1000
+    return max(time.time() - started, 0.0)
+
+
+def timed(request):
+    path = request.get_full_path()
+    return not any(pattern.search(path) for pattern in UNTIMED)
+
+
+def low_priority(request):
+    path = request.get_full_path()
+    if any(pattern.search(path) for pattern in LOW_PRIORITY):
+        return True
+    return (SHED_ANONYMOUS_READS and request.method in ('GET', 'HEAD') and path.startswith('/api/')
+            and 'HTTP_AUTHORIZATION' not in request.META)
+
+
+def overload_cause(request, in_flight):
+    if in_flight > MAX_IN_FLIGHT:
+        return 'in_flight'
+    if state.current_latency() > MAX_LATENCY_SECONDS:
+        return 'latency'
+    if queue_seconds(request) > MAX_QUEUE_SECONDS:
+        return 'queue'
+    return None
+
+
+class LoadSheddingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        response = self.shed(request)
+        if response is not None:
+            return response
+        state.started()
+        started = time.perf_counter()
+        try:
+            return self.get_response(request)
+        finally:
+            state.finished(time.perf_counter() - started if timed(request) else None)
+
+    async def __acall__(self, request):
+        response = self.shed(request)
+        if response is not None:
+            return response
+        state.started()
+        started = time.perf_counter()
+        try:
+            return await self.get_response(request)
+        finally:
+            state.finished(time.perf_counter() - started if timed(request) else None)
+
+    def shed(self, request):
+        """The 503 for a low-priority request while the process is overloaded, otherwise None."""
+        cause = overload_cause(request, state.in_flight + 1)
+        if cause is None or not low_priority(request):
+            return None
+        if prometheus_client is not None:
+            SHED.labels(cause).inc()
+        response = HttpResponse(json.dumps({'detail': 'The server is busy, try again shortly.'}),
+                                status=503, content_type='application/json')
+        response['Retry-After'] = str(RETRY_AFTER)
+        return response
@@ -0,0 +1,69 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import check_password, make_password
+from django.contrib.auth.models import User
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+PASSWORD_HASHING = getattr(settings, 'PASSWORD_HASHING', {})
+WORKERS = PASSWORD_HASHING.get('WORKERS', 2)
+# hashes waiting for a worker; requests beyond that are turned away instead of piling up
+QUEUE = PASSWORD_HASHING.get('QUEUE', 32)
+QUEUE_TIMEOUT = PASSWORD_HASHING.get('QUEUE_TIMEOUT', 2)
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='password-hashing')
+_slots = threading.BoundedSemaphore(WORKERS + QUEUE)
+
+
+class HashingBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many sign-ins in progress, try again shortly.'
+    default_code = 'hashing_busy'
+
+
+def run_hashing(func, *args):
+    """Runs func in the hashing pool, so at most WORKERS hashes use the CPU at once."""
+    if not _slots.acquire(timeout=QUEUE_TIMEOUT):
+        raise HashingBusy()
+    try:
+        return _executor.submit(func, *args).result()
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    return run_hashing(make_password, password)
+
+
+def verify_and_rehash(password, encoded):
+    """Returns (valid, new_encoded); new_encoded is set when the stored hash is outdated."""
+    upgraded = []
+    valid = check_password(password, encoded, setter=lambda raw: upgraded.append(make_password(raw)))
+    return valid, upgraded[0] if upgraded else None
+
+
+class PooledModelBackend(ModelBackend):
+    """ModelBackend that checks passwords in the hashing pool and upgrades outdated hashes."""
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(User.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = User._default_manager.get_by_natural_key(username)
+        except User.DoesNotExist:
+            # hash anyway, so unknown usernames take as long as wrong passwords
+            hash_password(password)
+            return None
+        valid, upgraded = run_hashing(verify_and_rehash, password, user.password)
+        if not valid or not self.user_can_authenticate(user):
+            return None
+        if upgraded:
+            # a plain update: the password did not change, so no save signals and no token revocation
+            User._default_manager.filter(pk=user.pk, password=user.password).update(password=upgraded)
+            user.password = upgraded
+        return user
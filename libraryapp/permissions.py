@@ -1,15 +1,31 @@
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 
+from .authentication import ClaimsUser
+
 
 class IsOwnerProfileOrReadOnly(BasePermission):
     def has_object_permission(self, request, view, obj):
         if request.method in SAFE_METHODS:
             return True
-        return obj.user == request.user
+        return obj.user_id == request.user.pk
 
 class IsReaderOrAdmin(BasePermission):
     def has_permission(self, request, view):
         if (request.method in SAFE_METHODS and request.user.is_staff == False) or request.user.is_staff == True:
             return True
         else:
-            return False
\ No newline at end of file
+            return False
+
+
+class IsReader(BasePermission):
+    """Users whose profile is_reader flag is set, read from the token claims when the user came from them."""
+
+    def has_permission(self, request, view):
+        user = request.user
+        if not user.is_authenticated:
+            return False
+        if isinstance(user, ClaimsUser):
+            return user.is_reader
+        # a missing profile raises RelatedObjectDoesNotExist, an AttributeError
+        profile = getattr(user, 'profile', None)
+        return profile is not None and profile.is_reader
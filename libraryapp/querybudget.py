@@ -0,0 +1,39 @@
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def query_budget(max_queries, using=DEFAULT_DB_ALIAS):
+    """Fail when the wrapped block runs more than max_queries queries."""
+    context = CaptureQueriesContext(connections[using])
+    with context:
+        yield context
+    if len(context) > max_queries:
+        queries = '\n'.join(query['sql'] for query in context.captured_queries)
+        raise QueryBudgetExceeded('%d queries executed, budget is %d:\n%s' % (len(context), max_queries, queries))
+
+
+def count_queries(func, using=DEFAULT_DB_ALIAS):
+    context = CaptureQueriesContext(connections[using])
+    with context:
+        func()
+    return len(context)
+
+
+def assert_queries_constant(populate, request, sizes=(1, 10), using=DEFAULT_DB_ALIAS):
+    """Fail when the number of queries made by request() grows with the number of rows created by populate(n)."""
+    counts = []
+    created = 0
+    for size in sizes:
+        populate(size - created)
+        created = size
+        counts.append(count_queries(request, using))
+    if len(set(counts)) > 1:
+        raise QueryBudgetExceeded('query count grows with N: %s' % dict(zip(sizes, counts)))
+    return counts[0]
@@ -0,0 +1,61 @@
+"""Faster renderers: orjson for JSON and, for Accept: application/msgpack, MessagePack.
+
+Both produce the same values as DRF's JSONRenderer: the types orjson and
+msgpack do not know (Decimal, lazy strings, querysets...) go through DRF's
+JSONEncoder.default, and datetimes end in Z like DRF's. Without orjson the
+JSON renderer is DRF's own.
+"""
+import json
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+encoder = JSONEncoder(ensure_ascii=False)
+
+
+def dumps(data):
+    """Compact UTF-8 JSON of an API representation, as bytes."""
+    if orjson is None:
+        return encoder.encode(data).encode('utf-8')
+    return orjson.dumps(data, default=encoder.default, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+
+
+def loads(data):
+    return json.loads(data) if orjson is None else orjson.loads(data)
+
+
+def msgpack_default(obj):
+    # the JSON form of the value, e.g. a str for UUID, date and datetime
+    return json.loads(encoder.encode(obj))
+
+
+class ORJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # an indented body (the browsable API, ?indent=) is rare and left to DRF
+        if orjson is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+        return dumps(data)
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=msgpack_default, use_bin_type=True)
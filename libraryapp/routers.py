@@ -0,0 +1,152 @@
+"""Routing of catalogue reads to the read replicas.
+
+Only the safe requests of the views with ReplicaReadMixin read from a
+replica; everything else, including the rest of a request that wrote, uses
+the primary. After a successful write through one of those views the user
+stays on the primary for STICKY_SECONDS, so they read their own writes even
+while the replicas lag behind. The end of that window is kept under the
+user id in CACHE_ALIAS, which must be seen by every worker, and is also
+returned in the primary_until cookie and the X-Primary-Until header, which
+clients without cookies can send back.
+"""
+import contextvars
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+READ_REPLICAS = getattr(settings, 'READ_REPLICAS', {})
+REPLICAS = tuple(READ_REPLICAS.get('ALIASES', ()))
+MAX_LAG_SECONDS = READ_REPLICAS.get('MAX_LAG_SECONDS', 5)
+CHECK_INTERVAL = READ_REPLICAS.get('CHECK_INTERVAL', 5)
+STICKY_SECONDS = READ_REPLICAS.get('STICKY_SECONDS', 10)
+STICKY_COOKIE = 'primary_until'
+STICKY_HEADER = 'X-Primary-Until'
+
+# the replica the current request reads from, None for the primary
+reads_from = contextvars.ContextVar('reads_from', default=None)
+# alias: (checked at, usable), per process
+_health = {}
+_health_lock = threading.Lock()
+
+LAG_SQL = ("SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+           "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END")
+
+
+def replica_lag(alias):
+    """Seconds the replica is behind the primary; databases other than PostgreSQL are never behind."""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        connection.ensure_connection()
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(LAG_SQL)
+        return float(cursor.fetchone()[0])
+
+
+def check_replica(alias):
+    try:
+        usable = replica_lag(alias) <= MAX_LAG_SECONDS
+    except DatabaseError:
+        connections[alias].close()
+        usable = False
+    _health[alias] = (time.monotonic(), usable)
+    return usable
+
+
+def mark_unusable(alias):
+    _health[alias] = (time.monotonic(), False)
+
+
+def usable_replicas():
+    now = time.monotonic()
+    usable = []
+    for alias in REPLICAS:
+        checked_at, ok = _health.get(alias, (None, False))
+        if checked_at is None or now - checked_at >= CHECK_INTERVAL:
+            # one thread checks, the others keep the previous answer meanwhile
+            if _health_lock.acquire(blocking=False):
+                try:
+                    ok = check_replica(alias)
+                finally:
+                    _health_lock.release()
+        if ok:
+            usable.append(alias)
+    return usable
+
+
+def failover_on_error(execute, sql, params, many, context):
+    """Execute wrapper of the replica connections: a replica that fails is not used until it is checked again."""
+    try:
+        return execute(sql, params, many, context)
+    except DatabaseError:
+        mark_unusable(context['connection'].alias)
+        raise
+
+
+def install_failover_wrapper(sender, connection, **kwargs):
+    if connection.alias in REPLICAS and failover_on_error not in connection.execute_wrappers:
+        connection.execute_wrappers.append(failover_on_error)
+
+
+def sticky_key(user_id):
+    return 'db:primary-until:%s' % user_id
+
+
+def sticky_until(value, now):
+    """The end of the window a client sent back; ones further away than STICKY_SECONDS were not issued here."""
+    try:
+        until = float(value or 0)
+    except ValueError:
+        return 0
+    return until if until <= now + STICKY_SECONDS else 0
+
+
+def pinned_to_primary(request):
+    now = time.time()
+    if sticky_until(request.COOKIES.get(STICKY_COOKIE), now) > now:
+        return True
+    if sticky_until(request.META.get('HTTP_' + STICKY_HEADER.upper().replace('-', '_')), now) > now:
+        return True
+    user_id = getattr(request.user, 'pk', None)
+    return user_id is not None and caches[READ_REPLICAS.get('CACHE_ALIAS', 'shared')].get(sticky_key(user_id), 0) > now
+
+
+def pin_to_primary(request, response):
+    until = time.time() + STICKY_SECONDS
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        caches[READ_REPLICAS.get('CACHE_ALIAS', 'shared')].set(sticky_key(user.pk), until, STICKY_SECONDS)
+    response.set_cookie(STICKY_COOKIE, '%.3f' % until, max_age=STICKY_SECONDS, httponly=True, samesite='Lax')
+    response[STICKY_HEADER] = '%.3f' % until
+
+
+def read_from_replica():
+    """Sends the reads of the current request to a usable replica; returns the token for reads_from.reset()."""
+    replicas = usable_replicas()
+    return reads_from.set(random.choice(replicas) if replicas else None)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return reads_from.get() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # the request reads its own write from now on
+        if reads_from.get() is not None:
+            reads_from.set(None)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = (DEFAULT_DB_ALIAS,) + REPLICAS
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema through replication
+        return False if db in REPLICAS else None
+
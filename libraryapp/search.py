@@ -0,0 +1,180 @@
+import threading
+
+from django.conf import settings
+from django.db import connection, connections, router, transaction
+from django.utils.html import escape
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .models import Book
+from .tasks import task
+
+SEARCH_TABLE = 'libraryapp_booksearch'
+# tsvector values are limited to 1MB, so only the beginning of a long text is indexed
+TEXT_LIMIT = 200000
+SNIPPET_LIMIT = 20000
+INDEX_BATCH_SIZE = 200
+# the backends mark matches with these; mark_up() turns them into <b> after escaping the text around them
+START_MATCH, STOP_MATCH = '\x02', '\x03'
+
+
+class SearchUnavailable(APIException):
+    status_code = status.HTTP_501_NOT_IMPLEMENTED
+    default_detail = 'Full-text search is not available on this database.'
+    default_code = 'search_unavailable'
+
+
+def mark_up(fragment):
+    """HTML of a highlighted title or snippet: the book's own text is escaped, only the match markers become tags."""
+    if fragment is None:
+        return fragment
+    return escape(fragment).replace(START_MATCH, '<b>').replace(STOP_MATCH, '</b>')
+
+
+class PostgresSearchBackend:
+    """Weighted tsvector per book in a side table with a GIN index."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.config = getattr(settings, 'SEARCH_CONFIG', 'russian')
+
+    def index(self, rows):
+        sql = ('INSERT INTO {table} (book_id, document) VALUES (%s, '
+               "setweight(to_tsvector(%s::regconfig, %s), 'A') || setweight(to_tsvector(%s::regconfig, %s), 'B') || "
+               "setweight(to_tsvector(%s::regconfig, %s), 'C') || setweight(to_tsvector(%s::regconfig, %s), 'D')) "
+               'ON CONFLICT (book_id) DO UPDATE SET document = EXCLUDED.document').format(table=SEARCH_TABLE)
+        params = [(pk, self.config, title, self.config, authors, self.config, genre, self.config, text)
+                  for pk, title, authors, genre, text in rows]
+        with self.connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+
+    def delete(self, book_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE book_id = ANY(%%s)' % SEARCH_TABLE, [list(book_ids)])
+
+    def search(self, query, limit, offset):
+        sql = '''
+            WITH hits AS (
+                SELECT s.book_id, ts_rank_cd(s.document, q) AS rank, q
+                FROM {table} s, websearch_to_tsquery(%s::regconfig, %s) q
+                WHERE s.document @@ q
+                ORDER BY rank DESC, s.book_id
+                LIMIT %s OFFSET %s
+            )
+            SELECT hits.book_id, hits.rank,
+                   ts_headline(%s::regconfig, b.title, hits.q, %s),
+                   ts_headline(%s::regconfig, left(coalesce(i.text, ''), %s), hits.q, %s)
+            FROM hits
+            JOIN libraryapp_book b ON b.id = hits.book_id
+            LEFT JOIN libraryapp_bookinstance i ON i.id = b.id_inst_id
+            ORDER BY hits.rank DESC, hits.book_id
+        '''.format(table=SEARCH_TABLE)
+        markers = 'StartSel=%s, StopSel=%s' % (START_MATCH, STOP_MATCH)
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, [self.config, query, limit, offset, self.config, 'HighlightAll=true, ' + markers,
+                                 self.config, SNIPPET_LIMIT, 'MaxFragments=2, ' + markers])
+            return cursor.fetchall()
+
+
+class SqliteSearchBackend:
+    """FTS5 virtual table keyed by book id, used for local development and tests."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def index(self, rows):
+        with self.connection.cursor() as cursor:
+            self.delete([row[0] for row in rows])
+            cursor.executemany('INSERT INTO %s (rowid, title, authors, genre, text) VALUES (%%s, %%s, %%s, %%s, %%s)'
+                               % SEARCH_TABLE, rows)
+
+    def delete(self, book_ids):
+        book_ids = list(book_ids)
+        if not book_ids:
+            return
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' % (SEARCH_TABLE, ', '.join(['%s'] * len(book_ids))),
+                           book_ids)
+
+    def search(self, query, limit, offset):
+        terms = ' '.join('"%s"' % term.replace('"', '""') for term in query.split())
+        sql = '''
+            SELECT rowid, -bm25({table}, 10.0, 5.0, 2.0, 1.0) AS rank,
+                   highlight({table}, 0, %s, %s),
+                   snippet({table}, 3, %s, %s, '...', 32)
+            FROM {table}
+            WHERE {table} MATCH %s
+            ORDER BY bm25({table}, 10.0, 5.0, 2.0, 1.0), rowid
+            LIMIT %s OFFSET %s
+        '''.format(table=SEARCH_TABLE)
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, [START_MATCH, STOP_MATCH, START_MATCH, STOP_MATCH, terms, limit, offset])
+            return cursor.fetchall()
+
+
+BACKENDS = {
+    'postgresql': PostgresSearchBackend,
+    'sqlite': SqliteSearchBackend,
+}
+
+
+def get_backend(using=connection):
+    try:
+        return BACKENDS[using.vendor](using)
+    except KeyError:
+        raise SearchUnavailable('Full-text search is not supported on %s.' % using.vendor)
+
+
+def document_rows(books):
+    for book in books:
+        text = book.id_inst.text[:TEXT_LIMIT] if book.id_inst else ''
+        yield (book.pk, book.title,
+               ' '.join('%s %s' % (author.first_name, author.last_name) for author in book.authors.all()),
+               ' '.join(genre.name for genre in book.genre.all()),
+               text)
+
+
+def index_books(book_ids):
+    """Rebuilds the search documents of the given books; missing books are removed from the index."""
+    backend = get_backend()
+    book_ids = sorted(set(book_ids))
+    for start in range(0, len(book_ids), INDEX_BATCH_SIZE):
+        batch = book_ids[start:start + INDEX_BATCH_SIZE]
+        books = (Book.objects.filter(pk__in=batch).select_related('id_inst')
+                 .only('id', 'title', 'id_inst__text').prefetch_related('authors', 'genre'))
+        rows = list(document_rows(books))
+        found = {row[0] for row in rows}
+        if rows:
+            backend.index(rows)
+        if len(found) < len(batch):
+            backend.delete([pk for pk in batch if pk not in found])
+
+
+def search_books(query, limit, offset=0):
+    """(book id, rank, title HTML, snippet HTML) of the matching books, best first."""
+    hits = get_backend(connections[router.db_for_read(Book)]).search(query, limit, offset)
+    return [(book_id, rank, mark_up(title), mark_up(snippet)) for book_id, rank, title, snippet in hits]
+
+
+_pending = threading.local()
+
+
+@task
+def reindex_books(book_ids):
+    index_books(book_ids)
+
+
+def schedule_reindex(book_ids):
+    """Queues a reindex of the books once the current transaction commits; repeated requests for a book are merged."""
+    if connection.vendor not in BACKENDS:
+        return
+    if getattr(_pending, 'book_ids', None) is None:
+        _pending.book_ids = set()
+    _pending.book_ids.update(book_ids)
+    transaction.on_commit(flush_reindex)
+
+
+def flush_reindex():
+    book_ids, _pending.book_ids = _pending.book_ids, set()
+    if book_ids:
+        reindex_books.delay(sorted(book_ids))
@@ -0,0 +1,167 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .authentication import forget_user, revoke_user_tokens
+from .cache import expire_lists, invalidate
+from .compression import schedule_compression
+from .filters import LISTED_FIELDS
+from .listing import schedule_refresh
+from .models import Author, Book, BookInstance, Genre, UserProfile
+from .search import schedule_reindex
+
+
+def book_changed(book_ids):
+    """Updates the search document and the listing row of the books after the transaction commits."""
+    book_ids = list(book_ids)
+    schedule_reindex(book_ids)
+    schedule_refresh(book_ids)
+
+
+def touch_books(book_ids):
+    """Bumps updated_at of books whose representation changed through a related row, which reorders the lists."""
+    if Book.objects.filter(pk__in=book_ids).update(updated_at=timezone.now()):
+        expire_lists(Book)
+
+
+def related_books_changed(book_ids, membership=False):
+    """Reindexes, drops the cached rows of and touches books whose author, genre or instance changed.
+
+    The ids are read once here for all three.
+    """
+    book_ids = list(book_ids)
+    book_changed(book_ids)
+    invalidate(Book, book_ids, membership=membership)
+    touch_books(book_ids)
+
+
+@receiver(post_save, sender=Book)
+def reindex_book(sender, instance, **kwargs):
+    book_changed([instance.pk])
+
+
+@receiver(post_delete, sender=Book)
+def unindex_book(sender, instance, **kwargs):
+    book_changed([instance.pk])
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.genre.through)
+def book_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    # the lists filter on authors and genres, so the books may have moved between them
+    if not reverse:
+        related_books_changed([instance.pk], membership=True)
+    elif action == 'pre_clear':
+        related_books_changed(instance.book_set.values_list('pk', flat=True), membership=True)
+    elif pk_set:
+        related_books_changed(pk_set, membership=True)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+def invalidate_saved(sender, instance, created, **kwargs):
+    # any change moves the list version, which the list validators are built from
+    invalidate(sender, [instance.pk], membership=True)
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+def relation_saved(sender, instance, created, **kwargs):
+    if not created:
+        related_books_changed(instance.book_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Genre)
+def relation_deleted(sender, instance, **kwargs):
+    related_books_changed(instance.book_set.values_list('pk', flat=True), membership=True)
+
+
+@receiver(post_save, sender=Book)
+def expire_moved_book_lists(sender, instance, update_fields, **kwargs):
+    # a save moves updated_at unless update_fields leaves it out
+    if update_fields is None or LISTED_FIELDS.intersection(update_fields):
+        expire_lists(Book)
+
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+def invalidate_deleted(sender, instance, **kwargs):
+    invalidate(sender, [instance.pk], membership=True)
+
+
+@receiver(post_save, sender=BookInstance)
+def instance_saved(sender, instance, created, **kwargs):
+    book_ids = Book.objects.filter(id_inst_id=instance.pk).values_list('pk', flat=True)
+    if created:
+        invalidate(Book, book_ids)
+    else:
+        related_books_changed(book_ids)
+
+
+@receiver(post_delete, sender=BookInstance)
+def invalidate_instance_book(sender, instance, **kwargs):
+    invalidate(Book, Book.objects.filter(id_inst_id=instance.pk).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=BookInstance)
+@receiver(post_delete, sender=BookInstance)
+def expire_instance_lists(sender, instance, **kwargs):
+    expire_lists(BookInstance)
+
+
+@receiver(post_save, sender=BookInstance)
+def compress_instance(sender, instance, **kwargs):
+    if getattr(instance, 'compression_pending', False):
+        instance.compression_pending = False
+        schedule_compression(instance.pk)
+
+
+# fields copied into the token claims or deciding whether a token may be used at all
+USER_CLAIM_FIELDS = ('username', 'is_staff', 'is_superuser', 'is_active', 'password')
+PROFILE_CLAIM_FIELDS = ('is_reader',)
+
+
+def fields_changed(sender, instance, fields, update_fields):
+    if instance.pk is None:
+        return False
+    if update_fields is not None:
+        fields = [field for field in fields if field in update_fields]
+        if not fields:
+            return False
+    stored = sender.objects.filter(pk=instance.pk).values(*fields).first()
+    return stored is not None and any(stored[field] != getattr(instance, field) for field in fields)
+
+
+@receiver(pre_save, sender=User)
+def revoke_changed_user(sender, instance, update_fields, **kwargs):
+    if fields_changed(sender, instance, USER_CLAIM_FIELDS, update_fields):
+        user_id = instance.pk
+        transaction.on_commit(lambda: revoke_user_tokens(user_id))
+
+
+@receiver(pre_save, sender=UserProfile)
+def revoke_changed_profile(sender, instance, update_fields, **kwargs):
+    if fields_changed(sender, instance, PROFILE_CLAIM_FIELDS, update_fields):
+        user_id = instance.user_id
+        transaction.on_commit(lambda: revoke_user_tokens(user_id))
+
+
+@receiver(post_delete, sender=User)
+def revoke_deleted_user(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: revoke_user_tokens(user_id))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=UserProfile)
+def forget_saved_user(sender, instance, **kwargs):
+    user_id = instance.pk if sender is User else instance.user_id
+    forget_user(user_id)
+    transaction.on_commit(lambda: forget_user(user_id))
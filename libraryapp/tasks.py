@@ -0,0 +1,130 @@
+"""Background tasks kept in the database and run by manage.py runworker.
+
+A task is a module-level function decorated with @task; func.delay(*args)
+stores a Task row naming it by its dotted path, and a worker process
+claims the row, imports the function and calls it with the JSON
+arguments. Failures are retried with exponential backoff up to
+max_attempts. A worker that dies leaves its task to be claimed again when
+the lease runs out, so a task may run more than once and must be
+idempotent. An idempotency key makes delay() return the existing task
+instead of adding another one.
+
+With TASKS['BACKEND'] = 'immediate' the task runs inside delay() instead,
+which needs no worker; a countdown is not waited for there, as nothing
+would claim the task later.
+"""
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Task
+
+TASKS = getattr(settings, 'TASKS', {})
+BACKEND = TASKS.get('BACKEND', 'database')
+LEASE_SECONDS = TASKS.get('LEASE_SECONDS', 300)
+MAX_ATTEMPTS = TASKS.get('MAX_ATTEMPTS', 5)
+BACKOFF_SECONDS = TASKS.get('BACKOFF_SECONDS', 10)
+MAX_BACKOFF_SECONDS = TASKS.get('MAX_BACKOFF_SECONDS', 3600)
+CLAIM_BATCH = 10
+
+logger = logging.getLogger('libraryapp.tasks')
+
+
+def task(func=None, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF_SECONDS):
+    """Marks a module-level function as a task and gives it delay()."""
+    def decorate(func):
+        func.task_name = '%s.%s' % (func.__module__, func.__qualname__)
+        func.max_attempts = max_attempts
+        func.backoff = backoff
+        func.delay = lambda *args, key=None, countdown=0: enqueue(func, args, key=key, countdown=countdown)
+        return func
+    return decorate(func) if func is not None else decorate
+
+
+def enqueue(func, args, key=None, countdown=0):
+    if BACKEND == 'immediate':
+        countdown = 0
+    try:
+        with transaction.atomic():
+            queued = Task.objects.create(name=func.task_name, args=list(args), key=key, max_attempts=func.max_attempts,
+                                         run_at=timezone.now() + timedelta(seconds=countdown))
+    except IntegrityError:
+        if key is None:
+            raise
+        return Task.objects.get(key=key)
+    if BACKEND == 'immediate':
+        claimed = claim(queued.pk)
+        if claimed is not None:
+            execute(claimed)
+            queued.refresh_from_db()
+    return queued
+
+
+def due(now):
+    # a running task whose lease ran out belongs to a worker that died
+    return Q(status='queued', run_at__lte=now) | Q(status='running', locked_until__lt=now)
+
+
+def claim(pk=None):
+    """Takes a due task (or the given one) for this worker; a conditional update, so each claim has one winner."""
+    now = timezone.now()
+    candidates = Task.objects.filter(due(now))
+    if pk is not None:
+        candidates = candidates.filter(pk=pk)
+    for row in candidates.order_by('run_at', 'pk').values('pk', 'status', 'locked_until')[:CLAIM_BATCH]:
+        locked_until = now + timedelta(seconds=LEASE_SECONDS)
+        if Task.objects.filter(**row).update(status='running', locked_until=locked_until, attempts=F('attempts') + 1):
+            return Task.objects.get(pk=row['pk'])
+    return None
+
+
+def backoff_seconds(func, attempts):
+    base = getattr(func, 'backoff', BACKOFF_SECONDS)
+    # full jitter keeps retries of tasks that failed together from arriving together
+    return random.uniform(0, min(base * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS))
+
+
+def execute(claimed):
+    """Runs a claimed task and records the outcome, unless its lease was taken over meanwhile."""
+    mine = Task.objects.filter(pk=claimed.pk, status='running', locked_until=claimed.locked_until)
+    func = None
+    try:
+        func = import_string(claimed.name)
+        result = func(*claimed.args)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        if func is not None and claimed.attempts < claimed.max_attempts:
+            retry_at = timezone.now() + timedelta(seconds=backoff_seconds(func, claimed.attempts))
+            mine.update(status='queued', run_at=retry_at, locked_until=None, last_error=error)
+            logger.warning('task %s (%s) failed, attempt %d of %d: %s', claimed.pk, claimed.name, claimed.attempts,
+                           claimed.max_attempts, error)
+        else:
+            mine.update(status='failed', locked_until=None, last_error=error, finished_at=timezone.now())
+            logger.exception('task %s (%s) failed for good', claimed.pk, claimed.name)
+        return False
+    mine.update(status='done', locked_until=None, result=result, finished_at=timezone.now())
+    return True
+
+
+def run_pending(limit=None):
+    """Runs due tasks in this process until none is left; returns how many ran."""
+    ran = 0
+    while limit is None or ran < limit:
+        claimed = claim()
+        if claimed is None:
+            break
+        execute(claimed)
+        ran += 1
+    return ran
+
+
+def purge_finished(older_than):
+    """Deletes done and failed tasks; their idempotency keys become free again."""
+    return Task.objects.filter(status__in=('done', 'failed'),
+                               finished_at__lt=timezone.now() - timedelta(seconds=older_than)).delete()[0]
@@ -1,16 +1,57 @@
+import asyncio
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock, skipIf
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import caches
+from django.core.signals import request_finished, request_started
+from django.core.management import call_command
+from django.db import close_old_connections, connection
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
 from rest_framework.reverse import reverse
-from rest_framework.test import APITestCase
+from rest_framework.test import APIRequestFactory, APITestCase
+
+from . import authentication, db, loans, overload, routers, tasks, throttling
+from .asgi import StreamingASGIHandler
+from .blacklist import purge_expired
+from .bulk import BookBulkLoader
+from .cache import get_response_cache, is_shared, list_key
+from .instrumentation import InstrumentationMiddleware
+from .models import Author, Book, BookInstance, BookListing, Genre, Loan, RevokedToken, Task, UserProfile
+from .querybudget import assert_queries_constant, query_budget
+from .renderers import ORJSONRenderer, msgpack
+from .search import SEARCH_TABLE
+from .serializers import AuthorToBookSerializer, BookSerializer, LoanSerializer, UserCreateSerializer
+from .tasks import task
 
 
 class userProfileTestCase(APITestCase):
     profile_list_url=reverse("libraryapp:all-profiles")
+    profile_url=reverse("libraryapp:profile")
     def setUp(self):
-        self.user=self.client.post('users/',data={'username':'mario', 'email': 'mario@mail.li', 'password':'i-keep-jumping'})
-        response=self.client.post('jwt/create/',data={'username':'mario','password':'i-keep-jumping'})
-        self.token = response.body["access"]
+        self.user=self.client.post('/auth/register',data={'username':'mario', 'email': 'mario@mail.li', 'password':'i-keep-jumping'})
+        response=self.client.post('/auth/login',data={'username':'mario','password':'i-keep-jumping'})
+        self.token = response.data["access"]
         self.api_authentication()
 
+    def tearDown(self):
+        authentication._users.clear()
+
     def api_authentication(self):
         self.client.credentials(HTTP_AUTHORIZATION='Bearer '+self.token)
 
@@ -21,20 +62,1142 @@ class userProfileTestCase(APITestCase):
 
     # retrieve a list of all user profiles while the request user is unauthenticated
     def test_userprofile_list_unauthenticated(self):
-        self.client.force_authenticate(user=None)
+        self.client.credentials()
         response=self.client.get(self.profile_list_url)
         self.assertEqual(response.status_code,status.HTTP_401_UNAUTHORIZED)
 
     # check to retrieve the profile details of the authenticated user
     def test_userprofile_detail_retrieve(self):
-        response=self.client.get(reverse('profile',kwargs={'pk':1}))
-        # print(response.data)
+        response=self.client.get(self.profile_url)
         self.assertEqual(response.status_code,status.HTTP_200_OK)
+        self.assertEqual(response.data['username'],'mario')
 
 
     # populate the user profile that was automatically created using the signals
     def test_userprofile_profile(self):
         profile_data={'location':'nintendo world','is_reader':'True',}
-        response=self.client.put(reverse('profile',kwargs={'pk':1}),data=profile_data)
-        print(response.data)
+        response=self.client.put(self.profile_url,data=profile_data)
         self.assertEqual(response.status_code,status.HTTP_200_OK)
+        self.assertEqual(response.data['location'],'nintendo world')
+
+
+class BooksQueryBudgetTestCase(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@admins.com', 'i-keep-jumping')
+        self.author = Author.objects.create(first_name='Александр', last_name='Пушкин')
+        self.genre = Genre.objects.create(name='Роман')
+
+    def create_books(self, count):
+        # the listing rows are rendered by a task queued when the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(count):
+                book = Book.objects.create(title='book %d' % i, isbn='978-5-7932-0842-3', id_inst=BookInstance.objects.create(text='text'))
+                book.authors.add(self.author)
+                book.genre.add(self.genre)
+        tasks.run_pending()
+
+    # the list endpoint must run the same number of queries for any number of books
+    def test_books_list_queries_constant(self):
+        queries = assert_queries_constant(self.create_books, lambda: self.client.get('/api/books'), sizes=(2, 10))
+        self.assertLessEqual(queries, 4)
+
+    def test_book_detail_query_budget(self):
+        self.create_books(1)
+        url = '/api/books/%d' % Book.objects.get().pk
+        self.client.force_authenticate(user=self.admin)
+        with query_budget(4):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['authors'][0]['last_name'], 'Пушкин')
+
+
+class BooksPaginationTestCase(APITestCase):
+    def setUp(self):
+        for i in range(5):
+            Book.objects.create(title='book %d' % i, isbn='978-5-7932-0842-3')
+
+    def test_books_cursor_pagination(self):
+        response = self.client.get('/api/books', {'page_size': 2})
+        self.assertEqual([book['title'] for book in response.data['results']], ['book 0', 'book 1'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([book['title'] for book in response.data['results']], ['book 2', 'book 3'])
+
+    def test_books_stream(self):
+        response = self.client.get('/api/books', {'stream': 1})
+        self.assertTrue(response.streaming)
+        books = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(books), 5)
+
+
+class BooksFilterTestCase(APITestCase):
+    def setUp(self):
+        self.author = Author.objects.create(first_name='Александр', last_name='Пушкин')
+        self.novel = Genre.objects.create(name='Роман')
+        self.poem = Genre.objects.create(name='Поэма')
+        for title, isbn, book_status, genres in [('Метро 2033', '978-5-17', 'a', [self.novel]),
+                                                  ('Евгений Онегин', '978-5-04', 'a', [self.novel, self.poem]),
+                                                  ('Медный всадник', '978-5-04', 'e', [self.poem])]:
+            book = Book.objects.create(title=title, isbn=isbn, status=book_status)
+            book.genre.set(genres)
+            if title != 'Метро 2033':
+                book.authors.add(self.author)
+
+    def tearDown(self):
+        get_response_cache().clear()
+
+    def titles(self, **params):
+        response = self.client.get('/api/books', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [book['title'] for book in response.data['results']]
+
+    def test_filters(self):
+        self.assertEqual(self.titles(status='e'), ['Медный всадник'])
+        self.assertEqual(self.titles(status='a,e', author=self.author.pk), ['Евгений Онегин', 'Медный всадник'])
+        self.assertEqual(self.titles(genre=self.poem.pk, isbn='978-5-0'), ['Евгений Онегин', 'Медный всадник'])
+        self.assertEqual(self.titles(title='Ме'), ['Метро 2033', 'Медный всадник'])
+        self.assertEqual(self.client.get('/api/books', {'status': 'x'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/books', {'author': 'x'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ordering(self):
+        self.assertEqual(self.titles(ordering='-title'), ['Метро 2033', 'Медный всадник', 'Евгений Онегин'])
+        # fields outside the whitelist are ignored
+        self.assertEqual(self.titles(ordering='isbn')[0], 'Метро 2033')
+        response = self.client.get('/api/books', {'ordering': 'title', 'page_size': 2})
+        self.assertEqual(self.client.get(response.data['next']).data['results'][0]['title'], 'Метро 2033')
+
+    def test_facets(self):
+        with query_budget(3):
+            response = self.client.get('/api/books', {'facets': 1})
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(response.data['status'], {'a': 2, 'e': 1})
+        self.assertEqual([(genre['name'], genre['count']) for genre in response.data['genre']], [('Поэма', 2), ('Роман', 2)])
+        response = self.client.get('/api/books', {'facets': 1, 'author': self.author.pk})
+        self.assertEqual(response.data['genre'][0], {'id': self.poem.pk, 'name': 'Поэма', 'count': 2})
+
+    def test_facets_are_cached_until_a_book_changes(self):
+        self.client.get('/api/books', {'facets': 1})
+        with query_budget(2):
+            self.client.get('/api/books', {'facets': 1})
+        book = Book.objects.get(title='Медный всадник')
+        book.status = 'a'
+        with self.captureOnCommitCallbacks(execute=True):
+            book.save()
+        self.assertEqual(self.client.get('/api/books', {'facets': 1}).data['status'], {'a': 3})
+
+
+class RenderingTestCase(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(user=User.objects.create_superuser('admin', 'admin@admins.com', 'i-keep-jumping'))
+        self.author = Author.objects.create(first_name='Александр', last_name='Пушкин')
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(3):
+                book = Book.objects.create(title='book %d' % i, isbn='1', id_inst=BookInstance.objects.create(text='text'))
+                book.authors.add(self.author)
+                book.genre.add(Genre.objects.create(name='genre %d' % i))
+        self.book = book
+
+    def tearDown(self):
+        get_response_cache().clear()
+
+    def test_orjson_matches_drf(self):
+        loan = Loan.objects.create(book=self.book, user=User.objects.get(), due_at=timezone.now())
+        data = {'book': BookSerializer(self.book).data, 'loan': LoanSerializer(loan).data, 'at': timezone.now()}
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(AuthorToBookSerializer(self.author).data,
+                         {'id': self.author.pk, 'first_name': 'Александр', 'last_name': 'Пушкин'})
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_by_accept(self):
+        response = self.client.get('/api/books/%d' % self.book.pk, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content), self.client.get('/api/books/%d' % self.book.pk).json())
+
+    def test_sparse_fields(self):
+        response = self.client.get('/api/books', {'fields': 'title,id'})
+        self.assertEqual(response.data['results'][0], {'id': self.book.pk - 2, 'title': 'book 0'})
+        response = self.client.get('/api/books/%d' % self.book.pk, {'fields': 'authors'})
+        self.assertEqual(list(response.data), ['authors'])
+        self.assertEqual(response.data['authors'][0]['last_name'], 'Пушкин')
+        response = self.client.get('/api/books', {'fields': 'id,password'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sparse_stream_skips_relations(self):
+        response = self.client.get('/api/books', {'stream': 1, 'fields': 'id,title'})
+        with CaptureQueriesContext(connection) as queries:
+            books = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(books[0], {'id': self.book.pk - 2, 'title': 'book 0'})
+        # one chunk and the empty one after it, no joins or prefetches
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('JOIN', queries[0]['sql'])
+
+
+class BooksBulkTestCase(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(user=User.objects.create_superuser('admin', 'admin@admins.com', 'i-keep-jumping'))
+        Author.objects.create(first_name='Александр', last_name='Пушкин')
+        Genre.objects.create(name='Роман')
+        self.instance = BookInstance.objects.create(text='text')
+
+    def book_data(self, **kwargs):
+        data = {'title': 'Евгений Онегин', 'isbn': '978-5-7932-0842-3', 'status': 'a',
+                'authors': [{'first_name': 'Александр', 'last_name': 'Пушкин'}], 'genre': [{'name': 'Роман'}]}
+        data.update(kwargs)
+        return data
+
+    def test_bulk_create_reports_item_errors(self):
+        books = [self.book_data(id_inst={'id_security': str(self.instance.id_security)}),
+                 self.book_data(genre=[{'name': 'Стихотворение'}]),
+                 self.book_data(title='Метро 2033')]
+        with query_budget(12):
+            response = self.client.post('/api/books/bulk', books, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['created']), 2)
+        self.assertEqual(response.data['errors'], [{'index': 1, 'errors': {'genre': ['Стихотворение does not exist.']}}])
+        self.assertEqual(Book.authors.through.objects.count(), 2)
+
+    def test_bulk_update(self):
+        book = Book.objects.create(title='old', isbn='1')
+        response = self.client.post('/api/books/bulk', [self.book_data(id=book.pk)], format='json')
+        self.assertEqual(response.data['updated'], [book.pk])
+        book.refresh_from_db()
+        self.assertEqual(book.title, 'Евгений Онегин')
+        self.assertEqual(list(book.genre.values_list('name', flat=True)), ['Роман'])
+
+    def test_create_missing_author(self):
+        response = self.client.post('/api/books', self.book_data(authors=[{'first_name': 'Юрий', 'last_name': 'Шпак'}]), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_rejects_a_list(self):
+        response = self.client.post('/api/books', [self.book_data()], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_authors_match_on_full_name(self):
+        Author.objects.create(first_name='Юрий', last_name='Шпак')
+        books = [self.book_data(authors=[{'first_name': 'Александр', 'last_name': 'Шпак'}]),
+                 self.book_data(authors=[{'first_name': 'Юрий', 'last_name': 'Шпак'}])]
+        with mock.patch('libraryapp.bulk.BATCH_SIZE', 2):
+            response = self.client.post('/api/books/bulk', books, format='json')
+        self.assertEqual(len(response.data['created']), 1)
+        self.assertEqual(response.data['errors'], [{'index': 0, 'errors': {'authors': ['Александр Шпак does not exist.']}}])
+
+
+class BookUpdateTestCase(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(user=User.objects.create_superuser('admin', 'admin@admins.com', 'i-keep-jumping'))
+        self.pushkin = Author.objects.create(first_name='Александр', last_name='Пушкин')
+        self.shpak = Author.objects.create(first_name='Юрий', last_name='Шпак')
+        self.book = Book.objects.create(title='Евгений Онегин', isbn='978-5-7932-0842-3', status='a')
+        self.book.authors.add(self.pushkin)
+
+    def test_put_keeps_unchanged_through_rows(self):
+        through_id = Book.authors.through.objects.get().id
+        data = {'title': 'Евгений Онегин', 'isbn': '978-5-7932-0842-3', 'status': 'a', 'genre': [],
+                'authors': [{'first_name': 'Александр', 'last_name': 'Пушкин'}, {'first_name': 'Юрий', 'last_name': 'Шпак'}]}
+        response = self.client.put('/api/books/%d' % self.book.pk, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['authors']), 2)
+        self.assertTrue(Book.authors.through.objects.filter(id=through_id).exists())
+
+    def test_patch_changes_only_sent_fields(self):
+        response = self.client.patch('/api/books/%d' % self.book.pk, {'status': 'n_a'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'n_a')
+        self.assertEqual(response.data['title'], 'Евгений Онегин')
+        self.assertEqual([author['id'] for author in response.data['authors']], [self.pushkin.pk])
+
+    def test_status_of_lent_book_is_left_to_loans(self):
+        self.assertEqual(self.client.patch('/api/books/%d' % self.book.pk, {'status': 'e'},
+                                           format='json').status_code, status.HTTP_400_BAD_REQUEST)
+        Book.objects.filter(pk=self.book.pk).update(status='e')
+        response = self.client.patch('/api/books/%d' % self.book.pk, {'status': 'a'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Book.objects.get(pk=self.book.pk).status, 'e')
+
+    def test_bulk_status_changes_report_lent_books(self):
+        lent = Book.objects.create(title='Метро 2033', isbn='1', status='a')
+        items = [{'id': self.book.pk, 'status': 'n_a'}, {'id': self.book.pk, 'status': 'n_a'},
+                 {'id': lent.pk, 'status': 'n_a', 'title': 'Метро 2034'}]
+        loader = BookBulkLoader(items, partial=True)
+        # a checkout between validation and the write
+        with mock.patch.object(BookBulkLoader, 'check_instances',
+                               lambda self, rows: Book.objects.filter(pk=lent.pk).update(status='e')):
+            loader.load()
+        self.assertEqual(loader.errors, [{'index': 2, 'errors': {'status': [loans.LENT_OUT]}}])
+        self.assertEqual(Book.objects.get(pk=self.book.pk).status, 'n_a')
+        self.assertEqual(Book.objects.filter(pk=lent.pk).values_list('title', 'status').get(), ('Метро 2033', 'e'))
+
+    def test_title_of_lent_book_can_be_edited(self):
+        Book.objects.filter(pk=self.book.pk).update(status='e')
+        url = '/api/books/%d' % self.book.pk
+        data = {key: self.client.get(url).data[key] for key in ('title', 'isbn', 'status', 'authors', 'genre')}
+        data['title'] = 'Евгений Онегин. Роман в стихах'
+        self.assertEqual(self.client.put(url, data, format='json').status_code, status.HTTP_200_OK)
+        del data['status']
+        data['title'] = 'Евгений Онегин'
+        response = self.client.put(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['title'], response.data['status']), ('Евгений Онегин', 'e'))
+
+    def test_patch_missing_book(self):
+        response = self.client.patch('/api/books/100', {'status': 'a'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BookSearchTestCase(APITestCase):
+    def setUp(self):
+        author = Author.objects.create(first_name='Дмитрий', last_name='Глуховский')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.metro = Book.objects.create(title='Метро 2033', isbn='978-5-7932-0842-3',
+                                             id_inst=BookInstance.objects.create(text='Когда-то давно Московское метро замышлялось как бомбоубежище'))
+            self.metro.authors.add(author)
+            Book.objects.create(title='Евгений Онегин', isbn='978-5-7932-0842-3')
+        tasks.run_pending()
+
+    def test_search_title_and_author(self):
+        response = self.client.get('/api/books/search', {'q': 'Глуховский'})
+        self.assertEqual([hit['book']['id'] for hit in response.data['results']], [self.metro.pk])
+        response = self.client.get('/api/books/search', {'q': 'Метро'})
+        self.assertIn('<b>Метро</b>', response.data['results'][0]['title_highlight'])
+
+    def test_search_instance_text(self):
+        response = self.client.get('/api/books/search', {'q': 'бомбоубежище'})
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIn('<b>бомбоубежище</b>', response.data['results'][0]['snippet'])
+
+    def test_highlights_escape_book_text(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Book.objects.create(title='<script>alert(1)</script> Пикник', isbn='978-5-17-042722-6')
+        tasks.run_pending()
+        response = self.client.get('/api/books/search', {'q': 'Пикник'})
+        self.assertEqual(response.data['results'][0]['title_highlight'],
+                         '&lt;script&gt;alert(1)&lt;/script&gt; <b>Пикник</b>')
+
+    def test_author_delete_reindexes_books(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Author.objects.get(last_name='Глуховский').delete()
+        tasks.run_pending()
+        response = self.client.get('/api/books/search', {'q': 'Глуховский'})
+        self.assertEqual(response.data['results'], [])
+
+    def test_rebuild_search_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % SEARCH_TABLE)
+        out = io.StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('2 books indexed', out.getvalue())
+        response = self.client.get('/api/books/search', {'q': 'Глуховский'})
+        self.assertEqual([hit['book']['id'] for hit in response.data['results']], [self.metro.pk])
+
+    def test_unsupported_database(self):
+        with mock.patch.dict('libraryapp.search.BACKENDS', clear=True):
+            response = self.client.get('/api/books/search', {'q': 'Метро'})
+        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+    def test_search_follows_updates(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.metro.delete()
+        tasks.run_pending()
+        response = self.client.get('/api/books/search', {'q': 'Метро'})
+        self.assertEqual(response.data['results'], [])
+
+
+class BooksCacheTestCase(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@admins.com', 'i-keep-jumping')
+        self.author = Author.objects.create(first_name='Александр', last_name='Пушкин')
+        self.book = Book.objects.create(title='Евгений Онегин', isbn='978-5-7932-0842-3')
+        self.book.authors.add(self.author)
+
+    def test_list_served_from_cache(self):
+        self.client.get('/api/books')
+        with query_budget(2):
+            response = self.client.get('/api/books')
+        self.assertEqual(response.data['results'][0]['title'], 'Евгений Онегин')
+
+    def test_author_rename_invalidates_book(self):
+        self.client.force_authenticate(user=self.admin)
+        url = '/api/books/%d' % self.book.pk
+        self.client.get(url)
+        self.author.last_name = 'Pushkin'
+        self.author.save()
+        with query_budget(4):
+            response = self.client.get(url)
+        self.assertEqual(response.data['authors'][0]['last_name'], 'Pushkin')
+        with query_budget(1):
+            self.client.get(url)
+
+    def test_new_book_expires_list_pages(self):
+        self.client.get('/api/books')
+        with self.captureOnCommitCallbacks(execute=True):
+            Book.objects.create(title='Метро 2033', isbn='978-5-7932-0842-3')
+        response = self.client.get('/api/books')
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_cache_is_shared_and_keys_fit_memcached(self):
+        self.assertTrue(is_shared())
+        request = APIRequestFactory().get('/api/books', {'title': 'Евгений Онегин' * 30})
+        self.assertLessEqual(len(list_key(Book, request)), 250)
+
+
+class ConditionalGetTestCase(APITestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@admins.com', 'i-keep-jumping')
+        self.author = Author.objects.create(first_name='Александр', last_name='Пушкин')
+        self.book = Book.objects.create(title='Евгений Онегин', isbn='978-5-7932-0842-3')
+        self.client.force_authenticate(user=self.admin)
+
+    def test_book_detail_not_modified(self):
+        url = '/api/books/%d' % self.book.pk
+        response = self.client.get(url)
+        self.assertIn('Last-Modified', response)
+        with query_budget(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_relation_change_updates_etag(self):
+        url = '/api/books/%d' % self.book.pk
+        etag = self.client.get(url)['ETag']
+        self.book.authors.add(self.author)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_books_list_changes_on_delete(self):
+        Book.objects.create(title='Метро 2033', isbn='978-5-7932-0842-3')
+        etag = self.client.get('/api/books')['ETag']
+        self.assertEqual(self.client.get('/api/books', HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.delete()
+        self.assertEqual(self.client.get('/api/books', HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_authors_list_changes_on_edit(self):
+        etag = self.client.get('/api/authors')['ETag']
+        # the validator is the list version alone, no aggregate over the table
+        with query_budget(1):
+            response = self.client.get('/api/authors', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author.last_name = 'Пушкин-Мусин'
+            self.author.save()
+        response = self.client.get('/api/authors', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_filtered_list_changes_when_a_book_leaves_it(self):
+        url = '/api/books?status=a'
+        Book.objects.filter(pk=self.book.pk).update(status='a')
+        response = self.client.get(url)
+        self.assertEqual(len(response.data['results']), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.status = 'n_a'
+            self.book.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+
+    def test_lists_ordered_by_update_follow_relation_changes(self):
+        self.book.authors.add(self.author)
+        other = Book.objects.create(title='Метро 2033', isbn='978-5-17-059678-2')
+        url = '/api/books?ordering=-updated_at'
+        self.assertEqual([book['id'] for book in self.client.get(url).data['results']], [other.pk, self.book.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author.last_name = 'Пушкин-Мусин'
+            self.author.save()
+        self.assertEqual([book['id'] for book in self.client.get(url).data['results']], [self.book.pk, other.pk])
+
+    def test_list_validators_come_from_the_database(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Book.objects.create(title='Метро 2033', isbn='978-5-7932-0842-3')
+        response = self.client.get('/api/books')
+        # another worker, or this one after a restart, has nothing cached and answers with the same validators
+        get_response_cache().clear()
+        again = self.client.get('/api/books', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(again['Last-Modified'], response['Last-Modified'])
+
+    def test_validators_vary_on_accept(self):
+        response = self.client.get('/api/books/%d' % self.book.pk)
+        self.assertIn('Accept', [header.strip() for header in response['Vary'].split(',')])
+        response = self.client.get('/api/books/%d' % self.book.pk, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertIn('Accept', [header.strip() for header in response['Vary'].split(',')])
+
+    def test_profile_not_modified(self):
+        etag = self.client.get('/api/profile')['ETag']
+        response = self.client.get('/api/profile', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+
+def asgi_get(path, query='', headers=()):
+    """Status and body of a GET served by the ASGI handler, with the body read as a server reads it."""
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+             'path': path, 'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+             'headers': [(name.encode(), value.encode()) for name, value in headers],
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 50000)}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+    # as the test clients do, so the connection holding the test transaction stays open
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    try:
+        async_to_sync(StreamingASGIHandler())(scope, receive, send)
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+
+class AsgiStreamingTestCase(APITestCase):
+    def setUp(self):
+        self.text = 'МЕТРО 2033 ' * 2000
+        with self.captureOnCommitCallbacks(execute=True):
+            self.instance = BookInstance.objects.create(text=self.text)
+            Book.objects.create(title='Метро 2033', isbn='1', id_inst=self.instance)
+        User.objects.create_user('reader', password='secret-pass-1')
+        response = self.client.post('/auth/login', {'username': 'reader', 'password': 'secret-pass-1'})
+        self.authorization = ('Authorization', 'Bearer ' + response.data['access'])
+
+    def tearDown(self):
+        get_response_cache().clear()
+
+    def test_streamed_list(self):
+        code, body = asgi_get('/api/books', 'stream=1', [self.authorization])
+        self.assertEqual(code, 200)
+        self.assertEqual([book['title'] for book in json.loads(body)], ['Метро 2033'])
+
+    def test_streamed_text(self):
+        code, body = asgi_get('/api/bookinstances/%s/content' % self.instance.id_security, headers=[self.authorization])
+        self.assertEqual(code, 200)
+        self.assertEqual(body.decode(), self.text)
+
+class BookInstanceContentTestCase(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(user=User.objects.create_user('reader', 'reader@mail.li', 'i-keep-jumping'))
+        self.text = 'МЕТРО 2033\r\n\r\nКогда-то давно Московское метро замышлялось как гигантское бомбоубежище.'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.instance = BookInstance.objects.create(text=self.text)
+        tasks.run_pending()
+        self.url = '/api/bookinstances/%s/content' % self.instance.id_security
+
+    def test_metadata_defers_text(self):
+        with query_budget(2):
+            response = self.client.get('/api/bookinstances/%s' % self.instance.id_security)
+        self.assertNotIn('text', response.data)
+        self.assertEqual(response.data['text_length'], len(self.text))
+
+    def test_page(self):
+        response = self.client.get(self.url, {'page': 2, 'page_size': 10})
+        self.assertEqual(response.data['text'], self.text[10:20])
+        self.assertEqual(response.data['total'], len(self.text))
+        self.assertIn('offset=20', response.data['next'])
+
+    def test_range(self):
+        data = self.text.encode('utf-8')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5-40')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), data[5:41])
+        self.assertEqual(response['Content-Range'], 'bytes 5-40/%d' % len(data))
+        response = self.client.get(self.url, HTTP_RANGE='bytes=%d-' % len(data))
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+    def test_stream_and_gzip(self):
+        response = self.client.get(self.url)
+        self.assertEqual(b''.join(response.streaming_content).decode('utf-8'), self.text)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content).decode('utf-8'), self.text)
+
+    def test_refused_encoding_is_not_sent(self):
+        for header in ('gzip;q=0', 'identity, *;q=0', 'br;q=1, gzip;q=0.0'):
+            response = self.client.get(self.url, HTTP_ACCEPT_ENCODING=header)
+            self.assertFalse(response.has_header('Content-Encoding'), header)
+            self.assertEqual(b''.join(response.streaming_content).decode('utf-8'), self.text)
+
+    def test_text_is_compressed_by_a_task(self):
+        self.instance.text = 'Метро 2034'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.instance.save()
+        self.assertIsNone(BookInstance.objects.get(pk=self.instance.pk).text_gzip)
+        self.assertEqual(tasks.run_pending(), 1)
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(gzip.decompress(response.content).decode('utf-8'), 'Метро 2034')
+
+
+class ClaimsAuthenticationTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('reader', password='secret-pass-1')
+        response = self.client.post('/auth/login', {'username': 'reader', 'password': 'secret-pass-1'})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        Book.objects.create(title='Book', isbn='1')
+
+    def tearDown(self):
+        # user ids are reused after the test transaction rolls back
+        caches['shared'].clear()
+        authentication._revocations.clear()
+
+    def test_claims_authenticate_without_user_query(self):
+        self.client.get('/api/books')
+        with query_budget(2) as queries:
+            response = self.client.get('/api/books')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse([query for query in queries if 'auth_user' in query['sql']])
+
+    def test_deactivated_user_token_is_rejected(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        response = self.client.get('/api/books')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_revocation_reaches_other_workers(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_staff = True
+            self.user.save()
+        # a worker that did not make the change has neither the memo nor anything in its own caches
+        authentication._revocations.clear()
+        caches['shared'].clear()
+        response = self.client.get('/api/books')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+    def test_token_issued_right_after_revocation_is_accepted(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_staff = True
+            self.user.save()
+        # in the same second as the revocation
+        response = self.client.post('/auth/login', {'username': 'reader', 'password': 'secret-pass-1'})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        self.assertEqual(self.client.get('/api/books').status_code, status.HTTP_200_OK)
+        response = self.client.post('/auth/refresh', {'refresh': response.data['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class TokenRotationTestCase(APITestCase):
+    def setUp(self):
+        User.objects.create_user('reader', password='secret-pass-1')
+        self.tokens = self.client.post('/auth/login', {'username': 'reader', 'password': 'secret-pass-1'}).data
+
+    def tearDown(self):
+        caches['shared'].clear()
+
+    def test_refresh_rotates_and_blacklists(self):
+        response = self.client.post('/auth/refresh', {'refresh': self.tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.data['refresh'], self.tokens['refresh'])
+        response = self.client.post('/auth/refresh', {'refresh': self.tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        caches['shared'].clear()
+        response = self.client.post('/auth/verify', {'token': self.tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_login_does_not_write_tokens(self):
+        self.assertEqual(RevokedToken.objects.count(), 0)
+
+    def test_logout(self):
+        response = self.client.post('/auth/logout', {'refresh': self.tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        with query_budget(0):
+            response = self.client.post('/auth/verify', {'token': self.tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_unrevoked_token_is_cached_until_blacklisted(self):
+        self.client.post('/auth/verify', {'token': self.tokens['refresh']})
+        with query_budget(0):
+            response = self.client.post('/auth/verify', {'token': self.tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.post('/auth/logout', {'refresh': self.tokens['refresh']})
+        response = self.client.post('/auth/verify', {'token': self.tokens['refresh']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_purge_expired(self):
+        past = timezone.now() - timedelta(minutes=1)
+        RevokedToken.objects.bulk_create([RevokedToken(jti_hash='%032d' % i, expires_at=past) for i in range(5)])
+        RevokedToken.objects.create(jti_hash='f' * 32, expires_at=timezone.now() + timedelta(days=1))
+        self.assertEqual(purge_expired(batch_size=2, max_batches=2), 4)
+        self.assertEqual(purge_expired(batch_size=2), 1)
+        self.assertEqual(RevokedToken.objects.count(), 1)
+
+
+class PasswordHashingTestCase(APITestCase):
+    def tearDown(self):
+        caches['shared'].clear()
+
+    def test_register_checks_uniqueness_in_one_query(self):
+        data = {'username': 'reader', 'email': 'reader@mail.li', 'password': 'secret-pass-1'}
+        response = self.client.post('/auth/register', data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        user = User.objects.select_related('profile').get(username='reader')
+        self.assertTrue(user.check_password('secret-pass-1'))
+        self.assertTrue(user.profile.is_reader)
+        with query_budget(1):
+            response = self.client.post('/auth/register', dict(data, username='other'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('email', response.data)
+
+    def test_register_reports_the_violated_constraint(self):
+        User.objects.create_user('reader', email='reader@mail.li', password='secret-pass-1')
+        # a concurrent registration that passed validate() before the first one was inserted
+        with self.assertRaises(ValidationError) as raised:
+            UserCreateSerializer().create({'username': 'other', 'email': 'reader@mail.li', 'password': 'secret-pass-1'})
+        self.assertEqual(list(raised.exception.detail), ['email'])
+        with self.assertRaises(ValidationError) as raised:
+            UserCreateSerializer().create({'username': 'reader', 'email': 'other@mail.li', 'password': 'secret-pass-1'})
+        self.assertEqual(list(raised.exception.detail), ['username'])
+
+    def test_register_normalizes_username(self):
+        User.objects.create_user('reader', email='reader@mail.li', password='secret-pass-1')
+        # the fullwidth letters are the same username after NFKC normalization
+        response = self.client.post('/auth/register', {'username': 'ｒｅａｄｅｒ', 'email': 'other@mail.li', 'password': 'secret-pass-1'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('username', response.data)
+
+    def test_login_upgrades_outdated_hash(self):
+        outdated = PBKDF2PasswordHasher().encode('secret-pass-1', 'somesalt', iterations=1000)
+        user = User.objects.create(username='reader', password=outdated)
+        response = self.client.post('/auth/login', {'username': 'reader', 'password': 'secret-pass-1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        user.refresh_from_db()
+        self.assertNotEqual(user.password, outdated)
+        self.assertTrue(user.check_password('secret-pass-1'))
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        self.assertEqual(self.client.get('/api/books').status_code, status.HTTP_200_OK)
+
+    def test_login_rejects_wrong_password(self):
+        User.objects.create_user('reader', password='secret-pass-1')
+        response = self.client.post('/auth/login', {'username': 'reader', 'password': 'wrong-pass-1'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ProfileQueryTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('reader', email='reader@mail.li', password='secret-pass-1')
+        response = self.client.post('/auth/login', {'username': 'reader', 'password': 'secret-pass-1'})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        self.client.get('/api/profile')
+
+    def tearDown(self):
+        authentication._users.clear()
+
+    def test_user_save_does_not_save_profile(self):
+        with query_budget(1):
+            self.user.save(update_fields=['last_login'])
+
+    def test_profile_get_reads_the_user_once(self):
+        with query_budget(1):
+            response = self.client.get('/api/profile')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['username'], 'reader')
+
+    def test_profile_is_not_served_from_another_workers_cache(self):
+        UserProfile.objects.filter(user=self.user).update(location='Kazan')
+        response = self.client.get('/api/profile')
+        self.assertEqual(response.data['location'], 'Kazan')
+
+    def test_profile_put_writes_changed_fields(self):
+        # the user, then two updates inside the savepoint the test transaction turns atomic() into
+        with query_budget(5):
+            response = self.client.put('/api/profile', {'location': 'Moscow', 'first_name': 'Ivan'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, 'Ivan')
+        self.assertEqual(self.user.profile.location, 'Moscow')
+        with query_budget(2):
+            response = self.client.put('/api/profile', {'location': 'Moscow'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class InstrumentationTestCase(APITestCase):
+    def setUp(self):
+        Book.objects.create(title='Book', isbn='1')
+
+    def test_server_timing(self):
+        response = self.client.get('/api/books')
+        timing = response['Server-Timing']
+        for name in ('auth;', 'perm;', 'serialize;', 'render;', 'db;', 'total;'):
+            self.assertIn(name, timing)
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries, \d+ repeated"')
+
+    def test_slow_request_log(self):
+        with mock.patch('libraryapp.instrumentation.SLOW_REQUEST_SECONDS', 0), \
+                self.assertLogs('libraryapp.requests', 'WARNING') as logs:
+            self.client.get('/api/books')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['view'], 'api/books')
+        self.assertEqual(record['status'], 200)
+
+    def test_metrics(self):
+        self.client.get('/api/books')
+        response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('library_request_duration_seconds_bucket{le="0.005",method="GET",view="api/books"}',
+                      response.content.decode())
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_async_requests_are_not_served_in_a_thread(self):
+        async def get_response(request):
+            return HttpResponse('ok')
+        middleware = InstrumentationMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(RequestFactory().get('/api/books'))
+        self.assertIn('total;', response['Server-Timing'])
+
+
+class ConnectionHealthTestCase(APITestCase):
+    def test_idle_connection_is_checked(self):
+        connection.ensure_connection()
+        connection.last_used_at = time.monotonic() - db.HEALTH_CHECK_SECONDS - 1
+        # the test transaction lives on the connection, so closing is only recorded
+        with mock.patch.object(connection, 'is_usable', return_value=False) as is_usable, \
+                mock.patch.object(connection, 'close') as close:
+            db.check_connections()
+        is_usable.assert_called_once_with()
+        close.assert_called_once_with()
+
+    def test_recently_used_connection_is_not_checked(self):
+        self.client.get('/api/books')
+        with mock.patch.object(connection, 'is_usable') as is_usable:
+            db.check_connections()
+        is_usable.assert_not_called()
+
+
+class LoansTestCase(APITestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title='Метро 2033', isbn='1', status='a')
+        self.tokens = {}
+        for username in ('first', 'second'):
+            User.objects.create_user(username, password='secret-pass-1')
+            response = self.client.post('/auth/login', {'username': username, 'password': 'secret-pass-1'})
+            self.tokens[username] = 'Bearer ' + response.data['access']
+
+    def tearDown(self):
+        get_response_cache().clear()
+
+    def post(self, username, action):
+        return self.client.post('/api/books/%d/%s' % (self.book.pk, action), HTTP_AUTHORIZATION=self.tokens[username])
+
+    def test_checkout_return_and_waitlist(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.post('first', 'checkout').status_code, status.HTTP_201_CREATED)
+        tasks.run_pending()
+        self.assertEqual(json.loads(BookListing.objects.get().document)['status'], 'e')
+        self.assertEqual(self.post('second', 'checkout').status_code, status.HTTP_409_CONFLICT)
+        response = self.post('second', 'reservation')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['position'], 1)
+        self.assertEqual(self.post('second', 'reservation').status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.post('second', 'return').status_code, status.HTTP_409_CONFLICT)
+        # the book goes straight to the waitlist
+        self.assertEqual(self.post('first', 'return').status_code, status.HTTP_204_NO_CONTENT)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.status, 'e')
+        loans = self.client.get('/api/loans', HTTP_AUTHORIZATION=self.tokens['second']).data
+        self.assertEqual([loan['book'] for loan in loans['loans']], [self.book.pk])
+        self.assertEqual(loans['reservations'], [])
+        self.assertEqual(self.post('second', 'return').status_code, status.HTTP_204_NO_CONTENT)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.status, 'a')
+        self.assertEqual(Loan.objects.filter(returned_at__isnull=True).count(), 0)
+
+    def test_open_loan_left_behind_is_a_conflict(self):
+        Loan.objects.create(book=self.book, user=User.objects.get(username='first'), due_at=timezone.now())
+        self.assertEqual(self.post('second', 'checkout').status_code, status.HTTP_409_CONFLICT)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.status, 'a')
+
+    def test_only_readers_borrow(self):
+        UserProfile.objects.filter(user__username='first').update(is_reader=False)
+        response = self.client.post('/auth/login', {'username': 'first', 'password': 'secret-pass-1'})
+        self.tokens['first'] = 'Bearer ' + response.data['access']
+        self.assertEqual(self.post('first', 'checkout').status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.client.post('/api/books/0/checkout', HTTP_AUTHORIZATION=self.tokens['second']).status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+
+calls = []
+
+
+@task(max_attempts=2)
+def flaky(value):
+    calls.append(value)
+    if len(calls) == 1:
+        raise ValueError('first call fails')
+    return value * 2
+
+
+@task(max_attempts=2)
+def broken():
+    raise ValueError('always fails')
+
+
+class TasksTestCase(APITestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_retry_with_backoff(self):
+        queued = flaky.delay(21)
+        self.assertEqual(tasks.run_pending(), 1)
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), ('queued', 1))
+        self.assertIn('first call fails', queued.last_error)
+        # not due before the backoff has passed
+        self.assertEqual(tasks.run_pending(), 0)
+        Task.objects.update(run_at=timezone.now())
+        self.assertEqual(tasks.run_pending(), 1)
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.result), ('done', 42))
+
+    def test_gives_up_after_max_attempts(self):
+        with mock.patch('libraryapp.tasks.backoff_seconds', return_value=0):
+            broken.delay()
+            missing = Task.objects.create(name='libraryapp.tests.missing', max_attempts=3)
+            self.assertEqual(tasks.run_pending(), 3)
+        self.assertEqual(list(Task.objects.order_by('pk').values_list('status', 'attempts')), [('failed', 2), ('failed', 1)])
+        self.assertIn('ImportError', Task.objects.get(pk=missing.pk).last_error)
+
+    def test_idempotency_key_and_expired_lease(self):
+        first = flaky.delay(1, key='once')
+        self.assertEqual(flaky.delay(2, key='once').pk, first.pk)
+        self.assertEqual(Task.objects.count(), 1)
+        claimed = tasks.claim()
+        self.assertIsNone(tasks.claim())
+        # the worker died: its lease runs out and another worker takes the task over
+        Task.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(tasks.claim().pk, claimed.pk)
+        self.assertFalse(tasks.execute(claimed))
+        self.assertEqual(Task.objects.get().status, 'running')
+
+    def test_immediate_backend(self):
+        calls.append('warm')
+        with mock.patch('libraryapp.tasks.BACKEND', 'immediate'):
+            queued = flaky.delay(5)
+            delayed = flaky.delay(6, countdown=60)
+        self.assertEqual((queued.status, queued.result), ('done', 10))
+        self.assertEqual((delayed.status, delayed.result), ('done', 12))
+
+    def test_async_bulk_load(self):
+        self.client.force_authenticate(user=User.objects.create_superuser('admin', 'admin@admins.com', 'i-keep-jumping'))
+        books = [{'title': 'Метро 2033', 'isbn': '1', 'status': 'a', 'authors': [], 'genre': []}]
+        response = self.client.post('/api/books/bulk?async=1', books, format='json', HTTP_IDEMPOTENCY_KEY='import-1')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        repeated = self.client.post('/api/books/bulk?async=1', books, format='json', HTTP_IDEMPOTENCY_KEY='import-1')
+        self.assertEqual(repeated.data['id'], response.data['id'])
+        self.assertFalse(Book.objects.exists())
+        tasks.run_pending()
+        response = self.client.get(response['Location'])
+        self.assertEqual(response.data['status'], 'done')
+        self.assertEqual(response.data['result']['created'], list(Book.objects.values_list('pk', flat=True)))
+
+
+class ThrottlingTestCase(APITestCase):
+    def setUp(self):
+        throttling.get_counters().clear()
+
+    def tearDown(self):
+        throttling.get_counters().clear()
+
+    def test_sliding_window(self):
+        for _ in range(10):
+            self.assertIsNone(throttling.hit('test', 10, 60, now=120.0))
+        self.assertAlmostEqual(throttling.hit('test', 10, 60, now=150.0), 60 - 30 + 60 * (1 - 10 / 11))
+        # half of the previous window still counts: 11 * 0.5 + 4 = 9.5 stays below 10
+        for _ in range(4):
+            self.assertIsNone(throttling.hit('test', 10, 60, now=210.0))
+        self.assertIsNotNone(throttling.hit('test', 10, 60, now=210.0))
+        self.assertIsNone(throttling.hit('test', 10, 60, now=300.0))
+
+    def test_login_throttled_per_username(self):
+        with mock.patch.dict(api_settings.DEFAULT_THROTTLE_RATES, {'login': '2/min'}):
+            for _ in range(2):
+                response = self.client.post('/auth/login', {'username': 'mario', 'password': 'wrong-password'})
+                self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+            response = self.client.post('/auth/login', {'username': 'mario', 'password': 'wrong-password'})
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertGreater(int(response['Retry-After']), 0)
+            response = self.client.post('/auth/login', {'username': 'luigi', 'password': 'wrong-password'})
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_anonymous_and_stream_rates(self):
+        with mock.patch.dict(api_settings.DEFAULT_THROTTLE_RATES, {'anon': '2/min', 'stream': '1/min'}):
+            self.assertEqual(self.client.get('/api/books', {'stream': 1}).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get('/api/books', {'stream': 1}).status_code,
+                             status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(self.client.get('/api/books').status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            # another address has its own counters
+            self.assertEqual(self.client.get('/api/books', REMOTE_ADDR='10.0.0.2').status_code, status.HTTP_200_OK)
+
+
+class LoadSheddingTestCase(APITestCase):
+    def setUp(self):
+        User.objects.create_user('reader', password='secret-pass-1')
+        self.token = 'Bearer ' + self.client.post('/auth/login', {'username': 'reader', 'password': 'secret-pass-1'}).data['access']
+
+    def test_sheds_low_priority_when_busy(self):
+        with mock.patch('libraryapp.overload.MAX_IN_FLIGHT', 0):
+            response = self.client.get('/api/books')
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(response['Retry-After'], '5')
+            response = self.client.get('/api/books/search', {'q': 'x'}, HTTP_AUTHORIZATION=self.token)
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(self.client.get('/api/books', HTTP_AUTHORIZATION=self.token).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get('/api/loans', HTTP_AUTHORIZATION=self.token).status_code, status.HTTP_200_OK)
+        self.assertEqual(overload.state.in_flight, 0)
+
+    def test_queue_time_and_latency(self):
+        self.assertEqual(self.client.get('/api/books', HTTP_X_REQUEST_START='t=%d' % (time.time() * 1000)).status_code,
+                         status.HTTP_200_OK)
+        response = self.client.get('/api/books', HTTP_X_REQUEST_START='t=%.3f' % (time.time() - 5))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        with mock.patch.object(overload.state, 'latency', 10.0), mock.patch.object(overload.state, 'updated', time.monotonic()):
+            self.assertEqual(self.client.get('/api/books').status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            # the average decays while nothing completes
+            overload.state.updated -= 60
+            self.assertEqual(self.client.get('/api/books').status_code, status.HTTP_200_OK)
+
+    def test_long_requests_stay_out_of_the_average(self):
+        with mock.patch.object(overload.state, 'latency', 0.0), mock.patch('time.perf_counter', side_effect=[0, 30]):
+            overload.LoadSheddingMiddleware(lambda request: HttpResponse())(RequestFactory().get('/api/books?stream=1'))
+            self.assertEqual(overload.state.latency, 0.0)
+
+    def test_async_requests_are_not_served_in_a_thread(self):
+        async def get_response(request):
+            return HttpResponse('ok')
+        middleware = overload.LoadSheddingMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        with mock.patch('libraryapp.overload.MAX_IN_FLIGHT', 0):
+            response = async_to_sync(middleware)(RequestFactory().get('/api/books'))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(async_to_sync(middleware)(RequestFactory().get('/api/books')).status_code, status.HTTP_200_OK)
+        self.assertEqual(overload.state.in_flight, 0)
+
+
+class BookListingTestCase(APITestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author = Author.objects.create(first_name='Александр', last_name='Пушкин')
+            self.book = Book.objects.create(title='Евгений Онегин', isbn='1', id_inst=BookInstance.objects.create(text='text'))
+            self.book.authors.add(self.author)
+        tasks.run_pending()
+
+    def tearDown(self):
+        get_response_cache().clear()
+
+    def test_list_is_served_from_listing(self):
+        expected = BookSerializer(Book.objects.get()).data
+        self.assertEqual(json.loads(BookListing.objects.get().document), expected)
+        with query_budget(4) as queries:
+            response = self.client.get('/api/books')
+        self.assertEqual(response.data['results'], [expected])
+        self.assertFalse([query for query in queries if 'libraryapp_author' in query['sql']])
+
+    def test_listing_follows_related_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author.last_name = 'Лермонтов'
+            self.author.save()
+        # the outdated row is gone at once, the task renders the new one
+        self.assertFalse(BookListing.objects.exists())
+        self.assertEqual(self.client.get('/api/books').data['results'][0]['authors'][0]['last_name'], 'Лермонтов')
+        tasks.run_pending()
+        self.assertEqual(json.loads(BookListing.objects.get().document)['authors'][0]['last_name'], 'Лермонтов')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author.delete()
+        tasks.run_pending()
+        self.assertEqual(json.loads(BookListing.objects.get().document)['authors'], [])
+
+    def test_relation_change_reads_its_books_once(self):
+        for author in (self.author, Author.objects.create(first_name='Михаил', last_name='Лермонтов')):
+            with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+                author.save()
+                author.delete()
+            reads = [query for query in queries if query['sql'].startswith('SELECT') and 'libraryapp_book_authors' in query['sql']]
+            # one for the save and one for the delete, shared by the index, the cache and updated_at
+            self.assertEqual(len(reads), 2)
+
+    def test_books_without_listing_are_serialized(self):
+        BookListing.objects.all().delete()
+        response = self.client.get('/api/books')
+        self.assertEqual(response.data['results'][0]['authors'][0]['last_name'], 'Пушкин')
+        out = io.StringIO()
+        call_command('rebuild_book_listing', verbosity=2, stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[-1], '1 books rendered')
+        self.assertEqual(BookListing.objects.count(), 1)
+
+
+@mock.patch('libraryapp.mixins.REPLICAS', ('default',))
+@mock.patch('libraryapp.routers.REPLICAS', ('default',))
+class ReplicaRoutingTestCase(APITestCase):
+    def setUp(self):
+        User.objects.create_user('admin', password='secret-pass-1', is_staff=True)
+        response = self.client.post('/auth/login', {'username': 'admin', 'password': 'secret-pass-1'})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        routers._health.clear()
+
+    def tearDown(self):
+        caches['shared'].clear()
+
+    def test_write_ends_replica_reads_of_the_request(self):
+        router = routers.ReplicaRouter()
+        token = routers.reads_from.set('replica_1')
+        try:
+            self.assertEqual(router.db_for_read(Book), 'replica_1')
+            self.assertEqual(router.db_for_write(Book), 'default')
+            self.assertEqual(router.db_for_read(Book), 'default')
+        finally:
+            routers.reads_from.reset(token)
+
+    def test_lagging_replica_is_not_used(self):
+        self.assertEqual(routers.usable_replicas(), ['default'])
+        routers._health.clear()
+        with mock.patch('libraryapp.routers.replica_lag', return_value=routers.MAX_LAG_SECONDS + 1):
+            self.assertEqual(routers.usable_replicas(), [])
+
+    def test_reads_stay_on_primary_after_write(self):
+        with mock.patch('libraryapp.mixins.read_from_replica', wraps=routers.read_from_replica) as read:
+            self.client.get('/api/genre')
+            self.assertEqual(read.call_count, 1)
+            response = self.client.post('/api/genre', {'name': 'Роман'})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertIn(routers.STICKY_COOKIE, response.cookies)
+            self.client.get('/api/genre')
+            # without the cookie the user is still known from the token
+            self.client.cookies.clear()
+            self.client.get('/api/genre')
+            self.assertEqual(read.call_count, 1)
+
+    def test_window_header_is_honoured_only_when_plausible(self):
+        request = APIRequestFactory().get('/api/genre', HTTP_X_PRIMARY_UNTIL='%.3f' % (time.time() + 5))
+        request.user = AnonymousUser()
+        self.assertTrue(routers.pinned_to_primary(request))
+        request.META['HTTP_X_PRIMARY_UNTIL'] = '%.3f' % (time.time() + routers.STICKY_SECONDS + 60)
+        self.assertFalse(routers.pinned_to_primary(request))
+
+    def test_failed_request_does_not_leave_the_thread_on_a_replica(self):
+        with mock.patch('libraryapp.views.GenreListCreateView.list', side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            self.client.get('/api/genre')
+        self.assertIsNone(routers.reads_from.get())
+
+
+class CsvDumpTestCase(APITestCase):
+    def test_import_and_export_shipped_dumps(self):
+        call_command('import_csv', stdout=io.StringIO())
+        self.assertEqual(Book.objects.count(), 4)
+        self.assertEqual(Book.objects.get(pk=2).genre.count(), 2)
+        instance = BookInstance.objects.get(id_security='e1ea80709ad44d1e93ce84ee10809af8')
+        self.assertTrue(instance.text.startswith('МЕТРО 2033\r\n\r\n'))
+        self.assertEqual(instance.text_size, len(instance.text.encode('utf-8')))
+        self.assertTrue(User.objects.get(username='admin').is_superuser)
+        with tempfile.TemporaryDirectory() as directory:
+            call_command('export_csv', 'libraryapp_bookinstance', 'auth_user', output_dir=directory, stdout=io.StringIO())
+            with open(os.path.join(directory, 'libraryapp_bookinstances.csv'), encoding='utf-8') as dump:
+                self.assertEqual(len(dump.read().splitlines()), 5)
+            BookInstance.objects.update(text='')
+            call_command('import_csv', os.path.join(directory, 'libraryapp_bookinstances.csv'), truncate=True,
+                         stdout=io.StringIO())
+        self.assertEqual(BookInstance.objects.get(pk=instance.pk).text, instance.text)
@@ -0,0 +1,187 @@
+"""Request throttling by sliding window, with the counters in a cache.
+
+Every (scope, client) pair has one counter per fixed window of the rate's
+period. The number of requests over the last period is estimated as the
+current window's count plus the previous window's count weighted by how
+much of it still falls inside the period, which costs one increment and one
+read per throttle and request. Rejected requests are counted too, so a
+client that ignores Retry-After stays throttled.
+
+The counters live in the THROTTLING['CACHE_ALIAS'] cache, shared by all
+workers when that is memcached or redis; with CACHE_ALIAS None they are
+kept in process memory, which is enough for a single worker. Rates are
+DRF's DEFAULT_THROTTLE_RATES ('10/min'); a scope without a rate is not
+limited.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from .instrumentation import prometheus_client
+
+THROTTLING = getattr(settings, 'THROTTLING', {})
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+if prometheus_client is not None:
+    THROTTLED = prometheus_client.Counter('library_requests_throttled', 'Requests refused with 429, by scope.', ['scope'])
+
+
+class LocalCounters:
+    """Counters of this process, for a single worker."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+        self.next_purge = 0
+
+    def incr(self, key, timeout):
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_purge:
+                self.data = {key: item for key, item in self.data.items() if item[1] > now}
+                self.next_purge = now + 60
+            count, expires = self.data.get(key, (0, 0))
+            count = count + 1 if expires > now else 1
+            self.data[key] = (count, now + timeout if count == 1 else expires)
+            return count
+
+    def get(self, key):
+        count, expires = self.data.get(key, (0, 0))
+        return count if expires > time.monotonic() else 0
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class CacheCounters:
+    """Counters in a CACHES alias; add() and incr() are atomic on memcached and redis."""
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def incr(self, key, timeout):
+        if self.cache.add(key, 1, timeout):
+            return 1
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # expired between add() and incr()
+            self.cache.set(key, 1, timeout)
+            return 1
+
+    def get(self, key):
+        return self.cache.get(key, 0)
+
+    def clear(self):
+        self.cache.clear()
+
+
+_counters = None
+
+
+def get_counters():
+    global _counters
+    if _counters is None:
+        alias = THROTTLING.get('CACHE_ALIAS')
+        _counters = CacheCounters(alias) if alias else LocalCounters()
+    return _counters
+
+
+def parse_rate(rate):
+    """'10/min' -> (10, 60)."""
+    count, period = rate.split('/')
+    return int(count), PERIODS[period[0]]
+
+
+def hit(key, limit, period, now=None):
+    """Counts a request; returns the seconds to wait when the limit is exceeded, otherwise None."""
+    now = time.time() if now is None else now
+    window = int(now // period)
+    elapsed = now - window * period
+    counters = get_counters()
+    current = counters.incr('throttle:%s:%d' % (key, window), period * 2)
+    previous = counters.get('throttle:%s:%d' % (key, window - 1))
+    if previous * (1 - elapsed / period) + current <= limit:
+        return None
+    if current > limit:
+        # this window alone is over: wait until enough of it has slid out of the period
+        return period - elapsed + period * (1 - limit / current)
+    return period * (1 - (limit - current) / previous) - elapsed
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """Base of the throttles: get_scope() names the rate, client_key() the counter."""
+    scope = None
+
+    def __init__(self):
+        self.wait_seconds = None
+
+    def get_scope(self, request, view):
+        return self.scope
+
+    def client_key(self, request, view):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return 'user:%s' % user.pk
+        return 'ip:%s' % self.get_ident(request)
+
+    def allow_request(self, request, view):
+        scope = self.get_scope(request, view)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope) if scope else None
+        if rate is None:
+            return True
+        limit, period = parse_rate(rate)
+        self.wait_seconds = hit('%s:%s' % (scope, self.client_key(request, view)), limit, period)
+        if self.wait_seconds is None:
+            return True
+        if prometheus_client is not None:
+            THROTTLED.labels(scope).inc()
+        return False
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class ClientThrottle(SlidingWindowThrottle):
+    """Every request of a user ('user'), or of an address without a user ('anon')."""
+
+    def get_scope(self, request, view):
+        user = getattr(request, 'user', None)
+        return 'user' if user is not None and user.is_authenticated else 'anon'
+
+
+class AddressThrottle(SlidingWindowThrottle):
+    """Every request from an address, whoever is signed in ('address')."""
+    scope = 'address'
+
+    def client_key(self, request, view):
+        return 'ip:%s' % self.get_ident(request)
+
+
+class ScopedThrottle(SlidingWindowThrottle):
+    """The requests of a client to the views sharing the view's throttle_scope."""
+
+    def get_scope(self, request, view):
+        return self.scope or getattr(view, 'throttle_scope', None)
+
+
+class StreamThrottle(ScopedThrottle):
+    """Whole-table ?stream=1 lists, added by StreamingListMixin ('stream')."""
+    scope = 'stream'
+
+
+class LoginThrottle(ScopedThrottle):
+    """Sign-in attempts per address and username, so guessing one password is slow ('login')."""
+    scope = 'login'
+
+    def client_key(self, request, view):
+        username = request.data.get('username', '') if hasattr(request.data, 'get') else ''
+        # hashed: memcached keys cannot hold spaces and are limited in length
+        username = hashlib.md5(str(username).lower().encode()).hexdigest()
+        return 'ip:%s:%s' % (self.get_ident(request), username)
@@ -1,23 +1,42 @@
+from django.conf import settings
 from django.urls import path
 
+from .async_views import async_read_view
 from .views import BooksView, BookInstanceDetailView, UserProfileListCreateView, UserProfileDetailView, GenreListCreateView, \
-    GenreDetailView, AuthorListCreateView, AuthorDetailView, BookDetailView, BookInstanceListCreateView
+    GenreDetailView, AuthorListCreateView, AuthorDetailView, BookDetailView, BookInstanceListCreateView, BooksBulkView, \
+    BookSearchView, BookInstanceContentView, BookCheckoutView, BookReturnView, BookReservationView, LoanListView, \
+    TaskDetailView
 
 app_name = 'libraryapp'
 
+
+def read_view(view_class):
+    if settings.ASYNC_READ_VIEWS:
+        return async_read_view(view_class)
+    return view_class.as_view()
+
+
 urlpatterns = [
-    path('books', BooksView.as_view()),
-    path("books/<int:pk>",BookDetailView.as_view()),
+    path('books', read_view(BooksView)),
+    path('books/bulk', BooksBulkView.as_view()),
+    path('books/search', BookSearchView.as_view()),
+    path("books/<int:pk>",read_view(BookDetailView)),
+    path("books/<int:pk>/checkout", BookCheckoutView.as_view()),
+    path("books/<int:pk>/return", BookReturnView.as_view()),
+    path("books/<int:pk>/reservation", BookReservationView.as_view()),
+    path('loans', LoanListView.as_view()),
+    path('tasks/<int:pk>', TaskDetailView.as_view()),
 
     path('bookinstances', BookInstanceListCreateView.as_view()),
     path("bookinstances/<id_security>", BookInstanceDetailView.as_view()),
+    path("bookinstances/<id_security>/content", BookInstanceContentView.as_view()),
 
     path("all-profiles", UserProfileListCreateView.as_view(), name="all-profiles"),
     path("profile", UserProfileDetailView.as_view(), name="profile"),
 
-    path('genre', GenreListCreateView.as_view()),
-    path("genre/<int:pk>", GenreDetailView.as_view()),
+    path('genre', read_view(GenreListCreateView)),
+    path("genre/<int:pk>", read_view(GenreDetailView)),
 
-    path('authors', AuthorListCreateView.as_view()),
-    path("authors/<int:pk>", AuthorDetailView.as_view())
+    path('authors', read_view(AuthorListCreateView)),
+    path("authors/<int:pk>", read_view(AuthorDetailView))
 ]
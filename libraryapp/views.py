@@ -1,101 +1,296 @@
 from django.contrib.auth.models import User
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
 from rest_framework import status
-from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView, CreateAPIView
+from rest_framework.generics import ListCreateAPIView, RetrieveAPIView, RetrieveUpdateDestroyAPIView, CreateAPIView
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.response import Response
-
-from .permissions import IsOwnerProfileOrReadOnly, IsReaderOrAdmin
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from rest_framework.views import APIView
+
+from .authentication import CachedUserJWTAuthentication, UserJWTAuthentication
+from .bulk import BookBulkLoader, load_books
+from .content import TextReader, accepted_encodings, parse_range
+from .filters import BookFilter, TieBreakOrderingFilter, cached_book_facets
+from .listing import read_listings
+from .loans import cancel_reservation, checkout, reserve, return_book
+from .mixins import CachedListMixin, CachedRetrieveMixin, ConditionalGetMixin, EagerLoadingMixin, InstrumentedMixin, \
+    ReadModelListMixin, ReplicaReadMixin, SparseFieldsMixin, StreamingListMixin
+from .permissions import IsOwnerProfileOrReadOnly, IsReader, IsReaderOrAdmin
+from .search import search_books
 from .serializers import BookSerializer, BookInstanceSerializer, UserProfileSerializer, GenreSerializer, \
-    AuthorSerializer, BookInstanceAdminSerializer, UserCreateSerializer, UserSerializer
-from .models import Book, BookInstance, UserProfile, Genre, Author
+    AuthorSerializer, BookInstanceAdminSerializer, UserCreateSerializer, UserSerializer, LogoutSerializer, \
+    LoanSerializer, ReservationSerializer, TaskSerializer, eager_loading
+from .models import Book, BookInstance, UserProfile, Genre, Author, Loan, Reservation, Task
 
 
-class AuthorListCreateView(ListCreateAPIView):
+class AuthorListCreateView(InstrumentedMixin, ReplicaReadMixin, SparseFieldsMixin, EagerLoadingMixin, StreamingListMixin, ConditionalGetMixin, CachedListMixin, ListCreateAPIView):
     queryset = Author.objects.all()
     serializer_class = AuthorSerializer
     permission_classes = [IsAuthenticated, IsReaderOrAdmin,]
 
 
-class AuthorDetailView(RetrieveUpdateDestroyAPIView):
+class AuthorDetailView(InstrumentedMixin, ReplicaReadMixin, SparseFieldsMixin, EagerLoadingMixin, ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Author.objects.filter()
     serializer_class = AuthorSerializer
     permission_classes = [IsAuthenticated, IsReaderOrAdmin,]
 
 
-class GenreListCreateView(ListCreateAPIView):
+class GenreListCreateView(InstrumentedMixin, ReplicaReadMixin, SparseFieldsMixin, EagerLoadingMixin, StreamingListMixin, ConditionalGetMixin, CachedListMixin, ListCreateAPIView):
     queryset = Genre.objects.all()
     serializer_class = GenreSerializer
     permission_classes = [IsAuthenticated, IsAdminUser]
 
 
-class GenreDetailView(RetrieveUpdateDestroyAPIView):
+class GenreDetailView(InstrumentedMixin, ReplicaReadMixin, SparseFieldsMixin, EagerLoadingMixin, ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     queryset = Genre.objects.filter()
     serializer_class = GenreSerializer
     permission_classes = [IsAuthenticated, IsAdminUser]
 
 
-class BooksView(ListCreateAPIView):
+class BooksView(InstrumentedMixin, ReplicaReadMixin, SparseFieldsMixin, EagerLoadingMixin, StreamingListMixin, ConditionalGetMixin, ReadModelListMixin, CachedListMixin, ListCreateAPIView):
     queryset = Book.objects.all()
     serializer_class = BookSerializer
     permission_classes = [IsReaderOrAdmin]
+    read_rows = staticmethod(read_listings)
+    filter_backends = [BookFilter, TieBreakOrderingFilter]
+    ordering_fields = ('id', 'title', 'updated_at')
+    ordering = ('id',)
 
-    def create(self, request, *args, **kwargs):
-        data = request.data
-        secur = BookInstance.objects.get(id_security=data['id_inst']['id_security'])
-        book = Book.objects.create(title=data['title'], isbn=data['isbn'], status=data['status'], id_inst=secur)
-        book.save()
-        for author in data['authors']:
-            auth = Author.objects.get(first_name=author['first_name'], last_name=author['last_name'])
-            book.authors.add(auth)
-        for genr in data['genre']:
-            gen = Genre.objects.get(name=genr['name'])
-            book.genre.add(gen)
-        serializer=self.get_serializer(book)
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('facets') in ('1', 'true'):
+            return Response(cached_book_facets(request, self.filter_queryset(self.get_queryset())))
+        return super().list(request, *args, **kwargs)
 
+    def create(self, request, *args, **kwargs):
+        if not isinstance(request.data, dict):
+            return Response({'detail': 'Expected a book object.'}, status=status.HTTP_400_BAD_REQUEST)
+        data = {key: value for key, value in request.data.items() if key != 'id'}
+        loader = BookBulkLoader([data]).load()
+        if loader.errors:
+            return Response(loader.errors[0]['errors'], status=status.HTTP_400_BAD_REQUEST)
+        book = self.get_queryset().get(pk=loader.created[0])
+        serializer = self.get_serializer(book)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
-class BookDetailView(RetrieveUpdateDestroyAPIView):
+class BooksBulkView(InstrumentedMixin, ReplicaReadMixin, APIView):
+    """Loads the books in the request; with ?async=1 a background task does, and the response points at it.
+
+    An Idempotency-Key header makes a repeated async request return the task of the first one.
+    """
+    permission_classes = [IsAuthenticated, IsAdminUser]
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return Response({'detail': 'Expected a list of books.'}, status=status.HTTP_400_BAD_REQUEST)
+        if request.query_params.get('async') == '1':
+            key = request.headers.get('Idempotency-Key')
+            task = load_books.delay(request.data, key=key and 'books-bulk:%s:%s' % (request.user.pk, key[:100]))
+            return Response(TaskSerializer(task).data, status=status.HTTP_202_ACCEPTED,
+                            headers={'Location': '/api/tasks/%d' % task.pk})
+        loader = BookBulkLoader(request.data).load()
+        return Response({'created': loader.created, 'updated': loader.updated, 'errors': loader.errors},
+                        status=status.HTTP_200_OK)
+
+
+class TaskDetailView(InstrumentedMixin, RetrieveAPIView):
+    queryset = Task.objects.all()
+    serializer_class = TaskSerializer
+    permission_classes = [IsAuthenticated, IsAdminUser]
+
+
+class BookSearchView(InstrumentedMixin, ReplicaReadMixin, APIView):
+    permission_classes = [IsReaderOrAdmin]
+    throttle_scope = 'search'
+    page_size = 20
+    max_page_size = 100
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'q': ['This parameter is required.']}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            page = max(int(request.query_params.get('page', 1)), 1)
+            page_size = min(max(int(request.query_params.get('page_size', self.page_size)), 1), self.max_page_size)
+        except ValueError:
+            return Response({'page': ['Invalid page.']}, status=status.HTTP_400_BAD_REQUEST)
+        hits = search_books(query, page_size + 1, (page - 1) * page_size)
+        has_next = len(hits) > page_size
+        hits = hits[:page_size]
+        books = eager_loading(Book.objects.all(), BookSerializer).in_bulk([hit[0] for hit in hits])
+        results = []
+        for book_id, rank, title, snippet in hits:
+            if book_id in books:
+                results.append({'book': BookSerializer(books[book_id]).data, 'rank': rank,
+                                'title_highlight': title, 'snippet': snippet})
+        url = request.build_absolute_uri()
+        return Response({
+            'next': replace_query_param(url, 'page', page + 1) if has_next else None,
+            'previous': replace_query_param(url, 'page', page - 1) if page > 1 else None,
+            'results': results,
+        })
+
+
+class BookDetailView(InstrumentedMixin, ReplicaReadMixin, SparseFieldsMixin, EagerLoadingMixin, ConditionalGetMixin, CachedRetrieveMixin, RetrieveUpdateDestroyAPIView):
     queryset = Book.objects.filter()
     serializer_class = BookSerializer
     permission_classes = [IsAuthenticated, IsAdminUser]
 
     def update(self, request, *args, **kwargs):
-        data = request.data
-        #secur = BookInstance.objects.get(id_security=data['id_inst']['id_security'])
-        book = Book.objects.get(id=self.kwargs['pk'])
-        book.title = data['title']
-        book.isbn = data['isbn']
-        book.status = data['status']
-        book.save()
-        book.authors.clear()
-        book.genre.clear()
-        for author in data['authors']:
-            auth = Author.objects.get(first_name=author['first_name'], last_name=author['last_name'])
-            book.authors.add(auth)
-        for genr in data['genre']:
-            gen = Genre.objects.get(name=genr['name'])
-            book.genre.add(gen)
-        serializer = self.get_serializer(book)
+        partial = kwargs.pop('partial', False)
+        if not isinstance(request.data, dict):
+            return Response({'detail': 'Expected a book object.'}, status=status.HTTP_400_BAD_REQUEST)
+        data = {key: value for key, value in request.data.items() if key != 'id'}
+        data['id'] = self.kwargs['pk']
+        loader = BookBulkLoader([data], partial=partial).load()
+        if loader.errors:
+            errors = loader.errors[0]['errors']
+            if 'id' in errors:
+                raise Http404
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        serializer = self.get_serializer(self.get_object())
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class BookInstanceDetailView(RetrieveUpdateDestroyAPIView):
+class BookInstanceDetailView(InstrumentedMixin, ReplicaReadMixin, ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     lookup_field = 'id_security'
-    queryset = BookInstance.objects.filter()
+    queryset = BookInstance.objects.defer(*BookInstance.CONTENT_FIELDS)
     serializer_class = BookInstanceSerializer
     permission_classes = [IsAuthenticated, IsReaderOrAdmin]
 
 
-class BookInstanceListCreateView(ListCreateAPIView):
-    queryset = BookInstance.objects.all()
+class BookInstanceContentView(InstrumentedMixin, ReplicaReadMixin, ConditionalGetMixin, APIView):
+    """The text of a book instance, read from the database in slices.
+
+    ?offset=&limit= (or ?page=&page_size=) return one page of characters as
+    JSON; otherwise the whole text is streamed as text/plain, honouring a
+    single byte Range, or served from a precompressed copy when the client
+    accepts it.
+    """
+    permission_classes = [IsAuthenticated, IsReaderOrAdmin]
+    etag_headers = ('HTTP_ACCEPT_ENCODING',)
+    page_size = 4000
+    max_page_size = 100000
+
+    def perform_content_negotiation(self, request, force=False):
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request, id_security):
+        queryset = BookInstance.objects.filter(id_security=id_security)
+        instance = get_object_or_404(queryset.only('id', 'text_length', 'text_size', 'updated_at'))
+        reader = TextReader(queryset, instance.text_length)
+        params = request.query_params
+        if 'offset' in params or 'page' in params:
+            handler = self.get_page
+        else:
+            handler = self.get_text
+        response = self.conditional_response(instance.updated_at.timestamp(), handler, request, reader, instance)
+        # identity and compressed bodies share the URL, so every response names the header that chooses between them
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def get_page(self, request, reader, instance):
+        params = request.query_params
+        try:
+            limit = min(max(int(params.get('limit', params.get('page_size', self.page_size))), 1), self.max_page_size)
+            if 'offset' in params:
+                offset = max(int(params['offset']), 0)
+            else:
+                offset = (max(int(params['page']), 1) - 1) * limit
+        except ValueError:
+            return Response({'detail': 'offset, limit, page and page_size must be integers.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        next_offset = offset + limit
+        return Response({
+            'offset': offset,
+            'limit': limit,
+            'total': instance.text_length,
+            'next': replace_query_param(remove_query_param(request.build_absolute_uri(), 'page'), 'offset', next_offset)
+            if next_offset < instance.text_length else None,
+            'text': reader.slice(offset, limit),
+        })
+
+    def get_text(self, request, reader, instance):
+        content_type = 'text/plain; charset=utf-8'
+        range_header = request.META.get('HTTP_RANGE')
+        if range_header is None:
+            for encoding in accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''), ('br', 'gzip')):
+                data = reader.queryset.values_list('text_' + encoding, flat=True).get()
+                if data is not None:
+                    response = HttpResponse(bytes(data), content_type=content_type)
+                    response['Content-Encoding'] = encoding
+                    return response
+            response = StreamingHttpResponse((piece.encode('utf-8') for piece in reader.chars()), content_type=content_type)
+            response['Content-Length'] = instance.text_size
+        else:
+            byte_range = parse_range(range_header, instance.text_size)
+            if byte_range is None:
+                response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+                response['Content-Range'] = 'bytes */%d' % instance.text_size
+                return response
+            start, end = byte_range
+            response = StreamingHttpResponse(reader.bytes(start, end), content_type=content_type,
+                                             status=status.HTTP_206_PARTIAL_CONTENT)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, instance.text_size)
+            response['Content-Length'] = end - start
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+
+class BookInstanceListCreateView(InstrumentedMixin, ReplicaReadMixin, SparseFieldsMixin, StreamingListMixin, ConditionalGetMixin, ListCreateAPIView):
+    queryset = BookInstance.objects.defer(*BookInstance.CONTENT_FIELDS)
     serializer_class = BookInstanceAdminSerializer
     permission_classes = [IsAuthenticated, IsAdminUser]
 
 
-class UserRegisterView(CreateAPIView):
+class BookCheckoutView(InstrumentedMixin, APIView):
+    permission_classes = [IsReader]
+
+    def post(self, request, pk):
+        loan = checkout(pk, request.user.pk)
+        return Response(LoanSerializer(loan).data, status=status.HTTP_201_CREATED)
+
+
+class BookReturnView(InstrumentedMixin, APIView):
+    permission_classes = [IsReader]
+
+    def post(self, request, pk):
+        return_book(pk, request.user.pk)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class BookReservationView(InstrumentedMixin, APIView):
+    permission_classes = [IsReader]
+
+    def post(self, request, pk):
+        reservation, position = reserve(pk, request.user.pk)
+        data = ReservationSerializer(reservation).data
+        data['position'] = position
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    def delete(self, request, pk):
+        cancel_reservation(pk, request.user.pk)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class LoanListView(InstrumentedMixin, APIView):
+    """The open loans and waitlist places of the reader."""
+    permission_classes = [IsReader]
+
+    def get(self, request):
+        user_id = request.user.pk
+        loans = Loan.objects.filter(user_id=user_id, returned_at__isnull=True).order_by('due_at')
+        reservations = Reservation.objects.filter(user_id=user_id, closed_at__isnull=True).order_by('id')
+        return Response({'loans': LoanSerializer(loans, many=True).data,
+                         'reservations': ReservationSerializer(reservations, many=True).data})
+
+
+class UserRegisterView(InstrumentedMixin, CreateAPIView):
     queryset = User.objects.all()
     permission_classes = (AllowAny,)
+    throttle_scope = 'register'
     serializer_class = UserCreateSerializer
 
     def create(self, request, *args, **kwargs):
@@ -105,9 +300,21 @@ class UserRegisterView(CreateAPIView):
         return Response(status=status.HTTP_201_CREATED)
 
 
-class UserProfileListCreateView(ListCreateAPIView):
+class LogoutView(InstrumentedMixin, APIView):
+    """Blacklists the posted refresh token; access tokens issued from it expire on their own."""
+    authentication_classes = []
+    permission_classes = (AllowAny,)
+
+    def post(self, request, *args, **kwargs):
+        serializer = LogoutSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UserProfileListCreateView(InstrumentedMixin, StreamingListMixin, ListCreateAPIView):
     queryset = UserProfile.objects.all()
     serializer_class = UserProfileSerializer
+    authentication_classes = [CachedUserJWTAuthentication]
     permission_classes = [IsAuthenticated, ]
 
     def perform_create(self, serializer):
@@ -115,16 +322,31 @@ class UserProfileListCreateView(ListCreateAPIView):
         serializer.save(user=user)
 
 
-class UserProfileDetailView(RetrieveUpdateDestroyAPIView):
+class UserProfileDetailView(InstrumentedMixin, ConditionalGetMixin, RetrieveUpdateDestroyAPIView):
     serializer_class = UserSerializer
+    # read from the database: a user cached by another worker could still hold the profile before a PUT
+    authentication_classes = [UserJWTAuthentication]
     permission_classes = [IsOwnerProfileOrReadOnly, IsAuthenticated]
 
+    def get_user(self, request):
+        """The request user with its profile, both already loaded by the authentication class."""
+        user = request.user
+        try:
+            user.profile
+        except UserProfile.DoesNotExist:
+            user.profile = UserProfile.objects.create(user=user)
+        return user
+
     def get(self, request, *args, **kwargs):
-        serializer = self.serializer_class(request.user)
+        updated = self.get_user(request).profile.update_on
+        return self.conditional_response(updated.timestamp(), self.get_profile, request)
+
+    def get_profile(self, request):
+        serializer = self.serializer_class(self.get_user(request))
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     def put(self, request, *args, **kwargs):
-        serializer = self.serializer_class(request.user, data=request.data, partial=True)
+        serializer = self.serializer_class(self.get_user(request), data=request.data, partial=True)
         serializer.is_valid(raise_exception=True)
         serializer.save()
         return Response(serializer.data, status=status.HTTP_200_OK)